@@ -0,0 +1,261 @@
+# coding=utf-8
+# Copyright 2020 The Trax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Sharded checkpoints: one file per array and a JSON index of the structure.
+
+A sharded checkpoint is a directory with a file `index.json` and one `.npy`
+file per array leaf of each saved field (e.g., 'weights', 'slots', 'state'),
+so single fields can be loaded without reading the others. Leaves that are
+not arrays are stored in the index if they are plain Python values and
+pickled to their own file otherwise. Arrays are loaded lazily as read-only
+memory maps when the checkpoint is on a local file system.
+
+Delta checkpoints store arrays in a blob directory shared by several
+checkpoints instead, under the hash of their content, so arrays that did not
+change since an earlier checkpoint are not written again. Blobs that no
+checkpoint refers to anymore are deleted by `collect_garbage`.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import tensorflow as tf
+
+
+_INDEX_FILE = 'index.json'
+_VERSION = 1
+
+
+def is_sharded(path):
+  """Returns True if path is a sharded checkpoint."""
+  return tf.io.gfile.exists(os.path.join(path, _INDEX_FILE))
+
+
+def save(state_dict, path, blob_dir=None):
+  """Saves a dict of pytrees as a sharded checkpoint in directory path.
+
+  The checkpoint is written to a temporary directory first and then moved to
+  path, replacing an existing checkpoint there.
+
+  Args:
+    state_dict: dict from field names to pytrees of lists, tuples and dicts
+      with string keys, with arrays or other (picklable) objects as leaves.
+    path: directory to save the checkpoint to.
+    blob_dir: optional directory to store arrays in by the hash of their
+      content, for delta checkpoints; arrays already there are not written.
+
+  Returns:
+    The number of leaf files written, which excludes arrays that were already
+    in blob_dir.
+  """
+  tmp_path = path + '._tmp_'
+  if tf.io.gfile.exists(tmp_path):
+    tf.io.gfile.rmtree(tmp_path)
+  tf.io.gfile.makedirs(tmp_path)
+  index = {'version': _VERSION, 'fields': {}}
+  if blob_dir is not None:
+    tf.io.gfile.makedirs(blob_dir)
+    # Relative, so that checkpoints and blobs can be moved together.
+    index['blob_dir'] = os.path.relpath(blob_dir, os.path.dirname(path))
+  leaf_files = []
+  for field, tree in state_dict.items():
+    tf.io.gfile.makedirs(os.path.join(tmp_path, field))
+    index['fields'][field] = _encode(tree, tmp_path, field, leaf_files,
+                                     blob_dir)
+  with tf.io.gfile.GFile(os.path.join(tmp_path, _INDEX_FILE), 'w') as f:
+    json.dump(index, f)
+  _replace_dir(tmp_path, path)
+  return sum(1 for written in leaf_files if written)
+
+
+def load(path, fields=None):
+  """Loads the given fields (by default all) from a sharded checkpoint."""
+  index = _read_index(path)
+  blob_dir = os.path.join(os.path.dirname(path), index.get('blob_dir', ''))
+  if fields is None:
+    fields = list(index['fields'].keys())
+  return {field: _decode(index['fields'][field], path, blob_dir)
+          for field in fields}
+
+
+def collect_garbage(blob_dir, checkpoint_paths):
+  """Deletes blobs not used by any of the given (delta) checkpoints.
+
+  Args:
+    blob_dir: the blob directory the checkpoints were saved with.
+    checkpoint_paths: all checkpoints that use blob_dir and should be kept.
+
+  Returns:
+    The number of deleted blobs.
+  """
+  used = set()
+  for path in checkpoint_paths:
+    index = _read_index(path)
+    for node in index['fields'].values():
+      used.update(_blobs(node))
+  n_deleted = 0
+  for file_name in tf.io.gfile.listdir(blob_dir):
+    if file_name.endswith('.npy') and file_name not in used:
+      tf.io.gfile.remove(os.path.join(blob_dir, file_name))
+      n_deleted += 1
+  return n_deleted
+
+
+def _read_index(path):
+  with tf.io.gfile.GFile(os.path.join(path, _INDEX_FILE)) as f:
+    index = json.load(f)
+  if index['version'] > _VERSION:
+    raise ValueError(f'Checkpoint {path} has version {index["version"]}, '
+                     f'can only load up to version {_VERSION}.')
+  return index
+
+
+def _blobs(node):
+  """Yields the names of all blobs used in the tree described by node."""
+  if 'blob' in node:
+    yield node['blob']
+  for kind in ('list', 'tuple'):
+    for x in node.get(kind, []):
+      yield from _blobs(x)
+  for x in node.get('dict', {}).values():
+    yield from _blobs(x)
+
+
+def link(src_path, dst_path):
+  """Makes dst_path a copy of the checkpoint at src_path, hard-linking files.
+
+  On file systems without hard links, such as GCS, files are copied instead.
+
+  Args:
+    src_path: directory of an existing sharded checkpoint.
+    dst_path: directory to put the copy in, replacing an existing one there.
+  """
+  tmp_path = dst_path + '._tmp_'
+  if tf.io.gfile.exists(tmp_path):
+    tf.io.gfile.rmtree(tmp_path)
+  for src_dir, _, file_names in tf.io.gfile.walk(src_path):
+    dst_dir = os.path.join(tmp_path, os.path.relpath(src_dir, src_path))
+    tf.io.gfile.makedirs(dst_dir)
+    for file_name in file_names:
+      src_file = os.path.join(src_dir, file_name)
+      dst_file = os.path.join(dst_dir, file_name)
+      try:
+        os.link(src_file, dst_file)
+      except OSError:
+        tf.io.gfile.copy(src_file, dst_file, overwrite=True)
+  _replace_dir(tmp_path, dst_path)
+
+
+def _replace_dir(src_path, dst_path):
+  """Moves directory src_path to dst_path, replacing what is there."""
+  old_path = dst_path + '._old_'
+  if tf.io.gfile.exists(dst_path):
+    if tf.io.gfile.exists(old_path):
+      tf.io.gfile.rmtree(old_path)
+    tf.io.gfile.rename(dst_path, old_path)
+  tf.io.gfile.rename(src_path, dst_path)
+  if tf.io.gfile.exists(old_path):
+    tf.io.gfile.rmtree(old_path)
+
+
+def _encode(tree, path, field, leaf_files, blob_dir):
+  """Writes the leaves of tree to files and returns its JSON description.
+
+  Args:
+    tree: the tree to save.
+    path: the checkpoint directory.
+    field: the field of the checkpoint the tree is in.
+    leaf_files: list to which a bool is appended for each file leaf, whether
+      the file was written (and not found in the blob directory).
+    blob_dir: the blob directory, or None if not saving a delta checkpoint.
+
+  Returns:
+    A JSON-serializable description of tree.
+  """
+  encode = lambda x: _encode(x, path, field, leaf_files, blob_dir)
+  if isinstance(tree, (list, tuple)):
+    kind = 'list' if isinstance(tree, list) else 'tuple'
+    return {kind: [encode(x) for x in tree]}
+  if isinstance(tree, dict) and all(isinstance(k, str) for k in tree):
+    return {'dict': {k: encode(v) for (k, v) in tree.items()}}
+  if tree is None or isinstance(tree, (bool, int, float, str)):
+    return {'value': tree}
+  leaf_file = os.path.join(field, str(len(leaf_files)))
+  if hasattr(tree, 'shape') and hasattr(tree, 'dtype'):
+    array = np.asarray(tree)
+    if array.dtype != np.object_:
+      if blob_dir is not None:
+        blob = _hash(array) + '.npy'
+        blob_path = os.path.join(blob_dir, blob)
+        write = not tf.io.gfile.exists(blob_path)
+        if write:
+          _save_array(array, blob_path)
+        leaf_files.append(write)
+        return {'blob': blob}
+      leaf_file += '.npy'
+      _save_array(array, os.path.join(path, leaf_file))
+      leaf_files.append(True)
+      return {'array': leaf_file}
+  leaf_files.append(True)
+  leaf_file += '.pkl'
+  with tf.io.gfile.GFile(os.path.join(path, leaf_file), 'wb') as f:
+    pickle.dump(tree, f)
+  return {'pickle': leaf_file}
+
+
+def _hash(array):
+  """Returns a hex digest of the dtype, shape and content of array."""
+  h = hashlib.blake2b(digest_size=20)
+  h.update(f'{array.dtype.str}{array.shape}'.encode())
+  h.update(np.ascontiguousarray(array).data)
+  return h.hexdigest()
+
+
+def _save_array(array, file_path):
+  """Saves array to file_path, atomically by moving a temporary file."""
+  tmp_path = file_path + '._tmp_'
+  with tf.io.gfile.GFile(tmp_path, 'wb') as f:
+    np.save(f, array, allow_pickle=False)
+  tf.io.gfile.rename(tmp_path, file_path, overwrite=True)
+
+
+def _load_array(file_path):
+  if os.path.exists(file_path):  # Local file, can be memory-mapped.
+    return np.load(file_path, mmap_mode='r')
+  with tf.io.gfile.GFile(file_path, 'rb') as f:
+    return np.load(f)
+
+
+def _decode(node, path, blob_dir):
+  """Returns the tree described by node, loading leaves from files in path."""
+  decode = lambda x: _decode(x, path, blob_dir)
+  if 'list' in node:
+    return [decode(x) for x in node['list']]
+  if 'tuple' in node:
+    return tuple(decode(x) for x in node['tuple'])
+  if 'dict' in node:
+    return {k: decode(v) for (k, v) in node['dict'].items()}
+  if 'value' in node:
+    return node['value']
+  if 'array' in node:
+    return _load_array(os.path.join(path, node['array']))
+  if 'blob' in node:
+    return _load_array(os.path.join(blob_dir, node['blob']))
+  with tf.io.gfile.GFile(os.path.join(path, node['pickle']), 'rb') as f:
+    return pickle.load(f)
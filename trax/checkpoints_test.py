@@ -0,0 +1,110 @@
+# coding=utf-8
+# Copyright 2020 The Trax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Tests for trax.checkpoints."""
+
+import os
+
+from absl.testing import absltest
+import numpy as np
+
+from trax import checkpoints
+from trax import history as trax_history
+
+
+class CheckpointsTest(absltest.TestCase):
+
+  def _state_dict(self):
+    history = trax_history.History()
+    history.append('train', 'metrics/loss', 1, 0.5)
+    return {
+        'step': 7,
+        'weights': ((np.ones((2, 3)), ()), [np.arange(4)]),
+        'slots': {'m': np.zeros((5,), dtype=np.float32), 'v': None},
+        'history': history,
+    }
+
+  def test_save_and_load(self):
+    path = os.path.join(self.create_tempdir().full_path, 'model.ckpt')
+    checkpoints.save(self._state_dict(), path)
+    self.assertTrue(checkpoints.is_sharded(path))
+    loaded = checkpoints.load(path)
+    self.assertEqual(loaded['step'], 7)
+    np.testing.assert_array_equal(loaded['weights'][0][0], np.ones((2, 3)))
+    self.assertEqual(loaded['weights'][0][1], ())
+    np.testing.assert_array_equal(loaded['weights'][1][0], np.arange(4))
+    self.assertEqual(loaded['slots']['m'].dtype, np.float32)
+    self.assertIsNone(loaded['slots']['v'])
+    self.assertEqual(loaded['history'].get('train', 'metrics/loss'),
+                     [(1, 0.5)])
+    # Arrays are memory-mapped.
+    self.assertIsInstance(loaded['weights'][0][0], np.memmap)
+
+  def test_load_selected_fields(self):
+    path = os.path.join(self.create_tempdir().full_path, 'model.ckpt')
+    checkpoints.save(self._state_dict(), path)
+    loaded = checkpoints.load(path, ['weights'])
+    self.assertEqual(list(loaded.keys()), ['weights'])
+
+  def test_save_replaces_checkpoint(self):
+    path = os.path.join(self.create_tempdir().full_path, 'model.ckpt')
+    checkpoints.save(self._state_dict(), path)
+    checkpoints.save({'step': 8}, path)
+    self.assertEqual(checkpoints.load(path), {'step': 8})
+
+  def test_link(self):
+    directory = self.create_tempdir().full_path
+    src_path = os.path.join(directory, 'model_7.ckpt')
+    dst_path = os.path.join(directory, 'model.ckpt')
+    checkpoints.save(self._state_dict(), src_path)
+    checkpoints.link(src_path, dst_path)
+    self.assertEqual(checkpoints.load(dst_path)['step'], 7)
+    self.assertTrue(os.path.samefile(os.path.join(src_path, 'index.json'),
+                                     os.path.join(dst_path, 'index.json')))
+
+  def test_delta_checkpoints_share_unchanged_arrays(self):
+    directory = self.create_tempdir().full_path
+    blob_dir = os.path.join(directory, 'blobs')
+    state_dict = self._state_dict()
+    # 3 arrays and the pickled history.
+    self.assertEqual(checkpoints.save(
+        state_dict, os.path.join(directory, 'model_1.ckpt'), blob_dir), 4)
+    state_dict['slots']['m'] = np.ones((5,), dtype=np.float32)
+    self.assertEqual(checkpoints.save(
+        state_dict, os.path.join(directory, 'model_2.ckpt'), blob_dir), 2)
+    self.assertLen(os.listdir(blob_dir), 4)
+    loaded = checkpoints.load(os.path.join(directory, 'model_2.ckpt'))
+    np.testing.assert_array_equal(loaded['slots']['m'], np.ones((5,)))
+    np.testing.assert_array_equal(loaded['weights'][1][0], np.arange(4))
+
+  def test_collect_garbage(self):
+    directory = self.create_tempdir().full_path
+    blob_dir = os.path.join(directory, 'blobs')
+    path = os.path.join(directory, 'model.ckpt')
+    state_dict = self._state_dict()
+    checkpoints.save(state_dict, path, blob_dir)
+    state_dict['slots']['m'] = np.ones((5,), dtype=np.float32)
+    checkpoints.save(state_dict, path, blob_dir)
+    # Only the zeros that were replaced are not used anymore.
+    self.assertEqual(checkpoints.collect_garbage(blob_dir, [path]), 1)
+    self.assertLen(os.listdir(blob_dir), 3)
+    np.testing.assert_array_equal(
+        checkpoints.load(path)['weights'][0][0], np.ones((2, 3)))
+    self.assertEqual(checkpoints.collect_garbage(blob_dir, []), 3)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,298 @@
+# coding=utf-8
+# Copyright 2020 The Trax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Writes TensorBoard event files without TensorFlow.
+
+Events are encoded as `Event` protocol buffers by hand and framed as TFRecords
+(length, masked CRC32C of the length, data, masked CRC32C of the data), which
+is the format TensorBoard reads. Summaries are passed around as serialized
+`Summary` protos: since `Summary` only has the repeated field `value`, the
+concatenation of serialized summaries is the serialized summary with all of
+their values, so summaries for the same step are merged into one event by
+joining their bytes.
+
+`EventFileWriter` buffers summaries in memory and encodes and writes them in a
+background thread, when enough of them are buffered or enough time passed.
+"""
+
+import os
+import socket
+import struct
+import threading
+import time
+
+
+# Protocol buffer wire types.
+_VARINT = 0
+_FIXED64 = 1
+_BYTES = 2
+_FIXED32 = 5
+
+# Fields of Event, Summary, Summary.Value and HistogramProto (see
+# tensorflow/core/util/event.proto and tensorflow/core/framework/summary.proto).
+_EVENT_WALL_TIME = 1
+_EVENT_STEP = 2
+_EVENT_FILE_VERSION = 3
+_EVENT_SUMMARY = 5
+_SUMMARY_VALUE = 1
+_VALUE_TAG = 1
+_VALUE_SIMPLE_VALUE = 2
+_VALUE_HISTO = 5
+_HISTO_FIELDS = ('min', 'max', 'num', 'sum', 'sum_squares')  # Fields 1 to 5.
+_HISTO_BUCKET_LIMIT = 6
+_HISTO_BUCKET = 7
+
+_FILE_VERSION = b'brain.Event:2'
+
+
+def _make_crc32c_table():
+  table = []
+  for i in range(256):
+    crc = i
+    for _ in range(8):
+      crc = (crc >> 1) ^ 0x82f63b78 if crc & 1 else crc >> 1
+    table.append(crc)
+  return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def python_crc32c(data):
+  """Returns the CRC32C (Castagnoli) checksum of data, in pure Python."""
+  crc = 0xffffffff
+  table = _CRC32C_TABLE
+  for byte in data:
+    crc = table[(crc ^ byte) & 0xff] ^ (crc >> 8)
+  return crc ^ 0xffffffff
+
+
+def _native_crc32c():
+  """Returns a compiled CRC32C function from an installed package, or None."""
+  try:
+    import google_crc32c  # pylint: disable=g-import-not-at-top
+    # Without its C extension, google_crc32c falls back to pure Python too.
+    if getattr(google_crc32c, 'implementation', 'c') == 'c':
+      return google_crc32c.value
+  except ImportError:
+    pass
+  try:
+    import crc32c as crc32c_lib  # pylint: disable=g-import-not-at-top
+    return crc32c_lib.crc32c
+  except ImportError:
+    return None
+
+
+# Returns the CRC32C (Castagnoli) checksum of data, as TFRecords use. Computed
+# by the google_crc32c or crc32c package if installed, else in pure Python.
+crc32c = _native_crc32c() or python_crc32c
+
+
+def _masked_crc32c(data):
+  crc = crc32c(data)
+  return (((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xffffffff
+
+
+def record(data):
+  """Returns data framed as a TFRecord."""
+  length = struct.pack('<Q', len(data))
+  return b''.join([length, struct.pack('<I', _masked_crc32c(length)),
+                   data, struct.pack('<I', _masked_crc32c(data))])
+
+
+def _varint(n):
+  n &= 0xffffffffffffffff  # Negative ints are encoded in two's complement.
+  out = bytearray()
+  while n > 0x7f:
+    out.append((n & 0x7f) | 0x80)
+    n >>= 7
+  out.append(n)
+  return bytes(out)
+
+
+def _key(field, wire_type):
+  return _varint((field << 3) | wire_type)
+
+
+def _bytes_field(field, data):
+  return _key(field, _BYTES) + _varint(len(data)) + data
+
+
+def _double_field(field, value):
+  return _key(field, _FIXED64) + struct.pack('<d', value)
+
+
+def scalar_summary(tag, value):
+  """Returns a serialized Summary with a scalar value."""
+  value = (_bytes_field(_VALUE_TAG, tag.encode('utf-8')) +
+           _key(_VALUE_SIMPLE_VALUE, _FIXED32) + struct.pack('<f', value))
+  return _bytes_field(_SUMMARY_VALUE, value)
+
+
+def histogram_summary(tag, histogram):
+  """Returns a serialized Summary with a histogram.
+
+  Args:
+    tag: str, label of the histogram.
+    histogram: dict with the fields of a `HistogramProto`: floats 'min',
+      'max', 'num', 'sum' and 'sum_squares' and lists of floats 'bucket_limit'
+      and 'bucket'.
+  """
+  fields = [_double_field(i + 1, float(histogram[name]))
+            for (i, name) in enumerate(_HISTO_FIELDS)]
+  for field, name in ((_HISTO_BUCKET_LIMIT, 'bucket_limit'),
+                      (_HISTO_BUCKET, 'bucket')):
+    values = [float(x) for x in histogram[name]]
+    fields.append(_bytes_field(
+        field, struct.pack('<%dd' % len(values), *values)))
+  value = (_bytes_field(_VALUE_TAG, tag.encode('utf-8')) +
+           _bytes_field(_VALUE_HISTO, b''.join(fields)))
+  return _bytes_field(_SUMMARY_VALUE, value)
+
+
+def event(wall_time, step=None, summary=None, file_version=None):
+  """Returns a serialized Event.
+
+  Args:
+    wall_time: float, time of the event in seconds since the epoch.
+    step: optional int, the step of the event.
+    summary: optional serialized Summary.
+    file_version: optional bytes, the version for the first event in a file.
+  """
+  fields = [_double_field(_EVENT_WALL_TIME, wall_time)]
+  if step is not None:
+    fields.append(_key(_EVENT_STEP, _VARINT) + _varint(int(step)))
+  if file_version is not None:
+    fields.append(_bytes_field(_EVENT_FILE_VERSION, file_version))
+  if summary is not None:
+    fields.append(_bytes_field(_EVENT_SUMMARY, summary))
+  return b''.join(fields)
+
+
+class EventFileWriter(object):
+  """Writes summaries to a new event file, buffered and in the background.
+
+  Added summaries are buffered in memory. A background thread writes them
+  when max_queue of them are buffered, every flush_secs seconds and on
+  `flush` and `close`; summaries for the same step added one after another
+  are written as one event. Adding summaries never waits for the file.
+  """
+
+  def __init__(self, log_dir, max_queue=1000, flush_secs=120,
+               filename_suffix='', open_fn=open):
+    """Creates a new event file in log_dir, which must exist.
+
+    Args:
+      log_dir: directory to write the event file to.
+      max_queue: int, the number of buffered summaries that starts a write.
+      flush_secs: float, the most seconds summaries stay in the buffer.
+      filename_suffix: str, appended to the name of the event file.
+      open_fn: function like `open` to open the file with, e.g.,
+        `tf.io.gfile.GFile` for file systems not supported by `open`.
+    """
+    file_name = 'events.out.tfevents.%010d.%s%s' % (
+        time.time(), socket.gethostname(), filename_suffix)
+    self._path = os.path.join(log_dir, file_name)
+    self._file = open_fn(self._path, 'wb')
+    self._file.write(record(event(time.time(), file_version=_FILE_VERSION)))
+    self._max_queue = max_queue
+    self._flush_secs = flush_secs
+    # Buffered (step, wall time, summary or (tag, scalar value)) entries.
+    self._buffer = []
+    self._buffer_lock = threading.Lock()
+    self._file_lock = threading.Lock()
+    self._wake_up = threading.Event()
+    self._closed = False
+    self._error = None
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  @property
+  def path(self):
+    return self._path
+
+  def add_summary(self, summary, step=None, wall_time=None):
+    """Buffers a serialized Summary for the given step."""
+    self._add((step, wall_time or time.time(), summary))
+
+  def add_scalar(self, tag, value, step=None, wall_time=None):
+    """Buffers a scalar value, to be encoded when written."""
+    self._add((step, wall_time or time.time(), (tag, float(value))))
+
+  def _add(self, entry):
+    if self._closed:
+      raise ValueError(f'Cannot write to closed event file {self._path}.')
+    with self._buffer_lock:
+      self._buffer.append(entry)
+      n_buffered = len(self._buffer)
+    if n_buffered >= self._max_queue:
+      self._wake_up.set()
+
+  def flush(self):
+    """Writes all buffered summaries and flushes the file."""
+    self._write_buffer()
+    with self._file_lock:
+      self._file.flush()
+    self._raise_error()
+
+  def close(self):
+    """Writes all buffered summaries and closes the file. Final!"""
+    if self._closed:
+      return
+    self._closed = True
+    self._wake_up.set()
+    self._thread.join()
+    self._write_buffer()
+    with self._file_lock:
+      self._file.close()
+    self._raise_error()
+
+  def _run(self):
+    while not self._closed:
+      self._wake_up.wait(self._flush_secs)
+      self._wake_up.clear()
+      try:
+        self._write_buffer()
+        with self._file_lock:
+          self._file.flush()
+      except Exception as e:  # pylint: disable=broad-except
+        self._error = e
+
+  def _raise_error(self):
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error
+
+  def _write_buffer(self):
+    """Encodes the buffered summaries, merged by step, and writes them."""
+    with self._buffer_lock:
+      entries, self._buffer = self._buffer, []
+    if not entries:
+      return
+    records = []
+    start = 0
+    for end in range(1, len(entries) + 1):
+      if end < len(entries) and entries[end][0] == entries[start][0]:
+        continue
+      step, wall_time, _ = entries[start]
+      summary = b''.join(
+          scalar_summary(*value) if isinstance(value, tuple) else value
+          for (_, _, value) in entries[start:end])
+      records.append(record(event(wall_time, step=step, summary=summary)))
+      start = end
+    with self._file_lock:
+      self._file.write(b''.join(records))
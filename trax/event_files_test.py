@@ -0,0 +1,84 @@
+# coding=utf-8
+# Copyright 2020 The Trax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Tests for trax.event_files."""
+
+import os
+
+from absl.testing import absltest
+import numpy as np
+import tensorflow as tf
+
+from trax import event_files
+from trax import jaxboard
+
+
+def _read_events(log_dir):
+  (file_name,) = os.listdir(log_dir)
+  return list(tf.compat.v1.train.summary_iterator(
+      os.path.join(log_dir, file_name)))
+
+
+class EventFilesTest(absltest.TestCase):
+
+  def test_crc32c(self):
+    self.assertEqual(event_files.crc32c(b'123456789'), 0xe3069283)
+    self.assertEqual(event_files.python_crc32c(b'123456789'), 0xe3069283)
+    data = bytes(range(256)) * 3
+    self.assertEqual(event_files.crc32c(data), event_files.python_crc32c(data))
+
+  def test_write_scalars_and_histogram(self):
+    log_dir = self.create_tempdir().full_path
+    writer = event_files.EventFileWriter(log_dir, max_queue=2)
+    writer.add_scalar('loss', 0.5, step=3)
+    writer.add_scalar('accuracy', 0.75, step=3)
+    writer.add_summary(event_files.histogram_summary('weights', dict(
+        min=-1.0, max=2.0, num=3, sum=1.0, sum_squares=6.0,
+        bucket_limit=[0.0, 2.0], bucket=[1.0, 2.0])), step=4)
+    writer.close()
+
+    events = _read_events(log_dir)
+    self.assertEqual(events[0].file_version, 'brain.Event:2')
+    self.assertEqual([e.step for e in events[1:]], [3, 4])
+    # Scalars of the same step are merged into one event.
+    values = events[1].summary.value
+    self.assertEqual([v.tag for v in values], ['loss', 'accuracy'])
+    self.assertEqual([v.simple_value for v in values], [0.5, 0.75])
+    histo = events[2].summary.value[0].histo
+    self.assertEqual(histo.num, 3)
+    self.assertEqual(list(histo.bucket_limit), [0.0, 2.0])
+    self.assertEqual(list(histo.bucket), [1.0, 2.0])
+
+  def test_buffered_summary_writer(self):
+    log_dir = self.create_tempdir().full_path
+    writer = jaxboard.SummaryWriter(log_dir, buffered=True)
+    writer.scalar('loss', np.float32(0.25), step=1)
+    writer.histogram('weights', np.arange(10), bins=4, step=1)
+    writer.text('note', 'hello', step=2)
+    writer.flush()
+    writer.close()
+
+    events = _read_events(log_dir)
+    self.assertEqual([e.step for e in events[1:]], [1, 2])
+    self.assertEqual([v.tag for v in events[1].summary.value],
+                     ['loss', 'weights'])
+    self.assertEqual(events[1].summary.value[0].simple_value, 0.25)
+    self.assertEqual(events[1].summary.value[1].histo.num, 10)
+    self.assertEqual(events[2].summary.value[0].tag, 'note')
+
+
+if __name__ == '__main__':
+  absltest.main()
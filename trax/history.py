@@ -19,9 +19,119 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import collections
-
 from absl import logging
+import numpy as np
+
+
+class _Series(object):
+  """Steps and values of one metric, in growable NumPy arrays.
+
+  The arrays are over-allocated and doubled when full, so appending takes
+  amortized constant time. Values are stored as bools, ints (int64) or floats
+  (float64), whichever holds all of them, as `np.promote_types` gives: bools
+  and ints are kept as they are, but ints mixed with floats become floats,
+  exact only up to 2**53. If any value is not a real number or bool, they
+  are stored as objects. Steps are normally appended in increasing order,
+  which allows lookups by binary search; otherwise a sorted order is computed
+  when needed.
+  """
+
+  def __init__(self, steps=None, values=None):
+    if steps is None:
+      steps = np.zeros((0,), dtype=np.int64)
+      values = np.zeros((0,), dtype=np.float64)
+    self._steps = np.asarray(steps, dtype=np.int64)
+    self._values = np.asarray(values)
+    self._size = len(self._steps)
+    self._sorted = bool(np.all(self._steps[1:] >= self._steps[:-1]))
+
+  def __len__(self):
+    return self._size
+
+  def append(self, step, value):
+    """Appends a (step, value) pair."""
+    if self._size == len(self._steps):
+      capacity = max(2 * self._size, 16)
+      self._steps = _resized(self._steps, capacity)
+      self._values = _resized(self._values, capacity)
+    if self._values.dtype != np.object_:
+      dtype = _value_dtype(value)
+      if dtype is None:
+        dtype = np.object_
+      elif self._size:
+        dtype = np.promote_types(self._values.dtype, dtype)
+      if dtype != self._values.dtype:
+        self._values = self._values.astype(dtype)
+    if self._size and step < self._steps[self._size - 1]:
+      self._sorted = False
+    self._steps[self._size] = step
+    self._values[self._size] = value
+    self._size += 1
+
+  @property
+  def steps(self):
+    return self._steps[:self._size]
+
+  @property
+  def values(self):
+    return self._values[:self._size]
+
+  def pairs(self, start=0, stop=None):
+    """Returns the (step, value) pairs at positions start to stop."""
+    steps = self.steps[start:stop].tolist()
+    values = self.values[start:stop]
+    if values.dtype != np.object_:
+      values = values.tolist()
+    return list(zip(steps, values))
+
+  def window(self, start_step=None, stop_step=None):
+    """Returns the (step, value) pairs with start_step <= step < stop_step."""
+    if not self._sorted:
+      pairs = self.pairs()
+      return [(step, value) for (step, value) in pairs
+              if (start_step is None or step >= start_step) and
+              (stop_step is None or step < stop_step)]
+    start = 0
+    if start_step is not None:
+      start = int(np.searchsorted(self.steps, start_step, side='left'))
+    stop = None
+    if stop_step is not None:
+      stop = int(np.searchsorted(self.steps, stop_step, side='left'))
+    return self.pairs(start, stop)
+
+  def value_at(self, step):
+    """Returns the last value appended at or before step, or None."""
+    if not self._sorted:
+      at_or_before = np.nonzero(self.steps <= step)[0]
+      if not at_or_before.size:
+        return None
+      steps = self.steps[at_or_before]
+      i = at_or_before[np.nonzero(steps == steps.max())[0][-1]]
+      return self.pairs(i, i + 1)[0][1]
+    i = int(np.searchsorted(self.steps, step, side='right'))
+    if not i:
+      return None
+    return self.pairs(i - 1, i)[0][1]
+
+
+def _resized(array, capacity):
+  resized = np.zeros((capacity,), dtype=array.dtype)
+  resized[:len(array)] = array
+  return resized
+
+
+def _value_dtype(value):
+  """Returns the dtype to store a scalar bool, int or float in, else None."""
+  if np.ndim(value) != 0:
+    return None
+  dtype = np.asarray(value).dtype
+  if dtype == np.bool_:
+    return np.dtype(np.bool_)
+  if np.issubdtype(dtype, np.integer):
+    return np.dtype(np.int64)
+  if np.issubdtype(dtype, np.floating):
+    return np.dtype(np.float64)
+  return None
 
 
 class History(object):
@@ -36,13 +146,17 @@ class History(object):
   history.append('train', 'metrics/accuracy', 1000, 0.31)
   history.get('train', 'metrics/accuracy')
   # returns [(1, 0.04), (1000, 0.31)]
+
+  The steps and values of each metric are stored in NumPy arrays, so they can
+  be read as arrays with `steps_and_values` and queried by step with `window`
+  and `value_at` in logarithmic time, and pickle compactly.
   """
 
   def __init__(self):
     # Structure is
     # values = {
     #   'mode1': {
-    #     'metric1': [val1, val2],
+    #     'metric1': _Series of steps and values,
     #     ...
     #   },
     #   'mode2': ...
@@ -51,16 +165,33 @@ class History(object):
 
   def append(self, mode, metric, step, value):
     """Append (step, value) pair to history for the given mode and metric."""
+    series = self._values.setdefault(mode, {}).get(metric)
+    if series is None:
+      series = self._values[mode][metric] = _Series()
+    series.append(step, value)
+
+  def _series(self, mode, metric):
     if mode not in self._values:
-      self._values[mode] = collections.defaultdict(list)
-    self._values[mode][metric].append((step, value))
+      logging.info('Metric %s not found for mode %s', metric, mode)
+      return _Series()
+    return self._values[mode].get(metric) or _Series()
 
   def get(self, mode, metric):
     """Get the history for the given metric and mode."""
-    if mode not in self._values:
-      logging.info('Metric %s not found for mode %s', metric, mode)
-      return []
-    return list(self._values[mode][metric])
+    return self._series(mode, metric).pairs()
+
+  def steps_and_values(self, mode, metric):
+    """Returns copies of the arrays of steps and values of the metric."""
+    series = self._series(mode, metric)
+    return np.copy(series.steps), np.copy(series.values)
+
+  def window(self, mode, metric, start_step=None, stop_step=None):
+    """Get the (step, value) pairs with start_step <= step < stop_step."""
+    return self._series(mode, metric).window(start_step, stop_step)
+
+  def value_at(self, mode, metric, step):
+    """Get the last value of the metric at or before step, or None if none."""
+    return self._series(mode, metric).value_at(step)
 
   @property
   def modes(self):
@@ -74,5 +205,27 @@ class History(object):
       return []
     return sorted(list(self._values[mode].keys()))
 
+  def __getstate__(self):
+    # Only the filled part of the arrays is pickled.
+    return {'values': {
+        mode: {metric: (series.steps, series.values)
+               for (metric, series) in metrics.items()}
+        for (mode, metrics) in self._values.items()}}
+
+  def __setstate__(self, state):
+    if 'values' not in state:  # Pickled with lists of (step, value) pairs.
+      self._values = {}
+      for (mode, metrics) in state['_values'].items():
+        for (metric, pairs) in metrics.items():
+          for (step, value) in pairs:
+            self.append(mode, metric, step, value)
+      return
+    self._values = {
+        mode: {metric: _Series(steps, values)
+               for (metric, (steps, values)) in metrics.items()}
+        for (mode, metrics) in state['values'].items()}
+
   def __str__(self):
-    return str(self._values)
+    return str({mode: {metric: series.pairs()
+                       for (metric, series) in metrics.items()}
+                for (mode, metrics) in self._values.items()})
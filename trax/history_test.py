@@ -0,0 +1,123 @@
+# coding=utf-8
+# Copyright 2020 The Trax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Tests for trax.history."""
+
+import collections
+import pickle
+
+from absl.testing import absltest
+import numpy as np
+
+from trax import history as trax_history
+
+
+class HistoryTest(absltest.TestCase):
+
+  def _history(self, n_steps=100):
+    history = trax_history.History()
+    for step in range(0, n_steps * 10, 10):
+      history.append('train', 'metrics/loss', step, 1.0 / (step + 1))
+      history.append('eval', 'metrics/accuracy', step, np.float32(0.5))
+    return history
+
+  def test_append_and_get(self):
+    history = self._history(n_steps=3)
+    self.assertEqual(history.get('train', 'metrics/loss'),
+                     [(0, 1.0), (10, 1.0 / 11), (20, 1.0 / 21)])
+    self.assertEqual(history.get('eval', 'metrics/accuracy'),
+                     [(0, 0.5), (10, 0.5), (20, 0.5)])
+    self.assertEqual(history.get('eval', 'metrics/loss'), [])
+    self.assertEqual(history.get('predict', 'metrics/loss'), [])
+    self.assertEqual(history.modes, ['eval', 'train'])
+    self.assertEqual(history.metrics_for_mode('train'), ['metrics/loss'])
+    self.assertEqual(history.metrics_for_mode('predict'), [])
+
+  def test_steps_and_values(self):
+    history = self._history()
+    steps, values = history.steps_and_values('train', 'metrics/loss')
+    np.testing.assert_array_equal(steps, np.arange(0, 1000, 10))
+    np.testing.assert_allclose(values, 1.0 / (steps + 1))
+    values[:] = 0.0  # The arrays are copies.
+    self.assertEqual(history.get('train', 'metrics/loss')[0], (0, 1.0))
+
+  def test_window_and_value_at(self):
+    history = self._history()
+    self.assertEqual(history.window('train', 'metrics/loss', 15, 40),
+                     [(20, 1.0 / 21), (30, 1.0 / 31)])
+    self.assertLen(history.window('train', 'metrics/loss', stop_step=50), 5)
+    self.assertEqual(history.value_at('train', 'metrics/loss', 25), 1.0 / 21)
+    self.assertEqual(history.value_at('train', 'metrics/loss', 20), 1.0 / 21)
+    self.assertIsNone(history.value_at('train', 'metrics/loss', -1))
+
+  def test_unsorted_steps(self):
+    history = trax_history.History()
+    for step in (5, 1, 3):
+      history.append('train', 'metrics/loss', step, float(step))
+    self.assertEqual(history.get('train', 'metrics/loss'),
+                     [(5, 5.0), (1, 1.0), (3, 3.0)])
+    self.assertEqual(history.window('train', 'metrics/loss', 2, 6),
+                     [(5, 5.0), (3, 3.0)])
+    self.assertEqual(history.value_at('train', 'metrics/loss', 4), 3.0)
+
+  def test_value_dtypes(self):
+    history = trax_history.History()
+    big_int = 2 ** 53 + 1  # Not exact as a float.
+    history.append('train', 'count', 1, big_int)
+    history.append('train', 'count', 2, np.int32(3))
+    self.assertEqual(history.get('train', 'count'), [(1, big_int), (2, 3)])
+    self.assertIsInstance(history.value_at('train', 'count', 2), int)
+    history.append('train', 'flag', 1, True)
+    history.append('train', 'flag', 2, np.bool_(False))
+    _, flags = history.steps_and_values('train', 'flag')
+    self.assertEqual(flags.dtype, np.bool_)
+    self.assertFalse(np.any(np.isnan(flags)))
+    self.assertIs(history.value_at('train', 'flag', 1), True)
+    # Mixed with floats, ints and bools become floats.
+    history.append('train', 'flag', 3, 0.5)
+    history.append('train', 'count', 3, 0.5)
+    self.assertEqual(history.get('train', 'flag'),
+                     [(1, 1.0), (2, 0.0), (3, 0.5)])
+    _, counts = history.steps_and_values('train', 'count')
+    self.assertEqual(counts.dtype, np.float64)
+
+  def test_non_numeric_values(self):
+    history = trax_history.History()
+    history.append('train', 'metrics/loss', 1, 0.5)
+    history.append('train', 'metrics/loss', 2, 'nan?')
+    self.assertEqual(history.get('train', 'metrics/loss'),
+                     [(1, 0.5), (2, 'nan?')])
+
+  def test_pickle(self):
+    history = self._history()
+    unpickled = pickle.loads(pickle.dumps(history))
+    self.assertEqual(unpickled.get('train', 'metrics/loss'),
+                     history.get('train', 'metrics/loss'))
+    unpickled.append('train', 'metrics/loss', 1000, 0.25)
+    self.assertEqual(unpickled.value_at('train', 'metrics/loss', 2000), 0.25)
+
+  def test_unpickle_list_format(self):
+    # Histories were pickled with lists of (step, value) pairs before.
+    history = trax_history.History.__new__(trax_history.History)
+    history.__setstate__({'_values': {
+        'train': collections.defaultdict(list, {
+            'metrics/loss': [(1, 0.5), (2, 0.25)]})}})
+    self.assertEqual(history.get('train', 'metrics/loss'),
+                     [(1, 0.5), (2, 0.25)])
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -36,6 +36,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import tensorflow as tf
 
+from trax import event_files
+
 # pylint: disable=g-direct-tensorflow-import
 from tensorflow.core.util import event_pb2
 from tensorflow.python.summary.writer.event_file_writer import EventFileWriter
@@ -68,21 +70,39 @@ def _pack_images(images, rows, cols):
 
 
 class SummaryWriter(object):
-  """Saves data in event and summary protos for tensorboard."""
+  """Saves data in event and summary protos for tensorboard.
+
+  In buffered mode, summaries are buffered in memory and written by a
+  background thread, see `event_files.EventFileWriter`; scalars and histograms
+  are then encoded without building TensorFlow protos at all.
+  """
 
-  def __init__(self, log_dir, enable=True):
+  def __init__(self, log_dir, enable=True, buffered=False, max_queue=1000,
+               flush_secs=120):
     """Create a new SummaryWriter.
 
     Args:
       log_dir: path to record tfevents files in.
       enable: bool: if False don't actually write or flush data.  Used in
         multihost training.
+      buffered: bool: if True, buffer summaries and write them in the
+        background.
+      max_queue: int: in buffered mode, number of buffered summaries that
+        starts a write.
+      flush_secs: float: in buffered mode, the most seconds summaries stay in
+        the buffer.
     """
     # If needed, create log_dir directory as well as missing parent directories.
     if not tf.io.gfile.isdir(log_dir):
       tf.io.gfile.makedirs(log_dir)
 
-    self._event_writer = EventFileWriter(log_dir, 10, 120, None)
+    self._buffered = buffered
+    if buffered:
+      self._event_writer = event_files.EventFileWriter(
+          log_dir, max_queue=max_queue, flush_secs=flush_secs,
+          open_fn=tf.io.gfile.GFile)
+    else:
+      self._event_writer = EventFileWriter(log_dir, 10, 120, None)
     self._step = 0
     self._closed = False
     self._enabled = enable
@@ -90,6 +110,9 @@ class SummaryWriter(object):
   def add_summary(self, summary, step):
     if not self._enabled:
       return
+    if self._buffered:
+      self._event_writer.add_summary(summary.SerializeToString(), step)
+      return
     event = event_pb2.Event(summary=summary)
     event.wall_time = time.time()
     if step is not None:
@@ -129,6 +152,10 @@ class SummaryWriter(object):
       step = self._step
     else:
       self._step = step
+    if self._buffered:
+      if self._enabled:
+        self._event_writer.add_scalar(tag, value, step)
+      return
     summary = tf.compat.v1.Summary(
         value=[tf.compat.v1.Summary.Value(tag=tag, simple_value=value)])
     self.add_summary(summary, step)
@@ -287,6 +314,17 @@ class SummaryWriter(object):
                1:end] if start > 0 else np.concatenate([[0], counts[:end]]))
     limits = limits[start:end + 1]
     sum_sq = values.dot(values)
+    if self._buffered:
+      if self._enabled:
+        self._event_writer.add_summary(event_files.histogram_summary(tag, dict(
+            min=values.min(),
+            max=values.max(),
+            num=len(values),
+            sum=values.sum(),
+            sum_squares=sum_sq,
+            bucket_limit=limits.tolist(),
+            bucket=counts.tolist())), step)
+      return
     histo = tf.compat.v1.HistogramProto(
         min=values.min(),
         max=values.max(),
@@ -74,3 +74,5 @@ TimeBinPositionalEncoding = layer_configure(
     TimeBinPositionalEncoding, blacklist=['mode'])
 
 AtariConvInit = layer_configure(AtariConvInit)
+
+RematBudget = layer_configure(RematBudget)
@@ -173,8 +173,12 @@ def DotProductAttention(queries, keys, values, mask, dropout, mode, rng):
     Per-head activations resulting from masked per-head attention-weighted
     sum of per-head values.
   """
+  queries, keys, values = (
+      core.cast_to_compute_dtype(x) for x in (queries, keys, values))
   d_feature = queries.shape[-1]
   dots = jnp.matmul(queries, jnp.swapaxes(keys, -1, -2)) / jnp.sqrt(d_feature)
+  if math.compute_dtype() is not None:
+    dots = dots.astype(np.float32)  # Softmax in full precision.
   if mask is not None:
     # TODO(kitaev): workaround for https://github.com/google/jax/issues/850
     # We must ensure that both mask and the -1e9 constant have a data dependency
@@ -191,11 +195,12 @@ def DotProductAttention(queries, keys, values, mask, dropout, mode, rng):
   if dropout is not None and dropout > 0.0 and mode == 'train':
     keep = math.random.bernoulli(rng, 1.0 - dropout, dots.shape)
     dots = jnp.where(keep, dots / (1.0 - dropout), jnp.zeros_like(dots))
-  out = jnp.matmul(dots, values)
+  out = jnp.matmul(dots.astype(values.dtype), values)
   return out
 
 
-def CausalAttention(d_feature, n_heads=1, dropout=0.0, mode='train'):
+def CausalAttention(d_feature, n_heads=1, dropout=0.0, mode='train',
+                    packed=False):
   """Returns a layer that maps activations to activations, with causal masking.
 
   Like `Attention`, this layer type represents one pass of multi-head
@@ -207,6 +212,10 @@ def CausalAttention(d_feature, n_heads=1, dropout=0.0, mode='train'):
     dropout: Probababilistic rate for internal dropout applied to attention
         activations (based on query-key pairs) before dotting them with values.
     mode: Either 'train' or 'eval'.
+    packed: If True, the layer maps (activations, segment_ids) to
+        (activations, segment_ids) for sequences packed from several segments
+        (see `inputs.pack_data`), and each position attends only to earlier
+        positions from the same segment.
   """
   if d_feature % n_heads != 0:
     raise ValueError(
@@ -246,23 +255,35 @@ def CausalAttention(d_feature, n_heads=1, dropout=0.0, mode='train'):
           [core.Dense(d_feature), _split_into_heads()],
           [core.Dense(d_feature), _split_into_heads()],
       ),
-      DotProductCausalAttention(dropout=dropout, mode=mode),
+      DotProductCausalAttention(dropout=dropout, mode=mode, packed=packed),
       _merge_heads(),
       core.Dense(d_feature),
   )
 
 
 class DotProductCausalAttention(base.Layer):
-  """Computes new activations via causally masked attention-weighted values."""
+  """Computes new activations via causally masked attention-weighted values.
 
-  def __init__(self, dropout=0.0, mode='train'):
-    super(DotProductCausalAttention, self).__init__(n_in=3, n_out=1)
+  If `packed` is True, the layer also takes segment ids of packed sequences as
+  fourth input, passes them through as second output, and masks out attention
+  between positions from different segments.
+  """
+
+  def __init__(self, dropout=0.0, mode='train', packed=False):
+    if packed and mode == 'predict':
+      raise ValueError('Packed sequences are not supported in predict mode.')
+    n_in, n_out = (4, 2) if packed else (3, 1)
+    super(DotProductCausalAttention, self).__init__(n_in=n_in, n_out=n_out)
     self._dropout = dropout
     self._mode = mode
+    self._packed = packed
 
   def forward_with_state(self, inputs, weights, state, rng):
     del weights
-    q, k, v = inputs
+    if self._packed:
+      q, k, v, segment_ids = inputs
+    else:
+      q, k, v = inputs
 
     if self._mode == 'predict':
       state = _fast_inference_update_state(inputs, state)
@@ -278,9 +299,20 @@ class DotProductCausalAttention(base.Layer):
       else:
         mask = np.tril(
             np.ones((1, mask_size, mask_size), dtype=np.bool_), k=0)
+      if self._packed:
+        # Heads are folded into the batch dimension of q, k and v here.
+        batch_size = segment_ids.shape[0]
+        n_heads = q.shape[0] // batch_size
+        same_segment = _same_segment_mask(segment_ids)
+        same_segment = jnp.broadcast_to(
+            same_segment, (batch_size, n_heads, mask_size, mask_size))
+        mask = jnp.logical_and(
+            mask, same_segment.reshape((-1, mask_size, mask_size)))
 
     res = DotProductAttention(
         q, k, v, mask, dropout=self._dropout, mode=self._mode, rng=rng)
+    if self._packed:
+      return (res, segment_ids), state
     return res, state
 
   def new_weights_and_state(self, input_signature):
@@ -321,6 +353,29 @@ def PaddingMask(pad=0):
   return Fn(f'PaddingMask({pad})', f)
 
 
+def _same_segment_mask(segment_ids):
+  """Returns [batch, 1, len, len] mask of position pairs in the same segment."""
+  batch_size, seq_len = segment_ids.shape
+  return jnp.equal(segment_ids.reshape((batch_size, 1, seq_len, 1)),
+                   segment_ids.reshape((batch_size, 1, 1, seq_len)))
+
+
+def SegmentMask():
+  """Layer to make an attention mask from segment ids of packed sequences.
+
+  Each position may only attend to positions with the same segment id, so
+  segments packed into one sequence (see `inputs.pack_data`) stay separate.
+  Segment id 0 marks padding, which is masked out like in `PaddingMask`.
+  The mask has shape [batch, 1 for heads, query-len, key-len] and can be used
+  in place of a padding mask with `Attention`.
+  """
+  def f(x):
+    batch_size, seq_len = x.shape
+    content_positions = (x != 0).reshape((batch_size, 1, 1, seq_len))
+    return jnp.logical_and(_same_segment_mask(x), content_positions)
+  return Fn('SegmentMask', f)
+
+
 def EncoderDecoderMask():
   """Makes encoder-decoder mask from decoder input and a padding mask."""
   def f(decoder_input, mask):
@@ -333,14 +388,22 @@ def EncoderDecoderMask():
 
 
 class PositionalEncoding(base.Layer):
-  """Implements bare positional encoding."""
+  """Implements bare positional encoding.
+
+  With `packed=True`, the layer maps (activations, positions) to activations
+  and adds the encoding of each element's position in its segment, as given by
+  the positions of sequences packed with `inputs.pack_data`.
+  """
 
   def __init__(self, max_len=2048, dropout=0.0, dropout_broadcast_dims=(-2,),
-               mode='train'):
-    super(PositionalEncoding, self).__init__()
+               mode='train', packed=False):
+    super(PositionalEncoding, self).__init__(n_in=2 if packed else 1)
     self._max_len = max_len
     if dropout >= 1.0:
       raise ValueError('Dropout rates must be lower than 1.')
+    if packed and mode == 'predict':
+      raise ValueError('Packed sequences are not supported in predict mode.')
+    self._packed = packed
     if mode == 'train':
       self._dropout = dropout
     else:
@@ -350,9 +413,13 @@ class PositionalEncoding(base.Layer):
 
   def forward_with_state(self, inputs, weights, state, rng):
     if self._mode != 'predict':
-      x = inputs
-      symbol_size = jnp.shape(x)[1]
-      px = weights[:, :symbol_size, :]
+      if self._packed:
+        x, positions = inputs
+        px = jnp.take(weights[0], positions, axis=0)
+      else:
+        x = inputs
+        symbol_size = jnp.shape(x)[1]
+        px = weights[:, :symbol_size, :]
       if self._dropout == 0:
         return (x + px, state)
       else:
@@ -385,6 +452,8 @@ class PositionalEncoding(base.Layer):
         return inputs + jnp.stack(emb, 0), state + inputs.shape[1]
 
   def new_weights_and_state(self, input_signature):
+    if self._packed:
+      input_signature = input_signature[0]
     d_feature = input_signature.shape[-1]
     pe = np.zeros((self._max_len, d_feature), dtype=np.float32)
     position = np.arange(0, self._max_len)[:, np.newaxis]
@@ -19,6 +19,7 @@
 from absl.testing import absltest
 import numpy as np
 
+from trax import shapes
 import trax.layers as tl
 
 
@@ -70,6 +71,41 @@ class AttentionTest(absltest.TestCase):
                                       [48.0, 47.5, 47.0],
                                       [46.5, 46.0, 45.5]]])
 
+  def test_segment_mask(self):
+    layer = tl.SegmentMask()
+    x = np.array([[1, 1, 2, 0]])
+    y = layer(x)
+    self.assertEqual(y.shape, (1, 1, 4, 4))
+    self.assertEqual(tl.to_list(y[0, 0]), [[True, True, False, False],
+                                           [True, True, False, False],
+                                           [False, False, True, False],
+                                           [False, False, False, False]])
+
+  def test_packed_causal_attention(self):
+    layer = tl.CausalAttention(4, n_heads=2, packed=True)
+    x = np.random.uniform(size=(2, 6, 4)).astype(np.float32)
+    segment_ids = np.array([[1, 1, 1, 2, 2, 2],
+                            [1, 1, 1, 1, 1, 1]])
+    _, _ = layer.init(shapes.signature((x, segment_ids)))
+    y, out_segment_ids = layer((x, segment_ids))
+    self.assertEqual(y.shape, (2, 6, 4))
+    self.assertEqual(tl.to_list(out_segment_ids), tl.to_list(segment_ids))
+    # The second segment is attended to as if it were a separate sequence.
+    x_second = x[:, 3:, :]
+    y_second = layer((x_second, segment_ids[:, 3:]))[0]
+    np.testing.assert_allclose(y[0, 3:], y_second[0], rtol=1e-5, atol=1e-5)
+
+  def test_packed_positional_encoding(self):
+    layer = tl.PositionalEncoding(max_len=8, packed=True)
+    x = np.zeros((1, 5, 4), dtype=np.float32)
+    positions = np.array([[0, 1, 2, 0, 1]])
+    _, _ = layer.init(shapes.signature((x, positions)))
+    y = layer((x, positions))
+    self.assertEqual(y.shape, (1, 5, 4))
+    # Each segment gets the encodings of its own positions.
+    np.testing.assert_allclose(y[0, 3:], y[0, :2])
+    np.testing.assert_allclose(y[0, :3], layer.weights[0, :3])
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -25,6 +25,7 @@ import jax
 import numpy as np
 import tensorflow as tf
 
+from trax import checkpoints
 from trax import math
 from trax.math import nested_map
 from trax.math import numpy as jnp
@@ -331,14 +332,20 @@ class Layer(object):
     We assume that the file is a pickled dictionary that contains the fields
     'weights' and 'state' with structures corresponding to this layers weights
     and state. Note that the pickled dictionary is allowed to contain other
-    fields too, but these two are required to init.
+    fields too, but these two are required to init. The file can also be a
+    sharded checkpoint (see `trax.checkpoints`), from which only the needed
+    fields are read.
 
     Args:
       file_name: the name of the file to initialize from.
       weights_only: if True, initialize only the weights, not state.
     """
-    with tf.io.gfile.GFile(file_name, 'rb') as f:
-      dictionary = pickle.load(f)
+    if checkpoints.is_sharded(file_name):
+      fields = ['weights'] if weights_only else ['weights', 'state']
+      dictionary = checkpoints.load(file_name, fields)
+    else:
+      with tf.io.gfile.GFile(file_name, 'rb') as f:
+        dictionary = pickle.load(f)
     self.weights = dictionary['weights']
     if not weights_only:
       self.state = dictionary['state']
@@ -40,14 +40,31 @@ class Serial(base.Layer):
 
   A Serial instance with no sublayers acts as a special-case (but useful)
   1-input 1-output no-op.
+
+  To save memory in training, some sublayers can be rematerialized: only their
+  inputs are kept for the backward pass, and their activations are recomputed
+  from them. Which ones is given by the `remat` policy, which can be:
+
+    - None or False: no sublayer (the default); True: every sublayer;
+
+    - an int n: every n-th sublayer, starting with the first one;
+
+    - a layer name or class, or a tuple of them: every sublayer that is or
+      contains a layer of one of these names or classes;
+
+    - a `RematBudget`: the sublayers with the largest activations, until the
+      estimated activations of the others fit in the budget.
   """
 
-  def __init__(self, *sublayers, name=None):
+  def __init__(self, *sublayers, name=None, remat=None):
     super(Serial, self).__init__(name=name)
 
     sublayers = _ensure_flat(sublayers)
     self._sublayers = sublayers
     self._n_layers = len(sublayers)
+    self._remat = remat
+    # A RematBudget is only applied in init, when activation sizes are known.
+    self._remat_mask = _remat_mask(remat, sublayers)
 
     if sublayers:
       self._n_in, self._n_out = self._n_inputs_n_outputs(sublayers)
@@ -72,9 +89,14 @@ class Serial(base.Layer):
           f'Number of state elements ({len(state)}) does not equal '
           f'number of sublayers ({n_layers}).')
 
-    for layer, w, s, rng in zip(self.sublayers, weights, state, rngs):
+    for layer, w, s, rng, remat in zip(self.sublayers, weights, state, rngs,
+                                       self._remat_mask):
       inputs = _inputs_from_stack(layer, stack)
-      outputs, s = layer.pure_fn(inputs, w, s, rng)
+      if remat and not _has_remat_policy(layer):
+        pure_fn = math.remat(layer.pure_fn)
+      else:
+        pure_fn = layer.pure_fn
+      outputs, s = pure_fn(inputs, w, s, rng)
       stack = _outputs_onto_stack(layer, outputs, stack)
       new_state.append(s)
     return stack, new_state
@@ -85,15 +107,26 @@ class Serial(base.Layer):
     states = []
     # In the code below, stack, inputs, and outputs are abstract (shapes and
     # dtypes), but weights and states are non-abstract actual values.
+    activation_bytes = []
     stack = input_signature
     for sublayer in self.sublayers:
       inputs = _inputs_from_stack(sublayer, stack)
       weights_or_empty, state = sublayer.init(inputs)
       outputs, _ = sublayer._forward_abstract(inputs)
+      if isinstance(self._remat, RematBudget):
+        if _has_remat_policy(sublayer):  # It saves memory on its own.
+          activation_bytes.append(0)
+        else:
+          rng_signature = ShapeDtype((2,), np.uint32)
+          activation_bytes.append(math.activation_bytes(
+              sublayer.forward_with_state, inputs, sublayer.weights, state,
+              rng_signature))
       stack = _outputs_onto_stack(sublayer, outputs, stack)
 
       weights.append(weights_or_empty)
       states.append(state)
+    if isinstance(self._remat, RematBudget):
+      self._remat_mask = self._remat.mask(activation_bytes)
     return weights, states
   # pylint: enable=protected-access
 
@@ -474,6 +507,70 @@ def Branch(*layers, name='Branch'):
   return Serial(Select(_deep_flatten(indices)), parallel_layer, name=name)
 
 
+class RematBudget(object):
+  """Remat policy for `Serial` that keeps activations within a memory budget.
+
+  The activations of each sublayer are estimated at initialization by tracing
+  it on the input shapes. Sublayers with the largest activations are then
+  rematerialized until the activations of the remaining ones add up to at most
+  `n_bytes`.
+  """
+
+  def __init__(self, n_bytes):
+    self._n_bytes = n_bytes
+
+  def mask(self, activation_bytes):
+    """Returns for each sublayer (by activation bytes) whether to remat it."""
+    mask = [False] * len(activation_bytes)
+    total = sum(activation_bytes)
+    by_size = sorted(range(len(activation_bytes)),
+                     key=lambda i: activation_bytes[i], reverse=True)
+    for i in by_size:
+      if total <= self._n_bytes:
+        break
+      mask[i] = True
+      total -= activation_bytes[i]
+    return mask
+
+
+def _remat_mask(remat, sublayers):
+  """Returns for each sublayer whether the remat policy rematerializes it."""
+  n_layers = len(sublayers)
+  if isinstance(remat, RematBudget):
+    return [False] * n_layers  # Set in Serial.new_weights_and_state.
+  if remat is None or isinstance(remat, bool):
+    return [bool(remat)] * n_layers
+  if isinstance(remat, int):
+    if remat < 1:
+      raise ValueError(f'Remat policy must be a positive int, got {remat}.')
+    return [i % remat == 0 for i in range(n_layers)]
+  kinds = remat if isinstance(remat, (list, tuple)) else (remat,)
+  return [_contains_layer_of_kind(layer, kinds) for layer in sublayers]
+
+
+def _has_remat_policy(layer):
+  """Checks if layer is a Serial that rematerializes its own sublayers.
+
+  Such a layer is never rematerialized as a whole by an enclosing Serial, so
+  that its activations are not recomputed twice.
+  """
+  # pylint: disable=protected-access
+  return isinstance(layer, Serial) and layer._remat not in (None, False)
+  # pylint: enable=protected-access
+
+
+def _contains_layer_of_kind(layer, kinds):
+  """Checks if layer or any layer nested in it has one of the names/classes."""
+  for kind in kinds:
+    if isinstance(kind, str):
+      if layer._name == kind:  # pylint: disable=protected-access
+        return True
+    elif isinstance(layer, kind):
+      return True
+  return any(_contains_layer_of_kind(sublayer, kinds)
+             for sublayer in layer.sublayers)
+
+
 def Residual(*layers, shortcut=None):
   """Wraps a series of layers with a residual connection.
 
@@ -89,6 +89,34 @@ class SerialTest(absltest.TestCase):
                                    [1, 2, 3],
                                    [1, 2, 3]])
 
+  # pylint: disable=protected-access
+  def test_remat_every_nth_sublayer(self):
+    layer = tl.Serial(DivideBy(2.0), DivideBy(5.0), DivideBy(1.0), remat=2)
+    self.assertEqual(layer._remat_mask, [True, False, True])
+    x = np.array([10.0, 20.0, 30.0])
+    y = layer(x)
+    self.assertEqual(as_list(y), [1, 2, 3])
+
+  def test_remat_by_layer_name_or_class(self):
+    sublayers = [tl.Dense(2), tl.Residual(tl.Dense(2)), tl.Relu()]
+    by_name = tl.Serial(sublayers, remat='Dense')
+    by_class = tl.Serial(sublayers, remat=(tl.Dense,))
+    self.assertEqual(by_name._remat_mask, [True, True, False])
+    self.assertEqual(by_class._remat_mask, [True, True, False])
+
+  def test_remat_budget(self):
+    x = np.ones((3, 4), dtype=np.float32)
+    small = tl.Serial(tl.Dense(8), tl.Relu(), tl.Dense(2),
+                      remat=tl.RematBudget(0))
+    _, _ = small.init(shapes.signature(x))
+    self.assertEqual(small._remat_mask, [True, True, True])
+    large = tl.Serial(tl.Dense(8), tl.Relu(), tl.Dense(2),
+                      remat=tl.RematBudget(10**9))
+    _, _ = large.init(shapes.signature(x))
+    self.assertEqual(large._remat_mask, [False, False, False])
+    self.assertEqual(small(x).shape, (3, 2))
+  # pylint: enable=protected-access
+
   def test_default_name(self):
     layer = tl.Serial(tl.Dup(), tl.Dup())
     self.assertIn('Serial', str(layer))
@@ -61,6 +61,7 @@ class Dense(base.Layer):
       raise ValueError(f'Weights has length {len(weights)}; should instead '
                        f'have two elements: w, b.')
     w, b = weights
+    x, w, b = (cast_to_compute_dtype(a) for a in (x, w, b))
     return jnp.dot(x, w) + b
 
   def new_weights(self, input_signature):
@@ -111,7 +112,7 @@ class Embedding(base.Layer):
     self._kernel_initializer = kernel_initializer
 
   def forward(self, x, weights):
-    return jnp.take(weights, x, axis=0)
+    return cast_to_compute_dtype(jnp.take(weights, x, axis=0))
 
   def new_weights(self, input_signature):
     del input_signature
@@ -170,14 +171,18 @@ def Exp():
 
 def LogSoftmax(axis=-1):
   """Layer that applies log softmax: log-normalize along the given axis."""
-  return Fn('LogSoftmax',
-            lambda x: x - math.logsumexp(x, axis, keepdims=True))
+  def f(x):
+    x = _to_float32_if_mixed_precision(x)
+    return x - math.logsumexp(x, axis, keepdims=True)
+  return Fn('LogSoftmax', f)
 
 
 def Softmax(axis=-1):
   """Layer that applies softmax: exponentiate and normalize along given axis."""
-  return Fn('Softmax',
-            lambda x: jnp.exp(x - math.logsumexp(x, axis, keepdims=True)))
+  def f(x):
+    x = _to_float32_if_mixed_precision(x)
+    return jnp.exp(x - math.logsumexp(x, axis, keepdims=True))
+  return Fn('Softmax', f)
 
 
 def ToFloat():
@@ -196,6 +201,21 @@ def Negate():
   return Fn('Negate', lambda x: -x)
 
 
+def cast_to_compute_dtype(x):
+  """Casts floating-point x to `math.compute_dtype()`, if that is set."""
+  dtype = math.compute_dtype()
+  if dtype is None or not jnp.issubdtype(x.dtype, jnp.floating):
+    return x
+  return x.astype(dtype)
+
+
+def _to_float32_if_mixed_precision(x):
+  """Returns x as float32 if layers compute in a lower precision."""
+  if math.compute_dtype() is None:
+    return x
+  return x.astype(np.float32)
+
+
 def log_gaussian_pdf(x, mu, sigma):  # pylint: disable=invalid-name
   """Compute log N(x | mu, sigma)."""
   a = mu.shape[-1] * jnp.log(2 * jnp.pi)
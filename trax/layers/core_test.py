@@ -17,6 +17,7 @@
 """Tests for core layers."""
 
 from absl.testing import absltest
+import gin
 import numpy as np
 
 from trax import shapes
@@ -58,6 +59,18 @@ class DenseTest(absltest.TestCase):
     self.assertEqual(w.tolist(), w_cached.tolist())
     self.assertEqual(b.tolist(), b_cached.tolist())
 
+  def test_compute_dtype(self):
+    layer = tl.Dense(4)
+    x = np.ones((2, 3), dtype=np.float32)
+    _, _ = layer.init(shapes.signature(x))
+    gin.bind_parameter('compute_dtype.name', 'bfloat16')
+    try:
+      y = layer(x)
+    finally:
+      gin.clear_config()
+    self.assertEqual(str(y.dtype), 'bfloat16')
+    self.assertEqual(layer.weights[0].dtype, np.float32)
+
   def test_separate_instances_have_separate_weights(self):
     # Two dense layer instances: each will get its own initial weights (w, b).
     model = tl.Serial(tl.Dense(5), tl.Dense(5))
@@ -86,6 +86,22 @@ def SumOfWeights():
       cb.Drop(),  # Drop targets.
       core.Sum(axis=None)  # Sum weights.
   )
+
+
+def NonPaddingFraction():
+  """Returns a layer to compute the fraction of elements with nonzero weight.
+
+  Padding has zero weight, so for sequences packed from several examples (see
+  `inputs.pack_data`) this is the achieved packing efficiency. It is not one
+  of the default training metrics; pass it in `metrics` to `trainer_lib.train`.
+  """
+  def f(weights):  # pylint: disable=invalid-name
+    return np.mean((weights != 0).astype(np.float32))
+  return cb.Serial(
+      cb.Drop(),  # Drop inputs.
+      cb.Drop(),  # Drop targets.
+      Fn('NonPaddingFraction', f)
+  )
 # pylint: enable=no-value-for-parameter
 
 
@@ -66,6 +66,14 @@ class MetricsTest(absltest.TestCase):
     mean = layer((x, weights))
     np.testing.assert_allclose(mean, 1.)
 
+  def test_non_padding_fraction(self):
+    layer = metrics.NonPaddingFraction()
+    xs = [np.ones((2, 4, 20)),
+          np.ones((2, 4)),
+          np.array([[1., 1., 0., 0.], [1., 1., 1., 0.]])]
+    y = layer(xs)
+    np.testing.assert_allclose(y, 5. / 8.)
+
   def test_weighted_sequence_mean_semantics(self):
     layer = metrics._WeightedSequenceMean()
     sample_input = np.ones((2, 3))
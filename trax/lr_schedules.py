@@ -133,16 +133,15 @@ def EvalAdjustingSchedule(history,
     a function learning_rate(step): float -> {'learning_rate': float}, the
     step-dependent lr.
   """
-  metrics = history.get(history_mode, metric)
+  _, values = history.steps_and_values(history_mode, metric)
   adjusted = constant
-  if len(metrics) < 2:
+  if len(values) < 2:
     return MultifactorSchedule(history, constant=adjusted)
 
   steps_without_improvement = 0
-  cur = metrics.pop()[1]  # The most-recent value of the metric.
-  while len(metrics) > 1:
-    # The one-before value of metrics as .pop() removes one element each time.
-    prev = metrics.pop()[1]
+  cur = values[-1]  # The most-recent value of the metric.
+  # Go back through the earlier values, down to (but without) the first one.
+  for prev in values[-2:0:-1]:
     if cur < prev * (1 + improvement_margin):
       steps_without_improvement += 1
     else:
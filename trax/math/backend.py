@@ -79,6 +79,18 @@ def stop_gradient(*args, **kwargs):
   return backend()['stop_gradient'](*args, **kwargs)
 
 
+def remat(*args, **kwargs):
+  return backend()['remat'](*args, **kwargs)
+
+
+def activation_bytes(*args, **kwargs):
+  if 'activation_bytes' not in backend():
+    raise NotImplementedError(
+        f'Backend {backend_name()} cannot trace activation sizes; use the jax '
+        'backend for remat budgets (tl.RematBudget).')
+  return backend()['activation_bytes'](*args, **kwargs)
+
+
 _disable_jit = False
 
 
@@ -172,6 +184,20 @@ def backend(name='jax'):
   return JAX_BACKEND
 
 
+@gin.configurable()
+def compute_dtype(name=None):
+  """Returns the dtype layers compute in, or None to use that of the weights.
+
+  Setting it, e.g., to 'bfloat16' makes layers like `Dense` and attention cast
+  their inputs and weights to it, while the weights themselves (the master
+  copy updated by optimizers) keep their dtype.
+
+  Args:
+    name: name of a floating-point dtype of the backend's numpy, or None.
+  """
+  return None if name is None else getattr(numpy, name)
+
+
 @contextlib.contextmanager
 def use_backend(name):
   global override_backend_name
@@ -72,5 +72,12 @@ class BackendTest(test.TestCase):
     self.assertEqual(onp.isinf, numpy.isinf)
     self.assertEqual(onp.inf, numpy.inf)
 
+  def test_remat_and_activation_bytes_on_numpy_backend(self):
+    with math.use_backend('numpy'):
+      f = lambda x: 2 * x
+      self.assertEqual(math.remat(f)(3), 6)
+      with self.assertRaisesRegex(NotImplementedError, 'jax backend'):
+        math.activation_bytes(f, onp.zeros(3))
+
 if __name__ == '__main__':
   test.main()
@@ -28,6 +28,7 @@ import numpy as np
 import tensorflow as tf
 import tensorflow_datasets as tfds
 
+from trax.shapes import ShapeDtype
 from trax.shapes import signature
 
 
@@ -217,6 +218,32 @@ def jax_abstract_eval(f):
   return shape_fun
 
 
+def jax_activation_bytes(f, *args):
+  """Returns the number of bytes in all intermediate values of f on args.
+
+  This is an estimate of the memory that differentiating f keeps for the
+  backward pass. Only shapes and dtypes are traced, so nothing is computed.
+
+  Args:
+    f: the function to trace.
+    *args: arguments to f; `ShapeDtype` leaves stand for arrays of that shape
+      and dtype.
+
+  Returns:
+    The total size in bytes of the values computed by the operations in f.
+  """
+  def to_array(x):
+    return jnp.zeros(x.shape, x.dtype) if isinstance(x, ShapeDtype) else x
+  jaxpr = jax.make_jaxpr(f)(*nested_map(to_array, args))
+  n_bytes = 0
+  for eqn in jaxpr.jaxpr.eqns:
+    for var in eqn.outvars:
+      aval = getattr(var, 'aval', None)
+      if hasattr(aval, 'shape') and hasattr(aval, 'dtype'):
+        n_bytes += int(np.prod(aval.shape)) * np.dtype(aval.dtype).itemsize
+  return n_bytes
+
+
 # The default value of dtype is different from jax_random.randint
 def jax_randint(key, shape, minval, maxval, dtype=np.int32):
   """Sample uniform random values in [minval, maxval) with given shape/dtype.
@@ -274,6 +301,8 @@ JAX_BACKEND = {
     'cond': lax.cond,
     'lt': lax.lt,
     'stop_gradient': lax.stop_gradient,
+    'remat': jax.remat,
+    'activation_bytes': jax_activation_bytes,
     'jit': jax.jit,
     'grad': jax.grad,
     'pmap': jax.pmap,
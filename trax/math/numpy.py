@@ -26,6 +26,7 @@ NUMPY_BACKEND = {
     'name': 'numpy',
     'np': np,
     'jit': lambda f: f,
+    'remat': lambda f: f,
     'random_get_prng': lambda seed: None,
     'random_split': lambda prng, num=2: (None,) * num,
     'expit': lambda x: 1. / (1. + np.exp(-x)),
@@ -70,8 +70,13 @@ def BERT(d_model=768,
          head=None,
          init_checkpoint=None,
          mode='eval',
+         remat=None,
         ):
-  """BERT (default hparams are for bert-base-uncased)."""
+  """BERT (default hparams are for bert-base-uncased).
+
+  In 'train' mode, `remat` gives the layers to rematerialize to save memory,
+  see `tl.Serial`; e.g., 'SelfAttention' for all attention blocks.
+  """
   layer_norm_eps = 1e-12
   d_head = d_model // n_heads
 
@@ -117,8 +122,10 @@ def BERT(d_model=768,
   ]
 
   init_checkpoint = init_checkpoint if mode == 'train' else None
+  remat = remat if mode == 'train' else None
   bert = PretrainedBERT(
-      embeddings + encoder + pooler, init_checkpoint=init_checkpoint)
+      embeddings + encoder + pooler, init_checkpoint=init_checkpoint,
+      remat=remat)
 
   if head is not None:
     bert = tl.Serial(bert, head())
@@ -129,8 +136,8 @@ def BERT(d_model=768,
 class PretrainedBERT(tl.Serial):
   """Wrapper that always initializes weights from a pre-trained checkpoint."""
 
-  def __init__(self, *sublayers, init_checkpoint=None):
-    super().__init__(*sublayers)
+  def __init__(self, *sublayers, init_checkpoint=None, remat=None):
+    super().__init__(*sublayers, remat=remat)
 
     # TODO(kitaev): Support shorthand model names in the trax OSS release
     if init_checkpoint == 'bert-base-uncased':
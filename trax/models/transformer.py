@@ -133,12 +133,20 @@ def TransformerLM(vocab_size,
                   dropout=0.1,
                   max_len=2048,
                   mode='train',
-                  ff_activation=tl.Relu):
+                  ff_activation=tl.Relu,
+                  remat=None,
+                  packed=False):
   """Returns a Transformer language model.
 
   The input to the model is a tensor of tokens. (This model uses only the
   decoder part of the overall Transformer.)
 
+  With `packed=True`, the model takes the (tokens, segment_ids, positions)
+  of sequences packed from several examples by `inputs.pack_data`, so it can
+  train directly on their (inputs, segment_ids, positions, targets, weights)
+  batches. Each segment is then shifted, position-encoded and attended to
+  separately, as if it were its own sequence.
+
   Args:
     vocab_size: int: vocab size
     d_model: int:  depth of embedding
@@ -149,22 +157,42 @@ def TransformerLM(vocab_size,
     max_len: int: maximum symbol length for positional encoding
     mode: str: 'train', 'eval' or 'predict', predict mode is for fast inference
     ff_activation: the non-linearity in feed-forward layer
+    remat: which layers to rematerialize in training to save memory, see
+      `tl.Serial`; e.g., 'DotProductCausalAttention' for attention blocks
+    packed: bool: whether the model takes packed sequences, see above
 
   Returns:
     A Transformer language model as a layer that maps from a tensor of tokens
     to activations over a vocab set.
   """
-  positional_encoder = [
-      tl.Embedding(d_model, vocab_size),
-      tl.Dropout(rate=dropout, name='embedding', mode=mode),
-      tl.PositionalEncoding(max_len=max_len, mode=mode)]
-
   decoder_blocks = [
       # pylint: disable=g-complex-comprehension
       _DecoderBlock(d_model, d_ff, n_heads,
-                    dropout, i, mode, ff_activation)
+                    dropout, i, mode, ff_activation, packed=packed)
       for i in range(n_layers)]
 
+  if packed:
+    return tl.Serial(                    # toks, segs, pos
+        tl.Select([0, 2, 1, 2]),         # toks, pos, segs, pos
+        tl.ShiftRight(mode=mode),        # toks, pos, segs, pos
+        _StartSegments(),                # toks, segs, pos
+        tl.Embedding(d_model, vocab_size),
+        tl.Dropout(rate=dropout, name='embedding', mode=mode),
+        tl.Select([0, 2, 1]),            # vecs, pos, segs
+        tl.PositionalEncoding(max_len=max_len, mode=mode, packed=True),
+        decoder_blocks,                  # vecs, segs
+        tl.Select([0], n_in=2),          # vecs
+        tl.LayerNorm(),                  # vecs
+        tl.Dense(vocab_size),            # vecs
+        tl.LogSoftmax(),                 # vecs
+        remat=remat if mode == 'train' else None,
+    )
+
+  positional_encoder = [
+      tl.Embedding(d_model, vocab_size),
+      tl.Dropout(rate=dropout, name='embedding', mode=mode),
+      tl.PositionalEncoding(max_len=max_len, mode=mode)]
+
   # Assemble and return the model.
   return tl.Serial(              # tokens (or chunked tuple of tokens)
       tl.ShiftRight(mode=mode),  # toks
@@ -173,6 +201,7 @@ def TransformerLM(vocab_size,
       tl.LayerNorm(),            # vecs
       tl.Dense(vocab_size),      # vecs
       tl.LogSoftmax(),           # vecs
+      remat=remat if mode == 'train' else None,
   )
 
 
@@ -186,7 +215,8 @@ def Transformer(input_vocab_size,
                 dropout=0.1,
                 max_len=2048,
                 mode='train',
-                ff_activation=tl.Relu):
+                ff_activation=tl.Relu,
+                remat=None):
   """Returns a Transformer model.
 
   This model expects an input pair: target, source.
@@ -204,6 +234,8 @@ def Transformer(input_vocab_size,
     max_len: int: maximum symbol length for positional encoding
     mode: str: 'train' or 'eval'
     ff_activation: the non-linearity in feed-forward layer
+    remat: which layers to rematerialize in training to save memory, see
+      `tl.Serial`; applied to the encoder and to the decoder separately
 
   Returns:
     A Transformer model as a layer that maps from a target, source pair to
@@ -227,10 +259,12 @@ def Transformer(input_vocab_size,
           d_model, d_ff, n_heads, dropout, i, mode, ff_activation)
       for i in range(n_encoder_layers)]
 
+  remat = remat if mode == 'train' else None
   encoder = tl.Serial(
       in_encoder,
       encoder_blocks,
-      tl.LayerNorm()
+      tl.LayerNorm(),
+      remat=remat,
   )
   if mode == 'predict':
     encoder = tl.Cache(encoder)
@@ -263,6 +297,7 @@ def Transformer(input_vocab_size,
       tl.Select([0], n_in=3),             # vec_d tok_d
       tl.Dense(output_vocab_size),        # vec_d .....
       tl.LogSoftmax(),                    # vec_d .....
+      remat=remat,
   )
 
 
@@ -308,10 +343,11 @@ def _EncoderBlock(d_model, d_ff, n_heads, dropout, layer_idx, mode,
 
 
 def _DecoderBlock(d_model, d_ff, n_heads,
-                  dropout, layer_idx, mode, ff_activation):
+                  dropout, layer_idx, mode, ff_activation, packed=False):
   """Returns a list of layers that implements a Transformer decoder block.
 
-  The input is an activation tensor.
+  The input is an activation tensor, or a pair (activations, segment_ids) if
+  packed, in which case the segment ids are passed on unchanged.
 
   Args:
     d_model: int:  depth of embedding
@@ -321,12 +357,13 @@ def _DecoderBlock(d_model, d_ff, n_heads,
     layer_idx: which layer are we at (for bookkeeping)
     mode: str: 'train' or 'eval'
     ff_activation: the non-linearity in feed-forward layer
+    packed: bool: whether segment ids of packed sequences follow the input
 
   Returns:
     A list of layers that maps an activation tensor to an activation tensor.
   """
   causal_attention = tl.CausalAttention(
-      d_model, n_heads=n_heads, dropout=dropout, mode=mode),
+      d_model, n_heads=n_heads, dropout=dropout, mode=mode, packed=packed),
 
   dropout_ = tl.Dropout(
       rate=dropout, name='attention_%d' % layer_idx, mode=mode)
@@ -346,6 +383,13 @@ def _DecoderBlock(d_model, d_ff, n_heads,
   ]
 
 
+def _StartSegments():
+  """Zeroes the shifted tokens at segment starts: (toks, pos) --> toks."""
+  def f(tokens, positions):
+    return tokens * (positions != 0).astype(tokens.dtype)
+  return tl.Fn('StartSegments', f)
+
+
 def _EncoderDecoderBlock(d_model, d_ff, n_heads, dropout, layer_idx, mode,
                          ff_activation):
   """Returns a list of layers implementing a Transformer encoder-decoder block.
@@ -23,6 +23,7 @@ from absl.testing import parameterized
 import numpy as np
 from trax import layers as tl
 from trax import math
+from trax import shapes
 from trax.math import numpy as jnp
 from trax.models import transformer
 from trax.shapes import ShapeDtype
@@ -39,6 +40,37 @@ class TransformerTest(parameterized.TestCase):
     final_shape = tl.check_shape_agreement(model, input_signature)
     self.assertEqual((3, 5, vocab_size), final_shape)
 
+  @parameterized.named_parameters(
+      ('all', True),
+      ('every_other', 2),
+      ('attention', 'DotProductCausalAttention'),
+      ('budget', tl.RematBudget(0)))
+  def test_transformer_lm_forward_shape_with_remat(self, remat):
+    vocab_size = 16
+    input_signature = ShapeDtype((3, 5), np.int32)
+    model = transformer.TransformerLM(
+        vocab_size, d_model=32, d_ff=64, n_layers=2, n_heads=2, remat=remat)
+    final_shape = tl.check_shape_agreement(model, input_signature)
+    self.assertEqual((3, 5, vocab_size), final_shape)
+
+  def test_packed_transformer_lm_keeps_segments_apart(self):
+    vocab_size = 16
+    model = transformer.TransformerLM(
+        vocab_size, d_model=32, d_ff=64, n_layers=2, n_heads=2, dropout=0.0,
+        max_len=8, mode='eval', packed=True)
+    tokens = np.array([[3, 4, 5, 6, 7, 0],
+                       [6, 7, 0, 0, 0, 0]])
+    segment_ids = np.array([[1, 1, 1, 2, 2, 0],
+                            [1, 1, 0, 0, 0, 0]])
+    positions = np.array([[0, 1, 2, 0, 1, 0],
+                          [0, 1, 0, 0, 0, 0]])
+    model.init(shapes.signature((tokens, segment_ids, positions)))
+    logits = model((tokens, segment_ids, positions))
+    self.assertEqual(logits.shape, (2, 6, vocab_size))
+    # The second segment of the first row is predicted as if it were alone.
+    np.testing.assert_allclose(logits[0, 3:5], logits[1, :2],
+                               rtol=1e-5, atol=1e-5)
+
   def _test_transformer_forward_shape(self, input_vocab_size,
                                       output_vocab_size):
     """Run the Transformer forward and check output shape."""
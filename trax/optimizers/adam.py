@@ -23,6 +23,8 @@ from trax.optimizers import base as opt_base
 class Adam(opt_base.Optimizer):
   """Adam optimizer."""
 
+  elementwise_update = True
+
   def __init__(self, learning_rate, weight_decay_rate=1e-5,  # pylint: disable=useless-super-delegation
                b1=0.9, b2=0.999, eps=1e-5, clip_grad_norm=None):
     """Create the Adam optimizer.
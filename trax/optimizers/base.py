@@ -36,6 +36,10 @@ class Optimizer(object):
   and slot updates for the whole tree of layers in the model.
   """
 
+  # Whether `update` treats each element of the weights independently, so that
+  # it can be applied to any slice of them, e.g., to a shard on one device.
+  elementwise_update = False
+
   def __init__(self, learning_rate, clip_grad_norm=None, **init_opt_params):
     """Sets initial hyperparameter values for this optimizer.
 
@@ -96,13 +100,15 @@ class Optimizer(object):
   def slots(self, slots):
     self._slots = slots
 
-  def _l2_norm(self, flat_list):
+  def _l2_norm(self, flat_list, axis_name=None):
     """Helper: calculate joint L2 norm of a list of tensors."""
     if math.backend_name() == 'jax':
-      norm = np.sqrt(sum(np.vdot(x, x) for x in flat_list))
+      squared_norm = sum(np.vdot(x, x) for x in flat_list)
     else:  # TODO(lukaszkaiser): add vdot to TF-numpy
-      norm = np.sqrt(sum(np.sum(x*x) for x in flat_list))
-    return norm
+      squared_norm = sum(np.sum(x*x) for x in flat_list)
+    if axis_name is not None:  # The tensors are shards of the full ones.
+      squared_norm = math.psum(squared_norm, axis_name)
+    return np.sqrt(squared_norm)
 
   def tree_init(self, weight_tree):
     """Assembles node-local initializations into full-tree initialization."""
@@ -128,18 +134,39 @@ class Optimizer(object):
             f'the old one ({weights.dtype}).')
     return new_weights, new_slots
 
-  def tree_update(self, step, grad_tree, weight_tree, slots, opt_params):
-    """Assembles node-local weight and slot updates for the full layer tree."""
-    grads_flat = math.tree_flatten(grad_tree)
-    grads_norm = self._l2_norm(grads_flat)
+  def tree_update(self, step, grad_tree, weight_tree, slots, opt_params,
+                  axis_name=None):
+    """Assembles node-local weight and slot updates for the full layer tree.
+
+    Updates are computed in the dtype of the weights, so float32 weights stay
+    the full-precision master copy when layers compute in a lower precision
+    (see `math.compute_dtype`).
+
+    Args:
+      step: Current step number in the training process.
+      grad_tree: Gradients, in the same tree structure as weight_tree.
+      weight_tree: Current weights of the model.
+      slots: Optimizer slots, one for each weight array.
+      opt_params: Optimizer hyperparameters (e.g. learning rate, momentum).
+      axis_name: if the arrays are shards of the full ones on devices mapped
+        over by `math.pmap` with this axis name, norms (for gradient clipping
+        and metrics) are taken over all shards. Requires `elementwise_update`.
+
+    Returns:
+      Tuple of (new_weights, new_slots, metrics).
+    """
+    weights_flat = math.tree_flatten(weight_tree)
+    grads_flat = [grad.astype(weight.dtype) if hasattr(weight, 'dtype') else grad
+                  for (grad, weight) in zip(math.tree_flatten(grad_tree),
+                                            weights_flat)]
+    grads_norm = self._l2_norm(grads_flat, axis_name)
     if self._clip_grad_norm is not None:
       max_norm = self._clip_grad_norm
       grads_flat = [np.where(grads_norm < max_norm,  # pylint: disable=g-complex-comprehension
                              g,
                              g * (max_norm / grads_norm))
                     for g in grads_flat]
-    weights_flat = math.tree_flatten(weight_tree)
-    weights_norm = self._l2_norm(weights_flat)
+    weights_norm = self._l2_norm(weights_flat, axis_name)
     updated_pairs = [
         self._update_and_check(step, grad, weight, slot, opt_params)
         for (grad, weight, slot) in zip(grads_flat, weights_flat, slots)
@@ -156,6 +183,8 @@ class SGD(Optimizer):
   A simple optimizer with no weights ("slots") of its own.
   """
 
+  elementwise_update = True
+
   def init(self, weights):
     return None
 
@@ -42,6 +42,8 @@ class Momentum(base.Optimizer):
   ($$\alpha$$) on the parameters, independent of the Nesterov momentum.
   """
 
+  elementwise_update = True
+
   def __init__(
       self, learning_rate, mass=0.9, weight_decay_rate=1e-5, nesterov=True
   ):  # pylint: disable=useless-super-delegation
@@ -27,6 +27,8 @@ class RMSProp(opt_base.Optimizer):
   decaying average of gradients from prior training batches.
   """
 
+  elementwise_update = True
+
   def __init__(self, learning_rate, gamma=0.9,
                eps=1e-8, clip_grad_norm=None):  # pylint: disable=useless-super-delegation
     super(RMSProp, self).__init__(
@@ -347,6 +347,7 @@ class AwrTrainer(policy_based_trainer.PolicyBasedTrainer):
       if self._should_write_summaries:
         for k, v in timing_dict.items():
           write_metric('timing/{}'.format(k), v)
+      self._write_memory_stats(self.epoch)
 
       # Only dump the average post losses.
       if combined_losses:
@@ -389,8 +390,10 @@ class AwrTrainer(policy_based_trainer.PolicyBasedTrainer):
 
     key = self._get_rng()
 
+    opt_step_fn = (donating_combined_opt_step if self._donate_buffers
+                   else combined_opt_step)
     self._policy_and_value_opt_state, self._model_state = (
-        combined_opt_step(
+        opt_step_fn(
             self._total_opt_step,
             self._policy_and_value_opt_state,
             self._policy_and_value_opt_update,
@@ -612,21 +615,20 @@ def combine_loss_components(critic_loss_val, actor_loss_val, entropy_val,
       entropy_val * entropy_bonus)
 
 
-@functools.partial(jit, static_argnums=(2, 3, 4, 11))
-def combined_opt_step(i,
-                      opt_state,
-                      opt_update,
-                      get_params,
-                      policy_and_value_net_apply,
-                      observations,
-                      actions,
-                      target_values,
-                      advantage_weights,
-                      actor_loss_weight,
-                      entropy_bonus,
-                      action_space,
-                      state=None,
-                      rng=None):
+def _combined_opt_step(i,
+                       opt_state,
+                       opt_update,
+                       get_params,
+                       policy_and_value_net_apply,
+                       observations,
+                       actions,
+                       target_values,
+                       advantage_weights,
+                       actor_loss_weight,
+                       entropy_bonus,
+                       action_space,
+                       state=None,
+                       rng=None):
   """Optimization step for combined loss."""
 
   def _combined_loss(params, in_state):  # pylint: disable=missing-docstring
@@ -648,3 +650,10 @@ def combined_opt_step(i,
   new_weights = get_params(opt_state)
   g, state = grad(_combined_loss, has_aux=True)(new_weights, state)
   return opt_update(i, g, opt_state), state
+
+
+combined_opt_step = jit(_combined_opt_step, static_argnums=(2, 3, 4, 11))
+# Same, but reusing the device buffers of opt_state for the new one; the
+# opt_state passed to it can't be used afterwards.
+donating_combined_opt_step = jit(
+    _combined_opt_step, static_argnums=(2, 3, 4, 11), donate_argnums=(1,))
@@ -108,6 +108,17 @@ class AwrTrainerTest(absltest.TestCase):
       )
       trainer.training_loop(n_epochs=2)
 
+  def test_training_loop_cartpole_donate_buffers(self):
+    with self.tmp_dir() as output_dir:
+      trainer = self._make_trainer(
+          train_env=self.get_wrapped_env('CartPole-v0', 10),
+          eval_env=self.get_wrapped_env('CartPole-v0', 10),
+          output_dir=output_dir,
+          max_timestep=20,
+          donate_buffers=True,
+      )
+      trainer.training_loop(n_epochs=2)
+
 
 if __name__ == '__main__':
   absltest.main()
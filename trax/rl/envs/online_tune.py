@@ -28,10 +28,7 @@ LEARNING_RATE_METRIC = ('train', 'training/learning_rate')
 def historical_metric_values(
     history, metric, observation_range=(-np.inf, np.inf)):
   """Converts a metric stream from a trax History object into a numpy array."""
-  metric_sequence = history.get(*metric)
-  metric_values = np.array([
-      metric_value for (_, metric_value) in metric_sequence
-  ])
+  (_, metric_values) = history.steps_and_values(*metric)
   return np.clip(metric_values, *observation_range)
 
 
@@ -24,10 +24,7 @@ import numpy as np
 
 def historical_metric_values(history, metric):
   """Converts a metric stream from a trax History object into a numpy array."""
-  metric_sequence = history.get(*metric)
-  metric_values = np.array([
-      metric_value for (_, metric_value) in metric_sequence
-  ])
+  (_, metric_values) = history.steps_and_values(*metric)
   if np.any(np.isnan(metric_values)):
     # Zero out all observations if any element is NaN. This way the agent
     # doesn't get any rewards, so it learns to avoid those regions.
@@ -82,6 +82,7 @@ class PolicyBasedTrainer(base_trainer.BaseTrainer):
       # Optimization arguments.
       n_optimizer_steps=N_OPTIMIZER_STEPS,
       optimizer_batch_size=64,
+      donate_buffers=False,
       **kwargs):
     """Creates the PolicyBasedTrainer.
 
@@ -122,6 +123,9 @@ class PolicyBasedTrainer(base_trainer.BaseTrainer):
         reward with temperature 1.0.
       n_optimizer_steps: Number of optimizer steps.
       optimizer_batch_size: Batch size of an optimizer step.
+      donate_buffers: Whether optimizer steps reuse the device memory of the
+        old optimizer state for the new one. Peak memory is written to the
+        timing summaries either way.
       **kwargs: Additional keyword arguments passed to the base class.
     """
     super(PolicyBasedTrainer, self).__init__(train_env, eval_env, output_dir,
@@ -156,6 +160,7 @@ class PolicyBasedTrainer(base_trainer.BaseTrainer):
     # Optimization arguments.
     self._n_optimizer_steps = n_optimizer_steps
     self._optimizer_batch_size = optimizer_batch_size
+    self._donate_buffers = donate_buffers
     self._total_opt_step = 0
 
     # Policy and Value model arguments.
@@ -248,6 +253,10 @@ class PolicyBasedTrainer(base_trainer.BaseTrainer):
     (init_slots, init_opt_params) = (
         self._policy_and_value_optimizer.tree_init(weights)
     )
+    if self._donate_buffers:
+      # The optimizer keeps its initial parameters, so don't donate those.
+      init_opt_params = {
+          name: jnp.array(value) for (name, value) in init_opt_params.items()}
     self._policy_and_value_opt_state = (weights, init_slots, init_opt_params)
 
   def _policy_and_value_opt_update(self, step, grads, opt_state):
@@ -451,6 +460,12 @@ class PolicyBasedTrainer(base_trainer.BaseTrainer):
     self._n_trajectories_done_since_last_save = 0
     self._last_saved_at_epoch = self.epoch
 
+  def _write_memory_stats(self, step):
+    """Writes the peak memory use so far to the timing summaries."""
+    if self._should_write_summaries:
+      for (name, value) in trainer_lib.memory_stats().items():
+        self._timing_sw.scalar('memory/{}'.format(name), value, step=step)
+
   def flush_summaries(self):
     if self._should_write_summaries:
       self._train_sw.flush()
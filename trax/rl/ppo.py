@@ -454,21 +454,20 @@ def combined_loss(new_weights,
   return (loss, component_losses, summaries, state)
 
 
-@functools.partial(jax.jit, static_argnums=(2, 3, 4))
-def policy_and_value_opt_step(i,
-                              opt_state,
-                              opt_update,
-                              get_params,
-                              policy_and_value_net_apply,
-                              log_probab_actions_old,
-                              value_predictions_old,
-                              padded_observations,
-                              padded_actions,
-                              padded_rewards,
-                              reward_mask,
-                              nontrainable_params,
-                              state=None,
-                              rng=None):
+def _policy_and_value_opt_step(i,
+                               opt_state,
+                               opt_update,
+                               get_params,
+                               policy_and_value_net_apply,
+                               log_probab_actions_old,
+                               value_predictions_old,
+                               padded_observations,
+                               padded_actions,
+                               padded_rewards,
+                               reward_mask,
+                               nontrainable_params,
+                               state=None,
+                               rng=None):
   """Policy and Value optimizer step."""
 
   # Combined loss function given the new params.
@@ -494,6 +493,15 @@ def policy_and_value_opt_step(i,
   return opt_update(i, g, opt_state), state
 
 
+policy_and_value_opt_step = jax.jit(
+    _policy_and_value_opt_step, static_argnums=(2, 3, 4))
+# Same, but reusing the device buffers of opt_state for the new one, so the
+# old and new weights and slots do not have to fit in memory together. The
+# opt_state passed to it can't be used afterwards.
+donating_policy_and_value_opt_step = jax.jit(
+    _policy_and_value_opt_step, static_argnums=(2, 3, 4), donate_argnums=(1,))
+
+
 def approximate_kl(log_prob_new, log_prob_old, mask):
   """Computes the approximate KL divergence between the old and new log-probs.
 
@@ -259,8 +259,10 @@ class PPO(policy_based_trainer.PolicyBasedTrainer):
       k1, k2, k3 = jax_random.split(key, num=3)
       t = time.time()
       # Update the optimizer state on the sampled minibatch.
+      opt_step_fn = (ppo.donating_policy_and_value_opt_step
+                     if self._donate_buffers else ppo.policy_and_value_opt_step)
       self._policy_and_value_opt_state, self._model_state = (
-          ppo.policy_and_value_opt_step(
+          opt_step_fn(
               # We pass the optimizer slots between PPO epochs, so we need to
               # pass the optimization step as well, so for example the
               # bias-correction in Adam is calculated properly. Alternatively we
@@ -381,6 +383,7 @@ class PPO(policy_based_trainer.PolicyBasedTrainer):
     if self._should_write_summaries:
       for k, v in timing_dict.items():
         self._timing_sw.scalar('timing/%s' % k, v, step=last_epoch)
+    self._write_memory_stats(last_epoch)
 
     max_key_len = max(len(k) for k in timing_dict)
     timing_info_list = [
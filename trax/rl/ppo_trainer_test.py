@@ -372,6 +372,16 @@ class PpoTrainerTest(parameterized.TestCase):
       )
       trainer.training_loop(n_epochs=2)
 
+  def test_training_loop_cartpole_donate_buffers(self):
+    with self.tmp_dir() as output_dir:
+      trainer = self._make_trainer(
+          train_env=self.get_wrapped_env('CartPole-v0', 2),
+          eval_env=self.get_wrapped_env('CartPole-v0', 2),
+          output_dir=output_dir,
+          donate_buffers=True,
+      )
+      trainer.training_loop(n_epochs=2)
+
 
 if __name__ == '__main__':
   test.main()
@@ -16,6 +16,7 @@
 """Supervised learning imports in Trax."""
 
 from trax.supervised import inputs
+from trax.supervised import numpy_inputs
 from trax.supervised import trainer_lib
 from trax.supervised.inputs import Inputs
 from trax.supervised.trainer_lib import train
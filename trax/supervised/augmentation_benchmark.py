@@ -0,0 +1,74 @@
+# coding=utf-8
+# Copyright 2020 The Trax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Benchmark of per-image and batched CIFAR augmentation throughput.
+
+Compares images per second of the per-image `tf.data` augmentation used by
+`cifar10_augmentation_preprocess` with `cifar10_augment_batch` in NumPy and
+in JAX, on random CIFAR-sized images.
+"""
+
+import time
+
+from absl import app
+from absl import flags
+
+import numpy as np
+import tensorflow as tf
+from trax.supervised import inputs
+
+flags.DEFINE_integer('batch_size', 256, 'Number of images in a batch.')
+flags.DEFINE_integer('n_batches', 50, 'Number of batches to time.')
+
+FLAGS = flags.FLAGS
+
+
+def _images_per_second(batches, n_batches, batch_size):
+  """Returns how many images per second are taken from the batches."""
+  next(batches)  # Warm up, e.g., compile.
+  start_time = time.time()
+  for _ in range(n_batches):
+    batch = next(batches)
+  np.asarray(batch[0])  # Wait for asynchronous computation to finish.
+  return n_batches * batch_size / (time.time() - start_time)
+
+
+def main(_):
+  batch_size, n_batches = FLAGS.batch_size, FLAGS.n_batches
+  images = np.random.randint(
+      256, size=(batch_size, 32, 32, 3)).astype(np.float32) / 255.0
+  labels = np.zeros((batch_size,), dtype=np.int64)
+
+  dataset = tf.data.Dataset.from_tensor_slices((images, labels)).repeat()
+  dataset = dataset.map(lambda x, y: (inputs._cifar_augment_image(x), y))  # pylint: disable=protected-access
+  dataset = dataset.batch(batch_size)
+  results = {'per-image tf.data': _images_per_second(
+      iter(dataset.as_numpy_iterator()), n_batches, batch_size)}
+
+  for use_jax in [False, True]:
+    def augmented_batches(use_jax=use_jax):
+      while True:
+        yield inputs.cifar10_augment_batch((images, labels), use_jax=use_jax)
+    name = 'batched ' + ('jax' if use_jax else 'numpy')
+    results[name] = _images_per_second(
+        augmented_batches(), n_batches, batch_size)
+
+  for name, images_per_second in results.items():
+    print('%-20s %10.0f images/sec' % (name, images_per_second))
+
+
+if __name__ == '__main__':
+  app.run(main)
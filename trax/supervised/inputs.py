@@ -22,8 +22,19 @@ from __future__ import print_function
 
 import collections
 import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
 import os
+import queue
 import random
+import shutil
+import threading
+import time
+import traceback
 
 from absl import logging
 
@@ -36,93 +47,7 @@ import tensorflow_datasets as tfds
 import tensorflow_text as tf_text
 from trax import math
 from trax.math import numpy as jnp
-
-
-class Inputs(object):
-  """Inputs bundle.
-
-  Inputs bundle holds input streams and shapes for a training run.
-  It contains stream-creating functions that return python generators
-  of (input_batch, target_batch) tuples.
-
-  * train_stream: training data that will be used for training
-      may include all the augmentation or selection the training wants
-      the shape of examples is [batch_fn.batch_size, ...]
-  * train_eval_stream: training data used for evaluation
-      examples from training data but usually without augmentation
-      the shape of examples is [batch_fn.eval_batch_size, ...]
-  * eval_stream: evaluation data stream
-      examples from evaluation data, usually without augmentation
-      the shape of examples is [batch_fn.eval_batch_size, ...]
-  * input_shape: the shape of inputs
-      the [...] above, without batch size
-  * input_dtype: the data type of inputs
-  * target_shape: the shape of targets
-      the [...] above, without batch size
-  * target_dtype: the data type of targets
-  """
-
-  def __init__(self, train_stream, eval_stream=None, train_eval_stream=None):
-    """Initialize a new set of inputs.
-
-    Args:
-      train_stream: a function taking n_devices (an int) and returning
-        a python generator of training batches.
-      eval_stream: a function taking n_devices (an int) and returning
-        a python generator of validation batches;
-        if None, then the training generator will be used for evaluation.
-      train_eval_stream: a function taking n_devices (an int) and returning
-        a python generator of batches from
-        the training set used for evaluation (if None, use train_stream).
-    """
-    self._train_stream = train_stream
-    self._eval_stream = eval_stream or self._train_stream
-
-    # TODO(lukaszkaiser): should we get rid of this one day?
-    self._train_eval_stream = train_eval_stream or self._train_stream
-
-    # Peek into the train stream to get an example shape.
-    example_train_batch = next(train_stream(1))
-    self._input_shape = tuple(example_train_batch[0].shape)[1:]
-    self._input_dtype = example_train_batch[0].dtype
-    self._target_shape = tuple(example_train_batch[-1].shape)[1:]
-    self._target_dtype = example_train_batch[-1].dtype
-    self._example_shape = [x.shape for x in example_train_batch]
-    self._example_dtype = [x.dtype for x in example_train_batch]
-
-  def train_stream(self, n_devices):
-    return self._train_stream(n_devices)
-
-  def eval_stream(self, n_devices):
-    return self._eval_stream(n_devices)
-
-  def train_eval_stream(self, n_devices):
-    return self._train_stream(n_devices)
-
-  @property
-  def input_shape(self):
-    """Example input shape, without batch dimension."""
-    return self._input_shape
-
-  @property
-  def target_shape(self):
-    """Example target shape, without batch dimension."""
-    return self._target_shape
-
-  @property
-  def input_dtype(self):
-    """Dtype of the input."""
-    return self._input_dtype
-
-  @property
-  def target_dtype(self):
-    """Dtype of the target."""
-    return self._target_dtype
-
-  @property
-  def example_shape_dtype(self):
-    """Shape and Dtype of an example batch."""
-    return self._example_shape, self._example_dtype
+from trax.supervised.inputs_base import Inputs
 
 
 # How many examples from the stream to skip at random during training.
@@ -130,6 +55,14 @@ class Inputs(object):
 # TODO(lukaszkaiser): can we improve efficiency, should that be changed?
 _MAX_SKIP_EXAMPLES = 1e5
 
+# How often (in seconds) a producer or consumer blocked on a queue of batches
+# checks whether it should stop waiting.
+_QUEUE_POLL_SECS = 0.1
+
+# The (shard_id, n_shards) of the source data this process reads, see
+# `input_shard`; set in the workers of `parallel_inputs`.
+_input_shard = (0, 1)
+
 
 def download_and_prepare(dataset_name, data_dir):
   """Downloads and prepares T2T or TFDS dataset.
@@ -166,7 +99,8 @@ def download_and_prepare(dataset_name, data_dir):
 
 
 @gin.configurable()
-def inputs(dataset_name, data_dir=None, input_name=None, target_name=None):
+def inputs(dataset_name, data_dir=None, input_name=None, target_name=None,
+           cache_dir=None):
   """Make Inputs for built-in datasets.
 
   Args:
@@ -176,6 +110,13 @@ def inputs(dataset_name, data_dir=None, input_name=None, target_name=None):
     input_name: optional, name of the inputs from the dictionary.
     target_name: optional, name of the outputs either from the dictionary or as
       a result of post-processing.
+    cache_dir: optional local directory; if set, preprocessed examples are
+      written there once and read back by later runs, see `ExampleCache`.
+      Preprocessing that augments examples at random cannot be cached; use
+      `batch_fn.augment_fn` to augment cached examples on read instead.
+
+  In a worker of `parallel_inputs`, the streams only read the worker's shard of
+  the examples, see `input_shard`.
 
   Returns:
     trax.inputs.Inputs
@@ -187,9 +128,10 @@ def inputs(dataset_name, data_dir=None, input_name=None, target_name=None):
     """Create the stream, cache TF streams if needed."""
     if n_devices not in cache:
       cache[n_devices] = _train_and_eval_batches(
-          dataset_name, data_dir, input_name, target_name)
+          dataset_name, data_dir, input_name, target_name, cache_dir=cache_dir,
+          shard=input_shard())
 
-    (train_batches, train_eval_batches, eval_batches,
+    (train_batches, train_eval_batches, eval_batches, full_eval_data,
      input_name_c, var_shapes) = cache[n_devices]
     dataset = train_batches
     training = True
@@ -199,12 +141,24 @@ def inputs(dataset_name, data_dir=None, input_name=None, target_name=None):
     if which == 'train_eval':
       dataset = train_eval_batches
       training = False
-    generator = dataset_to_stream(dataset, input_name_c)
-    return batch_fn(generator, training, n_devices, var_shapes)
+    if which == 'full_eval':
+      dataset = full_eval_data
+      training = False
+    if isinstance(dataset, ExampleCache):
+      generator = dataset.stream(shuffle=training,
+                                 repeat=(which != 'full_eval'),
+                                 shard=input_shard())
+    else:
+      generator = dataset_to_stream(dataset, input_name_c)
+    batches = batch_fn(generator, training, n_devices, var_shapes)
+    if which == 'full_eval':
+      batches = pad_batches(batches, n_devices)
+    return batches
 
   return Inputs(train_stream=lambda n: stream(n, 'train'),
                 train_eval_stream=lambda n: stream(n, 'train_eval'),
-                eval_stream=lambda n: stream(n, 'eval'))
+                eval_stream=lambda n: stream(n, 'eval'),
+                full_eval_stream=lambda n: stream(n, 'full_eval'))
 
 
 @gin.configurable()
@@ -528,16 +482,54 @@ def batch_fn(dataset, training, n_devices, variable_target_shapes,
              batch_size_per_device=32, batch_size=None, eval_batch_size=32,
              bucket_length=32, buckets=None,
              buckets_include_inputs_in_length=False,
-             batch_shuffle_size=8, max_eval_length=None):
-  """Batching function."""
+             batch_shuffle_size=8, max_eval_length=None, pack_length=None,
+             token_budget=None, max_buckets=8, length_warmup_size=1000,
+             batch_shapes=None, augment_fn=None):
+  """Batching function.
+
+  If pack_length is set, examples are packed into rows of that length by
+  `pack_data` instead of being bucketed, see there for the batch format.
+
+  If token_budget is set (and no buckets are given), the batch size of each
+  bucket is chosen so that batch size times padded length stays within the
+  budget. The (at most max_buckets) bucket boundaries are then chosen to
+  minimize padding on the lengths of the first length_warmup_size examples,
+  and batches are padded to their bucket boundary so that each bucket has one
+  batch shape, see `token_budget_buckets`.
+
+  If batch_shapes is set, all batches are padded to one of these (batch size,
+  length) shapes by `snap_to_shapes`, so only these shapes ever get compiled.
+
+  If augment_fn is set, it is applied to each training batch, e.g.,
+  `cifar10_augment_batch` to augment images a batch at a time.
+  """
   # Batch size is batch_size_per_device * n_devices unless given directly.
   batch_size = batch_size or batch_size_per_device * n_devices
   # If bucketing is not specified, check if target shapes are variable.
   cur_batch_size = batch_size if training else eval_batch_size
   # Make cur_batch_size divisible by n_devices.
   cur_batch_size = max(cur_batch_size // n_devices, 1) * n_devices
+  def example_length(x):
+    """The length function used by bucket_by_sequence_length to bucket."""
+    # The input x is a tuple to go on the stack, typically either
+    # (input, target) or (input, target, mask).
+    example_inputs, target = x[0], x[1]
+    # Length is the shape of axis 0 here (no batch yet).
+    other_length = 0  # We include input length only if asked.
+    if buckets_include_inputs_in_length:
+      other_length = example_inputs.shape[0]
+    return max(target.shape[0], other_length)
+
+  log_batch_stats = pad_to_boundaries = False
+  if buckets is None and token_budget and not pack_length:
+    warmup_examples = list(itertools.islice(dataset, length_warmup_size))
+    dataset = itertools.chain(warmup_examples, dataset)
+    buckets = token_budget_buckets(
+        [example_length(x) for x in warmup_examples], token_budget,
+        max_buckets=max_buckets, n_devices=n_devices)
+    log_batch_stats = pad_to_boundaries = True
   # Create heuristic buckets is none are specified.
-  if buckets is None:
+  if buckets is None and not pack_length:
     logging.info('Heuristically setting bucketing to %s based on shapes '
                  'of target tensors.', variable_target_shapes)
     if variable_target_shapes:
@@ -561,23 +553,24 @@ def batch_fn(dataset, training, n_devices, variable_target_shapes,
                             for b in bucket_batch_sizes]
       buckets = (bucket_boundaries, bucket_batch_sizes)
 
-  if buckets:
+  if pack_length:
+    logging.info('Packing examples into rows of length %d.', pack_length)
+    dataset = batch_data(pack_data(dataset, pack_length), cur_batch_size,
+                         drop_remainder=training)
+  elif buckets:
     logging.info('Bucketing with buckets %s.', str(buckets))
-    def example_length(x):
-      """The length function used by bucket_by_sequence_length to bucket."""
-      # The input x is a tuple to go on the stack, typically either
-      # (input, target) or (input, target, mask).
-      example_inputs, target = x[0], x[1]
-      # Length is the shape of axis 0 here (no batch yet).
-      other_length = 0  # We include input length only if asked.
-      if buckets_include_inputs_in_length:
-        other_length = example_inputs.shape[0]
-      return max(target.shape[0], other_length)
     boundaries, batch_sizes = buckets
     dataset = bucket_by_length(
-        dataset, example_length, boundaries, batch_sizes)
+        dataset, example_length, boundaries, batch_sizes,
+        pad_to_boundaries=pad_to_boundaries)
   else:
-    dataset = batch_data(dataset, cur_batch_size)
+    dataset = batch_data(dataset, cur_batch_size, drop_remainder=training)
+  if batch_shapes:
+    dataset = snap_to_shapes(dataset, batch_shapes)
+  if training and augment_fn is not None:
+    dataset = map(augment_fn, dataset)
+  if log_batch_stats:
+    dataset = _log_batch_stats(dataset, 'train' if training else 'eval')
   if training:
     dataset = shuffle_data(dataset, batch_shuffle_size)
   return dataset
@@ -631,6 +624,56 @@ def cifar10_augmentation_preprocess(dataset, training, shapes):
   return dataset, shapes
 
 
+@gin.configurable(blacklist=['batch'])
+def cifar10_augment_batch(batch, padding=4, use_jax=False):
+  """Augments a batch of CIFAR images at once, like `_cifar_augment_image`.
+
+  Each image in batch[0] (of shape [batch, height, width, channels]) is zero
+  padded by `padding` pixels on each side, randomly cropped back to its size
+  and randomly flipped left to right. The random crops and flips are drawn in
+  NumPy and applied to the whole batch with one gather, either in NumPy or, if
+  use_jax is True, in a jitted function on the accelerator.
+
+  Args:
+    batch: tuple of arrays, the first one a batch of images.
+    padding: int, how many pixels to pad on each side before cropping.
+    use_jax: bool, whether to gather on the accelerator.
+
+  Returns:
+    The batch with augmented images.
+  """
+  images = batch[0]
+  batch_size = images.shape[0]
+  offsets = np.random.randint(2 * padding + 1, size=(2, batch_size))
+  flips = np.random.randint(2, size=(batch_size,)).astype(np.bool_)
+  if use_jax:
+    crop_and_flip = _jit_crop_and_flip(math.backend_name())
+    images = crop_and_flip(images, offsets, flips, padding)
+  else:
+    images = _crop_and_flip(np, images, offsets, flips, padding)
+  return (images,) + tuple(batch[1:])
+
+
+def _crop_and_flip(numpy_module, images, offsets, flips, padding):
+  """Pads, crops at offsets and flips images using the given numpy module."""
+  batch_size, height, width = images.shape[:3]
+  pad_widths = [(0, 0), (padding, padding), (padding, padding)]
+  pad_widths += [(0, 0)] * (len(images.shape) - 3)
+  padded = numpy_module.pad(images, pad_widths, mode='constant')
+  rows = offsets[0][:, None] + numpy_module.arange(height)
+  cols = offsets[1][:, None] + numpy_module.arange(width)
+  cols = numpy_module.where(flips[:, None], cols[:, ::-1], cols)
+  batch_indices = numpy_module.arange(batch_size)[:, None, None]
+  return padded[batch_indices, rows[:, :, None], cols[:, None, :]]
+
+
+@functools.lru_cache(maxsize=None)
+def _jit_crop_and_flip(backend_name):
+  """Returns `_crop_and_flip` jitted in the given backend."""
+  del backend_name  # Only used to cache one jitted function per backend.
+  return math.jit(functools.partial(_crop_and_flip, jnp), static_argnums=(3,))
+
+
 @gin.configurable(blacklist=['dataset', 'training', 'shapes'])
 def cifar10_augmentation_flatten_preprocess(dataset, training, shapes,
                                             predict_image_train_weight=0.01):
@@ -801,8 +844,13 @@ def shuffle_and_batch_data(dataset,
                            features_info,
                            training,
                            shuffle_buffer_size=1024,
-                           preprocess_fun=no_preprocess):
-  """Shuffle and batch the given dataset."""
+                           preprocess_fun=no_preprocess,
+                           repeat_and_shuffle=True):
+  """Shuffle and batch the given dataset.
+
+  If repeat_and_shuffle is False, only preprocesses the dataset, e.g., to pass
+  over it once and cache the result.
+  """
   def append_targets(example):
     """Append targets to the example dictionary. Needed for Keras."""
     if len(target_names) == 1:
@@ -812,27 +860,64 @@ def shuffle_and_batch_data(dataset,
       targets[name] = example[name]
     return (example, targets)
   dataset = dataset.map(append_targets)
-  # TODO(pkozakowski): Repeat both the training and evaluation set, so we don't
-  # have incomplete batches during evaluation. This will be a problem when we
-  # add an option to evaluate on the whole dataset, then we'll need to think of
-  # a different solution.
+  shapes = {k: features_info[k].shape for k in features_info}
+  shapes = (shapes, shapes[target_names[0]])
+  if not repeat_and_shuffle:
+    return preprocess_fun(dataset, training, shapes)
+  # Repeat both the training and evaluation set, so we don't have incomplete
+  # batches during evaluation. To evaluate on the whole dataset, it is passed
+  # over once instead and the last batches are padded, see `pad_batches`.
   dataset = dataset.repeat()
   if training:
     # Skip a random fraction at the beginning of the stream.  The skip is
     # essential for synchronous highly-parallel training to avoid multiple
     # replicas reading the same data in lock-step.
     dataset = dataset.skip(random.randint(0, _MAX_SKIP_EXAMPLES))
-  shapes = {k: features_info[k].shape for k in features_info}
-  shapes = (shapes, shapes[target_names[0]])
   dataset, shapes = preprocess_fun(dataset, training, shapes)
   dataset = dataset.shuffle(shuffle_buffer_size)
   return dataset.prefetch(8), shapes
 
 
-def _train_and_eval_batches(dataset, data_dir, input_name, target_name):
-  """Return train and eval batches with input name and shape."""
-  (train_data, eval_data, features_info, keys) = train_and_eval_dataset(
-      dataset, data_dir)
+def _train_and_eval_batches(dataset, data_dir, input_name, target_name,
+                            cache_dir=None, shard=(0, 1)):
+  """Return train and eval batches with input name and shape.
+
+  If cache_dir is given, the batches are `ExampleCache`s of the preprocessed
+  train and eval data, written on the first run with the same cache key.
+
+  Besides the (repeated) train, train_eval and eval batches, the preprocessed
+  eval data is returned to pass over exactly once, for full evaluation.
+
+  If shard is (shard_id, n_shards) with n_shards > 1, the datasets only contain
+  every n_shards-th example, starting at shard_id, before any shuffling and
+  preprocessing. Example caches are sharded when they are streamed instead.
+  """
+  if cache_dir is not None:
+    _check_example_cache_dir(cache_dir)
+    cache_path = os.path.join(
+        os.path.expanduser(cache_dir),
+        _example_cache_key(dataset, data_dir, input_name, target_name))
+    if not os.path.exists(cache_path):
+      _write_example_caches(cache_path, dataset, data_dir, input_name,
+                            target_name)
+    logging.info('Reading cached examples from %s.', cache_path)
+    with open(os.path.join(cache_path, 'info.json')) as f:
+      info = json.load(f)
+    train_cache = ExampleCache(os.path.join(cache_path, 'train'))
+    eval_cache = ExampleCache(os.path.join(cache_path, 'eval'))
+    return (train_cache, train_cache, eval_cache, eval_cache,
+            info['input_name'], info['variable_target_shapes'])
+  shard_id, n_shards = shard
+  if n_shards > 1:
+    # Shards are taken by position, so all of them must read the files in the
+    # same order; each shard then shuffles its examples on its own.
+    (train_data, eval_data, features_info, keys) = train_and_eval_dataset(
+        dataset, data_dir, train_shuffle_files=False, eval_shuffle_files=False)
+    train_data = train_data.shard(n_shards, shard_id)
+    eval_data = eval_data.shard(n_shards, shard_id)
+  else:
+    (train_data, eval_data, features_info, keys) = train_and_eval_dataset(
+        dataset, data_dir)
   if keys is not None:
     input_names, target_names = keys[0], keys[1]
   else:
@@ -843,14 +928,217 @@ def _train_and_eval_batches(dataset, data_dir, input_name, target_name):
       train_data, target_names, features_info, training=False)
   eval_batches, _ = shuffle_and_batch_data(
       eval_data, target_names, features_info, training=False)
+  full_eval_data, _ = shuffle_and_batch_data(
+      eval_data, target_names, features_info, training=False,
+      repeat_and_shuffle=False)
   input_name = input_name or input_names[0]
   # Check if target shapes are variable so we know whether to do bucketing.
   target_shape = shapes[1]
   variable_target_shapes = None in target_shape
-  return (train_batches, train_eval_batches, eval_batches,
+  return (train_batches, train_eval_batches, eval_batches, full_eval_data,
           input_name, variable_target_shapes)
 
 
+# Increase when the format or content of example caches changes.
+_EXAMPLE_CACHE_VERSION = 1
+
+# Preprocessing functions that augment training examples at random; caching
+# their output would repeat the same augmentation in every epoch.
+_RANDOM_PREPROCESS_FUNS = ('cifar10_augmentation_preprocess',
+                           'cifar10_augmentation_flatten_preprocess')
+
+
+class ExampleCache(object):
+  """Preprocessed examples stored in flat memory-mapped files.
+
+  Examples are tuples of arrays, e.g., (inputs, targets) of tokens. For each
+  position in the tuple, the arrays of all examples are flattened and
+  concatenated into one file, and an offsets index and the array shapes are
+  stored next to it. Examples are then read as zero-copy slices of a
+  `np.memmap`, without running the original preprocessing again.
+
+  Use `write` to create a cache from a finite stream of examples.
+  """
+
+  def __init__(self, path):
+    """Opens the cache stored in the directory `path`."""
+    with open(os.path.join(path, 'meta.json')) as f:
+      meta = json.load(f)
+    self._offsets, self._shapes, self._data = [], [], []
+    for i, dtype in enumerate(meta['dtypes']):
+      offsets = np.load(os.path.join(path, f'offsets_{i}.npy'))
+      self._offsets.append(offsets)
+      self._shapes.append(np.load(os.path.join(path, f'shapes_{i}.npy')))
+      if offsets[-1]:
+        data = np.memmap(os.path.join(path, f'data_{i}.bin'), dtype=dtype,
+                         mode='r', shape=(int(offsets[-1]),))
+      else:  # Memory-mapping empty files is not supported.
+        data = np.zeros((0,), dtype=dtype)
+      self._data.append(data)
+    self._n_examples = meta['n_examples']
+
+  @staticmethod
+  def write(examples, path):
+    """Writes the examples to a new cache directory `path`.
+
+    The cache is written to a temporary directory first and moved to `path` at
+    the end, so readers never see a partially written cache.
+
+    Args:
+      examples: finite iterable of examples, tuples of numpy arrays.
+      path: the directory to create; its parent must exist.
+
+    Returns:
+      the number of examples written.
+    """
+    tmp_path = f'{path}.tmp.{os.getpid()}'
+    os.makedirs(tmp_path)
+    files, offsets, shapes, dtypes = [], [], [], []
+    try:
+      for example in examples:
+        if not files:
+          dtypes = [np.asarray(x).dtype for x in example]
+          files = [open(os.path.join(tmp_path, f'data_{i}.bin'), 'wb')
+                   for i in range(len(example))]
+          offsets = [[0] for _ in example]
+          shapes = [[] for _ in example]
+        if len(example) != len(files):
+          raise ValueError(f'Cannot cache examples of different lengths, got '
+                           f'{len(example)} and {len(files)}.')
+        for i, x in enumerate(example):
+          x = np.asarray(x, dtype=dtypes[i])
+          files[i].write(x.tobytes())
+          offsets[i].append(offsets[i][-1] + x.size)
+          shapes[i].append(x.shape)
+    finally:
+      for f in files:
+        f.close()
+    for i in range(len(files)):
+      np.save(os.path.join(tmp_path, f'offsets_{i}.npy'),
+              np.array(offsets[i], dtype=np.int64))
+      np.save(os.path.join(tmp_path, f'shapes_{i}.npy'),
+              np.array(shapes[i], dtype=np.int64).reshape(
+                  (len(shapes[i]), -1)))
+    n_examples = len(offsets[0]) - 1 if offsets else 0
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+      json.dump({'dtypes': [d.str for d in dtypes],
+                 'n_examples': n_examples}, f)
+    try:
+      os.rename(tmp_path, path)
+    except OSError:  # Another process wrote the same cache in the meantime.
+      shutil.rmtree(tmp_path)
+    return n_examples
+
+  def __len__(self):
+    return self._n_examples
+
+  def __getitem__(self, index):
+    return tuple(
+        data[offsets[index]:offsets[index + 1]].reshape(shapes[index])
+        for (data, offsets, shapes) in zip(
+            self._data, self._offsets, self._shapes))
+
+  def stream(self, shuffle=False, repeat=True, shard=(0, 1)):
+    """Returns a stream of examples, reshuffled every epoch if asked.
+
+    Args:
+      shuffle: whether to go through the examples in random order.
+      repeat: whether to repeat the examples endlessly or stop after one pass.
+      shard: pair (shard_id, n_shards); only every n_shards-th example,
+        starting at shard_id, is streamed.
+    """
+    shard_id, n_shards = shard
+    indices = np.arange(shard_id, self._n_examples, n_shards)
+    if repeat and not indices.size:
+      raise ValueError(f'Cannot stream from an empty example cache or shard, '
+                       f'shard {shard_id} of {n_shards} of {self._n_examples} '
+                       f'examples.')
+    while True:
+      order = np.random.permutation(indices) if shuffle else indices
+      for i in order:
+        yield self[i]
+      if not repeat:
+        return
+
+
+def _gin_bindings(names):
+  """Returns the gin bindings of the configurables with the given names."""
+  bindings, keep = [], False
+  for line in gin.config_str().splitlines():
+    if line and not line[0].isspace():  # Not a continuation line.
+      keep = line.split('.')[0].split('/')[-1] in names
+    if keep:
+      bindings.append(line)
+  return '\n'.join(bindings)
+
+
+def _preprocess_fun_name():
+  """Returns the name of the preprocess_fun of `shuffle_and_batch_data`."""
+  try:
+    return gin.query_parameter(
+        'shuffle_and_batch_data.preprocess_fun').configurable.name
+  except ValueError:  # Not bound in gin, so it is the default.
+    return no_preprocess.__name__
+
+
+def _check_example_cache_dir(cache_dir):
+  """Raises ValueError if the preprocessed examples cannot be cached there."""
+  if '://' in cache_dir:
+    raise ValueError(f'Example caches are memory-mapped, so cache_dir must be '
+                     f'a local directory, got {cache_dir}.')
+  preprocess_fun = _preprocess_fun_name()
+  if preprocess_fun in _RANDOM_PREPROCESS_FUNS:
+    raise ValueError(
+        f'Cannot cache examples preprocessed by {preprocess_fun}, which '
+        f'augments them at random. Cache examples without augmentation, e.g., '
+        f'from cifar10_no_augmentation_preprocess, and augment them on read '
+        f'with batch_fn.augment_fn, e.g., cifar10_augment_batch.')
+
+
+def _example_cache_key(dataset_name, data_dir, input_name, target_name):
+  """Returns a directory name identifying the preprocessed dataset."""
+  preprocess_fun = _preprocess_fun_name()
+  key = repr((_EXAMPLE_CACHE_VERSION, dataset_name, data_dir, input_name,
+              target_name, preprocess_fun,
+              _gin_bindings(['train_and_eval_dataset', 'shuffle_and_batch_data',
+                             preprocess_fun])))
+  return '{}-{}'.format(dataset_name.replace('/', '_'),
+                        hashlib.sha1(key.encode()).hexdigest()[:16])
+
+
+def _write_example_caches(cache_path, dataset, data_dir, input_name,
+                          target_name):
+  """Preprocesses the train and eval data once and caches it in cache_path."""
+  logging.info('Writing preprocessed %s to example cache %s.',
+               dataset, cache_path)
+  (train_data, eval_data, features_info, keys) = train_and_eval_dataset(
+      dataset, data_dir, train_shuffle_files=False)
+  if keys is not None:
+    input_names, target_names = keys[0], keys[1]
+  else:
+    input_names, target_names = [input_name], [target_name]
+  input_name = input_name or input_names[0]
+  tmp_path = f'{cache_path}.tmp.{os.getpid()}'
+  os.makedirs(tmp_path)
+  shapes = None
+  for (name, data, training) in [('train', train_data, True),
+                                 ('eval', eval_data, False)]:
+    data, shapes_split = shuffle_and_batch_data(
+        data, target_names, features_info, training=training,
+        repeat_and_shuffle=False)
+    shapes = shapes or shapes_split
+    n_examples = ExampleCache.write(dataset_to_stream(data, input_name),
+                                    os.path.join(tmp_path, name))
+    logging.info('Cached %d %s examples.', n_examples, name)
+  with open(os.path.join(tmp_path, 'info.json'), 'w') as f:
+    json.dump({'input_name': input_name,
+               'variable_target_shapes': None in shapes[1]}, f)
+  try:
+    os.rename(tmp_path, cache_path)
+  except OSError:  # Another process wrote the same cache in the meantime.
+    shutil.rmtree(tmp_path)
+
+
 DEFAULT_SPM_PATH = 'gs://t5-data/vocabs/cc_all.32000/sentencepiece.model'  # GCS
 
 
@@ -894,22 +1182,141 @@ def c4_preprocess(dataset, training, shapes, max_target_length=-1,
   return dataset, (new_shapes, new_shapes['targets'])
 
 
-def shuffle_data(generator, buffer_size):
-  """Shuffle generator as in tf.data.Dataset.shuffle."""
-  buf = []
-  assert buffer_size > 0, 'Buffer size must be positive'
-  for example in generator:
-    buf.append(example)
-    if len(buf) == buffer_size:
-      i = int(np.random.randint(buffer_size))  # Random index to yield.
-      # Swap the selected element with the last element (no-op if i = len - 1).
-      buf[i], buf[-1] = buf[-1], buf[i]
-      # Remove and yield last element.
-      yield buf.pop()
+class ShuffleBuffer(object):
+  """Shuffles a stream as in tf.data.Dataset.shuffle, with resumable state.
+
+  Examples are kept in a fixed number of preallocated slots: each step yields
+  the example in a random slot and refills that slot with the next example
+  from the stream, so both cost O(1). When the stream ends, the examples left
+  in the buffer are yielded in random order too.
+
+  The random order is determined by `seed` and can be checkpointed: `state()`
+  returns the random state, the buffered examples and the number of examples
+  read so far, and `restore(state)` continues from there on a fresh copy of
+  the same stream, skipping the examples that were already read. The skipped
+  examples are read and dropped, so restoring costs as much input work as
+  producing them did, i.e., it grows with the number of examples read.
+  """
+
+  def __init__(self, generator, buffer_size, seed=None):
+    """Creates a shuffle buffer.
+
+    Args:
+      generator: python generator of examples to shuffle.
+      buffer_size: int, number of examples to shuffle at a time.
+      seed: int or None, seed for the random order; if None, it is drawn from
+        the global NumPy random generator.
+    """
+    if buffer_size <= 0:
+      raise ValueError(f'Buffer size must be positive, but is {buffer_size}.')
+    if seed is None:
+      seed = np.random.randint(2**31 - 1)
+    self._generator = iter(generator)
+    self._slots = [None] * buffer_size
+    self._n_filled = 0
+    self._n_read = 0
+    self._n_to_skip = 0
+    self._exhausted = False
+    self._rng = np.random.RandomState(seed)
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if not self._exhausted:
+      self._skip_read_examples()
+    while not self._exhausted and self._n_filled < len(self._slots):
+      example = self._read()
+      if not self._exhausted:
+        self._slots[self._n_filled] = example
+        self._n_filled += 1
+    if self._n_filled == 0:
+      raise StopIteration
+    i = self._rng.randint(self._n_filled)
+    example = self._slots[i]
+    replacement = None if self._exhausted else self._read()
+    if self._exhausted:
+      # Drain the buffer: move the last filled slot into the yielded one.
+      self._n_filled -= 1
+      self._slots[i] = self._slots[self._n_filled]
+      self._slots[self._n_filled] = None
+    else:
+      self._slots[i] = replacement
+    return example
+
+  def state(self):
+    """Returns a picklable state to continue the shuffled stream from."""
+    return {
+        'random_state': self._rng.get_state(),
+        'examples': list(self._slots[:self._n_filled]),
+        'n_read': self._n_read,
+    }
+
+  def restore(self, state):
+    """Continues from `state`; the stream must not have been read from yet."""
+    if self._n_read:
+      raise ValueError('Cannot restore a shuffle buffer that was already read '
+                       f'from ({self._n_read} examples).')
+    examples = state['examples']
+    if len(examples) > len(self._slots):
+      raise ValueError(f'Cannot restore {len(examples)} examples into a buffer '
+                       f'of size {len(self._slots)}.')
+    self._rng.set_state(state['random_state'])
+    self._slots[:len(examples)] = examples
+    self._n_filled = len(examples)
+    self._n_read = self._n_to_skip = state['n_read']
+
+  def _skip_read_examples(self):
+    for _ in range(self._n_to_skip):
+      try:
+        next(self._generator)
+      except StopIteration:
+        self._exhausted = True
+        break
+    self._n_to_skip = 0
+
+  def _read(self):
+    try:
+      example = next(self._generator)
+    except StopIteration:
+      self._exhausted = True
+      return None
+    self._n_read += 1
+    return example
+
+
+def shuffle_data(generator, buffer_size, seed=None):
+  """Shuffle generator as in tf.data.Dataset.shuffle, see `ShuffleBuffer`."""
+  return ShuffleBuffer(generator, buffer_size, seed=seed)
+
+
+class MappedStream(object):
+  """Applies a function to each element of a stream, like `map`.
+
+  Unlike `map`, it keeps the `state`, `restore` and `close` methods of the
+  stream, so a mapped `ShuffleBuffer` can still be checkpointed and resumed.
+  """
+
+  def __init__(self, fn, stream):
+    self._fn = fn
+    self._stream = iter(stream)
+    for name in ('state', 'restore', 'close'):
+      if hasattr(stream, name):
+        setattr(self, name, getattr(stream, name))
+
+  def __iter__(self):
+    return self
 
+  def __next__(self):
+    return self._fn(next(self._stream))
 
-def batch_data(generator, batch_size):
-  """Batch and pad generator as in tf.data.Dataset.padded_batch."""
+
+def batch_data(generator, batch_size, drop_remainder=True):
+  """Batch and pad generator as in tf.data.Dataset.padded_batch.
+
+  If drop_remainder is False, the examples left at the end of a finite
+  generator are yielded as a last, smaller batch.
+  """
   buf = []
   assert batch_size > 0, f'Batch size must be positive, but is {batch_size}'
   for example in generator:
@@ -921,6 +1328,107 @@ def batch_data(generator, batch_size):
       # Note that it's the same shape as each example with added batch dim.
       yield batch
       buf = []
+  if buf and not drop_remainder:
+    yield tuple(np.stack(x) for x in zip(*buf))
+
+
+def pad_batches(generator, n_devices=1):
+  """Pads smaller batches to the full batch size, with 0 weights on padding.
+
+  Batches of a finite stream, e.g., over the whole evaluation set, can be
+  smaller at the end. Each batch is padded with zeros in the batch dimension
+  to the largest batch size seen before for batches of the same shape (other
+  than the batch size), and at least to a multiple of n_devices, so that it
+  does not need to be compiled for separately. Batches of (inputs, targets)
+  get weights added first, so that padded examples never count in metrics.
+
+  Args:
+    generator: python generator of batches.
+    n_devices: int, the number of devices to split the batches between.
+
+  Yields:
+    Batches of (inputs, targets, weights) or with more arrays if given.
+  """
+  batch_sizes = {}
+  for batch in generator:
+    if len(batch) == 2:
+      batch += (np.ones(batch[1].shape, dtype=np.float32),)
+    batch_size = batch[0].shape[0]
+    shapes = tuple(x.shape[1:] for x in batch)
+    full_size = max(batch_sizes.get(shapes, 0),
+                    -(-batch_size // n_devices) * n_devices)
+    batch_sizes[shapes] = full_size
+    if batch_size < full_size:
+      batch = tuple(
+          np.concatenate(
+              [x, np.zeros((full_size - batch_size,) + x.shape[1:],
+                           dtype=x.dtype)])
+          for x in batch)
+    yield batch
+
+
+def pack_data(generator, length, max_open_rows=8):
+  """Greedily pack examples from generator into rows of the given length.
+
+  Examples are pairs (inputs, targets) or triples (inputs, targets, weights)
+  of 1-D arrays with the same length, as produced e.g. by `concat_preprocess`
+  or `wmt_concat_preprocess`. Each example is placed into the first open row
+  with enough space left; if there is none, a new row is opened, and when more
+  than `max_open_rows` rows are open the fullest one is yielded. Examples
+  longer than `length` are truncated.
+
+  Each yielded row is a tuple (inputs, segment_ids, positions, targets,
+  weights) of arrays of shape [length]. Segment ids number the examples in the
+  row from 1 (0 marks padding) and positions count from 0 in each example, so
+  a model can keep the examples apart, e.g., `TransformerLM(packed=True)`
+  takes the first three and leaves (targets, weights) for the loss. Padding
+  has zero weight.
+
+  Args:
+    generator: python generator of examples to pack.
+    length: int, length of the packed rows.
+    max_open_rows: int, how many rows to fill at the same time.
+
+  Yields:
+    Packed rows, as described above.
+  """
+  rows = []  # Pairs (number of filled positions, list of arrays).
+  for example in generator:
+    if len(example) not in (2, 3):
+      raise ValueError(f'Can only pack examples of 2 or 3 tensors, '
+                       f'got {len(example)}.')
+    inputs, targets = example[0][:length], example[1][:length]
+    if len(example) == 3:
+      weights = example[2][:length]
+    else:
+      weights = np.ones(targets.shape, dtype=np.float32)
+    n = inputs.shape[0]
+    if targets.shape[0] != n or weights.shape[0] != n:
+      raise ValueError(f'Cannot pack inputs and targets of different lengths '
+                       f'({inputs.shape[0]} and {targets.shape[0]}).')
+    free_rows = [row for row in rows if row[0] + n <= length]
+    if free_rows:
+      row = free_rows[0]
+    else:
+      if len(rows) == max_open_rows:
+        fullest = max(rows, key=lambda row: row[0])
+        rows.remove(fullest)
+        yield tuple(fullest[1])
+      row = [0, [np.zeros((length,), dtype=inputs.dtype),
+                 np.zeros((length,), dtype=np.int32),
+                 np.zeros((length,), dtype=np.int32),
+                 np.zeros((length,), dtype=targets.dtype),
+                 np.zeros((length,), dtype=np.float32)]]
+      rows.append(row)
+    start, (row_inputs, segment_ids, positions, row_targets, row_weights) = row
+    segment_ids[start:start + n] = segment_ids[max(start - 1, 0)] + 1
+    positions[start:start + n] = np.arange(n)
+    row_inputs[start:start + n] = inputs
+    row_targets[start:start + n] = targets
+    row_weights[start:start + n] = weights
+    row[0] = start + n
+  for row in rows:
+    yield tuple(row[1])
 
 
 def pad_to_max_dims(tensors, boundary=None):
@@ -955,48 +1463,616 @@ def pad_to_max_dims(tensors, boundary=None):
     min_len = min([t.shape[i] for t in tensors])
     if max_len == min_len:  # No padding needed.
       max_len_to_pad.append(max_len)
-    elif boundary is None:
-      max_len_to_pad.append(max_len)
-      padding_needed = True
     else:
       padding_needed = True
-      cur_boundary = max(max_len, boundary)
-      if 2 * max_len < cur_boundary:
-        cur_boundary = 2**int(np.ceil(np.log2(max_len)))
-      max_len_to_pad.append(cur_boundary)
+      max_len_to_pad.append(_padded_length(max_len, boundary))
   if not padding_needed:
     return np.stack(tensors)
-  padded_tensors = []
-  for t in tensors:
-    pad_widths = [(0, max_len_to_pad[i] - t.shape[i]) for i in range(dim)]
-    padded_t = np.pad(t, pad_widths, mode='constant',
-                      constant_values=t.dtype.type(0))
-    padded_tensors.append(padded_t)
-  return np.stack(padded_tensors)
+  # Write the tensors into a zero-filled batch instead of padding each one.
+  dtype = np.result_type(*[t.dtype for t in tensors])
+  padded = np.zeros((len(tensors),) + tuple(max_len_to_pad), dtype=dtype)
+  for i, t in enumerate(tensors):
+    padded[(i,) + tuple(slice(0, d) for d in t.shape)] = t
+  return padded
+
+
+def _padded_length(max_len, boundary):
+  """Length to pad a dimension of varying size to, see `pad_to_max_dims`."""
+  if boundary is None:
+    return max_len
+  cur_boundary = max(max_len, boundary)
+  if 2 * max_len < cur_boundary:
+    cur_boundary = 2**int(np.ceil(np.log2(max_len)))
+  return int(cur_boundary)
+
+
+def _fit_to_shape(batch, shape):
+  """Crops or zero-pads all but the first (batch) dimension of batch to shape."""
+  if batch.shape[1:] == shape:
+    return batch
+  fitted = np.zeros(batch.shape[:1] + shape, dtype=batch.dtype)
+  common = tuple(slice(0, min(a, b)) for a, b in zip(batch.shape[1:], shape))
+  fitted[(slice(None),) + common] = batch[(slice(None),) + common]
+  return fitted
+
+
+class _Bucket(object):
+  """Examples from one length bucket, written into preallocated batch arrays.
+
+  Each tensor of an example is copied into a zero-filled array of shape
+  [batch_size, ...] as soon as it arrives, so a full bucket is turned into a
+  batch padded exactly as `pad_to_max_dims` would do it, but without any
+  per-example padding or stacking. The capacity of the arrays is kept between
+  batches, so in the common case each batch is a single allocation.
+  """
+
+  def __init__(self, batch_size, boundary, pad_to_boundary=False):
+    self._batch_size = batch_size
+    self._boundary = boundary
+    self._pad_to_boundary = pad_to_boundary
+    self._capacity = None  # Shapes (without batch) of the arrays to allocate.
+    self._arrays = None
+    self._max_shapes = None
+    self._min_shapes = None
+    self._size = 0
+
+  def __len__(self):
+    return self._size
+
+  def add(self, example):
+    """Adds an example to the bucket, returns True if the bucket is full."""
+    example = [np.asarray(x) for x in example]
+    shapes = [np.array(x.shape, dtype=np.int64) for x in example]
+    if self._arrays is None:
+      ranks = [len(s) for s in shapes]
+      if self._capacity is None or [len(c) for c in self._capacity] != ranks:
+        self._capacity = [x.shape for x in example]
+      else:
+        self._capacity = [tuple(max(c, d) for c, d in zip(capacity, x.shape))
+                          for capacity, x in zip(self._capacity, example)]
+      self._arrays = [np.zeros((self._batch_size,) + c, dtype=x.dtype)
+                      for c, x in zip(self._capacity, example)]
+      self._max_shapes = shapes
+      self._min_shapes = [np.copy(s) for s in shapes]
+    else:
+      for i, shape in enumerate(shapes):
+        self._max_shapes[i] = np.maximum(self._max_shapes[i], shape)
+        self._min_shapes[i] = np.minimum(self._min_shapes[i], shape)
+        capacity = self._capacity[i]
+        if any(m > c for m, c in zip(self._max_shapes[i], capacity)):
+          # Grow straight to the padded length so this happens rarely.
+          self._capacity[i] = tuple(
+              c if m <= c else max(c, _padded_length(int(m), self._boundary))
+              for m, c in zip(self._max_shapes[i], capacity))
+          self._arrays[i] = _fit_to_shape(self._arrays[i], self._capacity[i])
+    for array, x in zip(self._arrays, example):
+      array[(self._size,) + tuple(slice(0, d) for d in x.shape)] = x
+    self._size += 1
+    return self._size == self._batch_size
+
+  def batch(self):
+    """Returns the padded batch of the examples so far and empties the bucket."""
+    batch = []
+    for array, max_shape, min_shape in zip(
+        self._arrays, self._max_shapes, self._min_shapes):
+      shape = tuple(
+          int(hi) if hi == lo else _padded_length(int(hi), self._boundary)
+          for hi, lo in zip(max_shape, min_shape))
+      if self._pad_to_boundary and shape:
+        shape = (max(shape[0], self._boundary),) + shape[1:]
+      batch.append(_fit_to_shape(array[:self._size], shape))
+    self._arrays = None
+    self._size = 0
+    return tuple(batch)
+
+
+def token_budget_buckets(lengths, token_budget, max_buckets=8, n_devices=1,
+                         max_candidates=256):
+  """Returns buckets for `bucket_by_length` that fit batches to a token budget.
+
+  Bucket boundaries are chosen by dynamic programming over a histogram of the
+  given example lengths to minimize the total number of padding tokens with at
+  most max_buckets buckets. To keep this fast, only up to max_candidates
+  quantiles of the lengths are considered as boundaries. One more bucket takes
+  unseen examples up to twice the longest given length. Each of these buckets
+  gets the largest batch size (divisible by n_devices) such that batch size
+  times its longest length is within token_budget, and the returned buckets end
+  with an unbounded one for even longer examples, with batch size n_devices.
+
+  With `bucket_by_length(..., pad_to_boundaries=True)`, as `batch_fn` uses it,
+  batches are padded to their bucket's longest length, so there are at most
+  max_buckets + 1 batch shapes within token_budget. Only batches of examples
+  longer than twice the given lengths are padded to a power of two and may
+  exceed the budget, and when a finite stream ends its partly filled buckets
+  are yielded as smaller batches.
+
+  Args:
+    lengths: list of example lengths, e.g., from a warmup pass over the data.
+    token_budget: int, maximum number of (padded) tokens in a batch.
+    max_buckets: int, maximum number of buckets for the observed lengths.
+    n_devices: int, batch sizes are made divisible by this number.
+    max_candidates: int, maximum number of lengths to consider as boundaries.
+
+  Returns:
+    A pair (boundaries, batch_sizes) to pass to `bucket_by_length`.
+  """
+  if not lengths:
+    raise ValueError('Need example lengths to choose buckets from.')
+  lengths = np.sort(np.asarray(lengths, dtype=np.int64))
+  quantiles = np.linspace(0.0, 1.0, max_candidates)
+  candidates = np.unique(
+      lengths[np.ceil(quantiles * (len(lengths) - 1)).astype(np.int64)])
+  n = len(candidates)
+  # Number and sum of the lengths <= each candidate, index 0 is for none.
+  counts = np.concatenate([[0], np.searchsorted(lengths, candidates, 'right')])
+  sums = np.concatenate([[0], np.cumsum(lengths)])[counts]
+  def padding(j):
+    """Padding in buckets from each candidate (exclusive) to candidate j."""
+    return ((counts[j + 1] - counts[:j + 1]) * candidates[j] -
+            (sums[j + 1] - sums[:j + 1]))
+  # cost[k, j]: least padding of lengths <= candidates[j] in k + 1 buckets.
+  cost = np.full((max_buckets, n), np.inf)
+  previous = np.zeros((max_buckets, n), dtype=np.int64)
+  for j in range(n):
+    padding_to_j = padding(j)
+    cost[0, j] = padding_to_j[0]
+    for k in range(1, max_buckets):
+      costs = cost[k - 1, :j] + padding_to_j[1:]
+      if j > 0:
+        previous[k, j] = np.argmin(costs)
+        cost[k, j] = costs[previous[k, j]]
+  k, j = int(np.argmin(cost[:, -1])), n - 1
+  max_lengths = [candidates[j]]
+  while k > 0:
+    j = previous[k, j]
+    max_lengths.append(candidates[j])
+    k -= 1
+  max_lengths = sorted(int(l) for l in max_lengths)
+
+  def batch_size(length):
+    return max(token_budget // length // n_devices, 1) * n_devices
+  # Boundaries are exclusive, longer examples go to two more buckets.
+  max_lengths_and_overflow = max_lengths + [2 * max_lengths[-1]]
+  boundaries = [l + 1 for l in max_lengths_and_overflow]
+  batch_sizes = [batch_size(l) for l in max_lengths_and_overflow]
+  batch_sizes.append(n_devices)
+  lower = 0
+  for l in max_lengths:
+    bucket_lengths = lengths[(lengths > lower) & (lengths <= l)]
+    padding_fraction = 1.0 - bucket_lengths.sum() / (len(bucket_lengths) * l)
+    logging.info('Bucket for lengths %d to %d: batch size %d, %.1f%% of '
+                 'warmup examples, padding fraction %.3f.', lower + 1, l,
+                 batch_size(l), 100.0 * len(bucket_lengths) / len(lengths),
+                 padding_fraction)
+    lower = l
+  return boundaries, batch_sizes
+
+
+def snap_to_shapes(generator, batch_shapes):
+  """Pads each batch to the smallest fitting shape from a fixed set.
+
+  The batch (first) dimension of all arrays in a batch and the length (second)
+  dimension of all 2-dimensional arrays, e.g., of tokens, are padded with
+  zeros to the smallest (by number of elements) of the given (batch size,
+  length) shapes that fits. Batches of (inputs, targets) get weights added
+  which are 0 on the padding, so padded examples do not count in the loss.
 
+  Args:
+    generator: python generator of batches.
+    batch_shapes: list of (batch size, length) pairs.
 
-def bucket_by_length(generator, length_fn, boundaries, batch_sizes):
+  Yields:
+    Padded batches, always of one of the given shapes.
+  """
+  batch_shapes = sorted(batch_shapes, key=lambda s: (s[0] * s[1], tuple(s)))
+  for batch in generator:
+    batch_size = batch[0].shape[0]
+    length = max([x.shape[1] for x in batch if x.ndim == 2], default=0)
+    fitting = [(b, l) for (b, l) in batch_shapes
+               if b >= batch_size and l >= length]
+    if not fitting:
+      raise ValueError(f'No shape in {batch_shapes} fits a batch of size '
+                       f'{batch_size} and length {length}.')
+    snapped_size, snapped_length = fitting[0]
+    def snap(x):
+      if x.ndim == 2:
+        shape = (snapped_size, snapped_length)
+      else:
+        shape = (snapped_size,) + x.shape[1:]
+      snapped = np.zeros(shape, dtype=x.dtype)
+      snapped[tuple(slice(0, d) for d in x.shape)] = x
+      return snapped
+    snapped_batch = tuple(snap(x) for x in batch)
+    if len(batch) == 2:
+      snapped_batch += (snap(np.ones(batch[1].shape, dtype=np.float32)),)
+    yield snapped_batch
+
+
+def _log_batch_stats(generator, name, log_every=1000):
+  """Logs distinct batch shapes and padding fraction per shape of batches."""
+  tokens = collections.Counter()
+  padding = collections.Counter()
+  for i, batch in enumerate(generator):
+    # Bucketed dimensions are padded with 0 like in pad_to_max_dims.
+    shape = batch[1].shape
+    if shape not in tokens:
+      logging.info('New %s batch shape %s, %d distinct shapes so far.',
+                   name, shape, len(tokens) + 1)
+    tokens[shape] += batch[1].size
+    padding[shape] += batch[1].size - np.count_nonzero(batch[1])
+    if (i + 1) % log_every == 0:
+      for shape in sorted(tokens):
+        logging.info('Padding fraction of %s batches of shape %s: %.3f.',
+                     name, shape, padding[shape] / tokens[shape])
+    yield batch
+
+
+def bucket_by_length(generator, length_fn, boundaries, batch_sizes,
+                     pad_to_boundaries=False):
   """Bucket by length, like tf.data.experimental.bucket_by_sequence_length.
 
+  Buckets are found by binary search over the boundaries and examples are
+  written directly into the preallocated batch of their bucket. Buckets that
+  are not full when the generator is exhausted are yielded at the end as
+  smaller batches, so no examples from a finite generator are dropped.
+
   Args:
     generator: python generator to draw data from.
     length_fn: a function taking the example and returning the length.
     boundaries: a list of bucket boundaries.
     batch_sizes: a list of batch sizes.
+    pad_to_boundaries: bool, if True, the first axis of the tensors in each
+      bucket but the last is always padded to the bucket boundary - 1 (or
+      more, if a tensor is longer than length_fn says), so all full batches
+      of a bucket have the same shape.
 
   Yields:
     An input batch, which comes from one of the buckets.
   """
-  buckets = [[] for _ in range(len(batch_sizes))]
-  boundaries = boundaries + [1e20]  # Max boundary is unlimited.
-  max_idx = len(boundaries)
+  n_bounded = len(boundaries)
+  boundaries = np.array(list(boundaries) + [1e20])  # Max boundary is unlimited.
+  buckets = [_Bucket(batch_size, int(boundary) - 1,
+                     pad_to_boundary=pad_to_boundaries and i < n_bounded)
+             for i, (batch_size, boundary)
+             in enumerate(zip(batch_sizes, boundaries))]
   for example in generator:
     length = length_fn(example)
-    bucket_idx = min([i for i, b in enumerate(boundaries) if length < b])
-    buckets[bucket_idx].append(example)
-    if len(buckets[bucket_idx]) == batch_sizes[bucket_idx]:
-      batch = zip(*buckets[bucket_idx])
-      boundary = boundaries[bucket_idx] - 1 if bucket_idx < max_idx else None
-      padded_batch = tuple(pad_to_max_dims(x, boundary) for x in batch)
-      yield padded_batch
-      buckets[bucket_idx] = []
+    bucket_idx = int(np.searchsorted(boundaries, length, side='right'))
+    bucket = buckets[bucket_idx]
+    if bucket.add(example):
+      yield bucket.batch()
+  for bucket in buckets:
+    if bucket:
+      yield bucket.batch()
+
+
+class Prefetcher(object):
+  """Iterator that draws batches from a stream ahead in a background thread.
+
+  Up to `buffer_size` batches are produced ahead of the consumer, so that
+  preparing the next batches on the host overlaps with computation on the
+  accelerator. An optional `transform` (e.g., reshaping by device or a
+  `jax.device_put`) is applied to each batch in the background thread too.
+  Exceptions raised by the stream are re-raised on the consumer side.
+  """
+
+  def __init__(self, stream, buffer_size=2, transform=None):
+    """Starts prefetching from the given stream.
+
+    Args:
+      stream: python iterator of batches to prefetch from.
+      buffer_size: int, maximum number of batches produced ahead.
+      transform: optional function applied to each batch before queueing it.
+    """
+    assert buffer_size > 0, f'Buffer size must be positive, is {buffer_size}'
+    self._queue = queue.Queue(maxsize=buffer_size)
+    self._stop = threading.Event()
+    self._done = False
+    self._lock = threading.Lock()
+    self._producer_stall_secs = 0.0
+    self._consumer_stall_secs = 0.0
+    self._queue_depth_sum = 0
+    self._n_batches = 0
+    self._thread = threading.Thread(target=self._produce,
+                                    args=(stream, transform))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _produce(self, stream, transform):
+    """Fills the queue with (batch, error) pairs until stopped or exhausted."""
+    try:
+      for batch in stream:
+        if transform is not None:
+          batch = transform(batch)
+        if not self._put((batch, None)):
+          return
+    except Exception as e:  # pylint: disable=broad-except
+      self._put((None, e))
+      return
+    self._put((None, StopIteration()))
+
+  def _put(self, item):
+    """Puts item on the queue, returns False if stopped while waiting."""
+    start_time = time.time()
+    while not self._stop.is_set():
+      try:
+        self._queue.put(item, timeout=_QUEUE_POLL_SECS)
+      except queue.Full:
+        continue
+      with self._lock:
+        self._producer_stall_secs += time.time() - start_time
+      return True
+    return False
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self._done:
+      raise StopIteration
+    queue_depth = self._queue.qsize()
+    start_time = time.time()
+    batch, error = self._queue.get()
+    with self._lock:
+      self._consumer_stall_secs += time.time() - start_time
+      self._queue_depth_sum += queue_depth
+      self._n_batches += 1
+    if error is not None:
+      self._done = True
+      raise error
+    return batch
+
+  def pop_stats(self):
+    """Returns prefetching statistics since the last call and resets them.
+
+    Returns:
+      A dictionary with the average number of batches ready in the queue when
+      a batch was requested, and the total number of seconds the producer
+      waited for space in the queue and the consumer waited for a batch.
+    """
+    with self._lock:
+      stats = {
+          'queue_depth': self._queue_depth_sum / max(self._n_batches, 1),
+          'producer_stall_secs': self._producer_stall_secs,
+          'consumer_stall_secs': self._consumer_stall_secs,
+      }
+      self._producer_stall_secs = 0.0
+      self._consumer_stall_secs = 0.0
+      self._queue_depth_sum = 0
+      self._n_batches = 0
+    return stats
+
+  def close(self):
+    """Stops the background thread, waits for it and drops queued batches."""
+    self._stop.set()
+    self._done = True
+    self._thread.join()
+    while not self._queue.empty():
+      self._queue.get_nowait()
+
+
+def input_shard():
+  """Returns (shard_id, n_shards) of the source data this process reads.
+
+  This is (0, 1), i.e., all of the data, except in the workers of
+  `parallel_inputs`, where sources like the datasets of `inputs` only read
+  their shard, e.g., through `shard_data(source, *input_shard())`.
+  """
+  return _input_shard
+
+
+def shard_data(generator, shard_id, n_shards):
+  """Returns every n_shards-th element of generator, starting at shard_id."""
+  assert 0 <= shard_id < n_shards, f'Invalid shard {shard_id} of {n_shards}'
+  return itertools.islice(generator, shard_id, None, n_shards)
+
+
+def _batch_to_shared_memory(batch):
+  """Copies arrays in batch to a new shared memory block, returns its specs."""
+  arrays = [np.ascontiguousarray(x) for x in batch]
+  block = shared_memory.SharedMemory(
+      create=True, size=max(sum(x.nbytes for x in arrays), 1))
+  specs, offset = [], 0
+  for x in arrays:
+    np.ndarray(x.shape, x.dtype, buffer=block.buf, offset=offset)[...] = x
+    specs.append((x.shape, x.dtype.str, offset))
+    offset += x.nbytes
+  block.close()
+  return block.name, specs
+
+
+def _batch_from_shared_memory(name, specs):
+  """Reads a batch written by `_batch_to_shared_memory` and frees the block."""
+  block = shared_memory.SharedMemory(name=name)
+  batch = tuple(
+      np.ndarray(shape, dtype, buffer=block.buf, offset=offset).copy()
+      for (shape, dtype, offset) in specs)
+  block.close()
+  block.unlink()
+  return batch
+
+
+def _free_shared_memory(name, specs):
+  """Frees a block written by `_batch_to_shared_memory` without reading it."""
+  del specs
+  block = shared_memory.SharedMemory(name=name)
+  block.close()
+  block.unlink()
+
+
+def _parallel_stream_worker(stream_fn, worker_id, n_workers, seed, out_queue,
+                            stop):
+  """Runs stream_fn in a worker process and sends batches to out_queue."""
+  random.seed(seed + worker_id)
+  np.random.seed(seed + worker_id)
+
+  def put(item):
+    """Puts item on out_queue, returns False if stopped while waiting."""
+    while not stop.is_set():
+      try:
+        out_queue.put(item, timeout=_QUEUE_POLL_SECS)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  try:
+    for batch in stream_fn(worker_id, n_workers):
+      item = _batch_to_shared_memory(batch)
+      if not put(item):
+        _free_shared_memory(*item)
+        return
+  except Exception:  # pylint: disable=broad-except
+    put(traceback.format_exc())
+    return
+  put(None)
+
+
+def _next_from_worker(worker, worker_queue):
+  """Gets the next item sent by a worker, fails if the worker died."""
+  while True:
+    try:
+      return worker_queue.get(timeout=_QUEUE_POLL_SECS)
+    except queue.Empty:
+      if not worker.is_alive():
+        try:
+          return worker_queue.get_nowait()
+        except queue.Empty:
+          raise RuntimeError(f'Input worker {worker.name} exited with code '
+                             f'{worker.exitcode} without finishing.')
+
+
+def parallel_stream(stream_fn, n_workers, seed=None, buffer_size=2,
+                    start_method='spawn'):
+  """Produces batches in n_workers processes and interleaves them.
+
+  Each worker process calls `stream_fn(worker_id, n_workers)` and iterates
+  over the returned batches (tuples of arrays). Python and NumPy random
+  generators in worker `i` are seeded with `seed + i`, so the result is
+  reproducible for a fixed seed. Batches are passed back through shared memory
+  instead of being pickled, and are yielded in round-robin order of workers.
+  If each worker reads every n_workers-th element of the same deterministic
+  source, e.g., through `shard_data(source, worker_id, n_workers)`, that
+  restores the order in which a single process would produce the batches.
+
+  Workers are started with the given multiprocessing start method. The default
+  'spawn' starts fresh interpreters, so `stream_fn` must be picklable, e.g., a
+  module-level function or a `functools.partial` of one. 'fork' does not need
+  that, but is unsupported once TensorFlow or JAX run threads in this process,
+  as the forked workers may then deadlock.
+
+  Args:
+    stream_fn: function taking worker_id and n_workers and returning a python
+      iterator of batches; called in each worker process.
+    n_workers: int, number of worker processes.
+    seed: int or None; base random seed of the workers, random if None.
+    buffer_size: int, maximum number of batches each worker produces ahead.
+    start_method: multiprocessing start method of the workers.
+
+  Yields:
+    Batches from the workers, in round-robin order.
+  """
+  assert n_workers > 0, f'Number of workers must be positive, is {n_workers}'
+  if seed is None:
+    seed = random.randint(0, 2**31 - 1 - n_workers)
+  context = multiprocessing.get_context(start_method)
+  # Workers share the resource tracker of this process, which is then notified
+  # when shared memory created in a worker is freed here.
+  resource_tracker.ensure_running()
+  stop = context.Event()
+  queues = [context.Queue(maxsize=buffer_size) for _ in range(n_workers)]
+  workers = [
+      context.Process(target=_parallel_stream_worker,
+                      args=(stream_fn, i, n_workers, seed, queues[i], stop),
+                      name=f'input_worker_{i}', daemon=True)
+      for i in range(n_workers)]
+  for worker in workers:
+    worker.start()
+  active = list(range(n_workers))
+  try:
+    while active:
+      for i in list(active):
+        item = _next_from_worker(workers[i], queues[i])
+        if item is None:  # This worker is done.
+          active.remove(i)
+        elif isinstance(item, str):
+          raise RuntimeError(f'Input worker {i} failed:\n{item}')
+        else:
+          yield _batch_from_shared_memory(*item)
+  finally:
+    # Stop the workers and free shared memory of batches not consumed yet.
+    stop.set()
+    for worker, worker_queue in zip(workers, queues):
+      while worker.is_alive() or not worker_queue.empty():
+        try:
+          item = worker_queue.get(timeout=_QUEUE_POLL_SECS)
+        except queue.Empty:
+          continue
+        if isinstance(item, tuple):
+          _free_shared_memory(*item)
+      worker.join()
+
+
+def _inputs_worker_stream(inputs_fn, config, stream_name, n_devices, shard,
+                          worker_id, n_workers):
+  """Returns a stream of `inputs_fn()` in a worker of `parallel_inputs`."""
+  global _input_shard  # pylint: disable=global-statement
+  if shard:
+    _input_shard = (worker_id, n_workers)
+  # Spawned workers start without gin bindings. Configurables the inputs do
+  # not import are not needed here, so they are skipped.
+  gin.parse_config(config, skip_unknown=True)
+  return getattr(inputs_fn(), stream_name)(n_devices)
+
+
+@gin.configurable()
+def parallel_inputs(inputs=gin.REQUIRED, n_workers=2, seed=None, shard=True):
+  """Make Inputs with streams produced in parallel by worker processes.
+
+  The workers are spawned, see `parallel_stream`, and each of them calls
+  `inputs()` again under the gin bindings of this process. So inputs must be
+  a picklable function returning Inputs, e.g., a gin reference like
+  `@trax.supervised.inputs.inputs`, and not the Inputs themselves.
+
+  If shard is True, worker i sets `input_shard()` to (i, n_workers), and
+  sharded sources, like the datasets and example caches of `inputs`, only read
+  every n_workers-th example starting at the i-th, before shuffling and
+  batching. So each worker does 1/n_workers of the input work, and together
+  they read each example once per epoch. Each worker shuffles its shard with
+  its own seed and batches from the workers are interleaved, so the order of
+  examples differs from that of a single process.
+
+  Sources that do not read `input_shard()`, e.g., randomly generated ones like
+  `sequence_copy_inputs`, and all sources if shard is False, are read in full
+  by every worker, each with differently seeded random generators.
+
+  Args:
+    inputs: picklable function returning trax.inputs.Inputs.
+    n_workers: int, number of worker processes for each stream.
+    seed: int or None; base random seed of the workers, random if None.
+    shard: bool, whether each worker reads only its shard of the source.
+
+  Returns:
+    trax.inputs.Inputs
+  """
+  if not callable(inputs):
+    raise ValueError(f'Parallel inputs need a function returning Inputs, to '
+                     f'call in the worker processes, got {inputs}.')
+  config = gin.config_str()
+
+  def parallel(stream_name):
+    def stream_fn(n_devices):
+      worker_stream = functools.partial(
+          _inputs_worker_stream, inputs, config, stream_name, n_devices, shard)
+      return parallel_stream(worker_stream, n_workers, seed=seed)
+    return stream_fn
+
+  # Only used to check for a full evaluation stream.
+  local_inputs = inputs()
+  full_eval_stream = None
+  if local_inputs.has_full_eval_stream:
+    full_eval_stream = parallel('full_eval_stream')
+  return Inputs(train_stream=parallel('train_stream'),
+                eval_stream=parallel('eval_stream'),
+                train_eval_stream=parallel('train_eval_stream'),
+                full_eval_stream=full_eval_stream)
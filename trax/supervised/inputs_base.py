@@ -0,0 +1,126 @@
+# coding=utf-8
+# Copyright 2020 The Trax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""The Inputs bundle of input streams, without TensorFlow dependencies."""
+
+
+class Inputs(object):
+  """Inputs bundle.
+
+  Inputs bundle holds input streams and shapes for a training run.
+  It contains stream-creating functions that return python generators
+  of (input_batch, target_batch) tuples.
+
+  * train_stream: training data that will be used for training
+      may include all the augmentation or selection the training wants
+      the shape of examples is [batch_fn.batch_size, ...]
+  * train_eval_stream: training data used for evaluation
+      examples from training data but usually without augmentation
+      the shape of examples is [batch_fn.eval_batch_size, ...]
+  * eval_stream: evaluation data stream
+      examples from evaluation data, usually without augmentation
+      the shape of examples is [batch_fn.eval_batch_size, ...]
+  * full_eval_stream: optional finite evaluation data stream
+      all examples from evaluation data exactly once, in batches padded to
+      full size with weights that are 0 on the padding, see `pad_batches`
+  * input_shape: the shape of inputs
+      the [...] above, without batch size
+  * input_dtype: the data type of inputs
+  * target_shape: the shape of targets
+      the [...] above, without batch size
+  * target_dtype: the data type of targets
+  """
+
+  def __init__(self, train_stream, eval_stream=None, train_eval_stream=None,
+               full_eval_stream=None):
+    """Initialize a new set of inputs.
+
+    Args:
+      train_stream: a function taking n_devices (an int) and returning
+        a python generator of training batches.
+      eval_stream: a function taking n_devices (an int) and returning
+        a python generator of validation batches;
+        if None, then the training generator will be used for evaluation.
+      train_eval_stream: a function taking n_devices (an int) and returning
+        a python generator of batches from
+        the training set used for evaluation (if None, use train_stream).
+      full_eval_stream: optional function taking n_devices (an int) and
+        returning a finite python generator of (inputs, targets, weights)
+        batches that covers the evaluation set exactly once.
+    """
+    self._train_stream = train_stream
+    self._eval_stream = eval_stream or self._train_stream
+
+    # TODO(lukaszkaiser): should we get rid of this one day?
+    self._train_eval_stream = train_eval_stream or self._train_stream
+    self._full_eval_stream = full_eval_stream
+
+    # Peek into the train stream to get an example shape, then close it so
+    # that streams with background workers (e.g., `parallel_stream`) stop them.
+    example_stream = train_stream(1)
+    example_train_batch = next(example_stream)
+    if hasattr(example_stream, 'close'):
+      example_stream.close()
+    self._input_shape = tuple(example_train_batch[0].shape)[1:]
+    self._input_dtype = example_train_batch[0].dtype
+    self._target_shape = tuple(example_train_batch[-1].shape)[1:]
+    self._target_dtype = example_train_batch[-1].dtype
+    self._example_shape = [x.shape for x in example_train_batch]
+    self._example_dtype = [x.dtype for x in example_train_batch]
+
+  def train_stream(self, n_devices):
+    return self._train_stream(n_devices)
+
+  def eval_stream(self, n_devices):
+    return self._eval_stream(n_devices)
+
+  def train_eval_stream(self, n_devices):
+    return self._train_eval_stream(n_devices)
+
+  def full_eval_stream(self, n_devices):
+    if self._full_eval_stream is None:
+      raise ValueError('These inputs have no full evaluation stream.')
+    return self._full_eval_stream(n_devices)
+
+  @property
+  def has_full_eval_stream(self):
+    """Whether the evaluation set can be streamed exactly once."""
+    return self._full_eval_stream is not None
+
+  @property
+  def input_shape(self):
+    """Example input shape, without batch dimension."""
+    return self._input_shape
+
+  @property
+  def target_shape(self):
+    """Example target shape, without batch dimension."""
+    return self._target_shape
+
+  @property
+  def input_dtype(self):
+    """Dtype of the input."""
+    return self._input_dtype
+
+  @property
+  def target_dtype(self):
+    """Dtype of the target."""
+    return self._target_dtype
+
+  @property
+  def example_shape_dtype(self):
+    """Shape and Dtype of an example batch."""
+    return self._example_shape, self._example_dtype
@@ -46,6 +46,34 @@ def _test_dataset_ints(lengths):
       generator, output_types=types, output_shapes=shapes)
 
 
+# Streams of parallel workers are module-level, so spawned workers load them.
+def _sharded_stream(worker_id, n_workers):
+  source = ((np.full((2, 3), i), np.arange(i)) for i in range(10))
+  return inputs.shard_data(source, worker_id, n_workers)
+
+
+def _random_stream(worker_id, n_workers):
+  del worker_id, n_workers
+  while True:
+    yield (np.random.randint(1000, size=(4,)),)
+
+
+def _failing_stream(worker_id, n_workers):
+  del worker_id, n_workers
+  yield (np.zeros((2,)),)
+  raise ValueError('Stream failed.')
+
+
+def _counting_inputs():
+  """Inputs of 7 batches of counts, each reading only its input shard."""
+  def stream(n_devices):
+    del n_devices
+    source = (np.full((2, 3), i) for i in range(7))
+    for x in inputs.shard_data(source, *inputs.input_shard()):
+      yield (x, x[:, 0])
+  return inputs.Inputs(stream)
+
+
 class InputsTest(tf.test.TestCase):
 
   def setUp(self):
@@ -59,6 +87,39 @@ class InputsTest(tf.test.TestCase):
     self.assertEqual(len(batch), 2)
     self.assertEqual(batch[0].shape, (10,))
 
+  def test_batch_data_keeps_remainder(self):
+    dataset = ((i, i+1) for i in range(10))
+    batches = list(inputs.batch_data(dataset, 4, drop_remainder=False))
+    self.assertEqual([b[0].shape for b in batches], [(4,), (4,), (2,)])
+
+  def test_pad_batches(self):
+    batches = [(np.ones((4, 3)), np.ones((4, 3))),
+               (np.ones((1, 3)), np.ones((1, 3))),
+               (np.ones((3, 5)), np.ones((3, 5)))]
+    padded = list(inputs.pad_batches(iter(batches), n_devices=2))
+    self.assertEqual([len(b) for b in padded], [3, 3, 3])
+    self.assertEqual([b[0].shape for b in padded], [(4, 3), (4, 3), (4, 5)])
+    self.assertEqual([float(np.sum(b[2])) for b in padded], [12.0, 3.0, 15.0])
+    self.assertEqual(float(np.sum(padded[1][0])), 3.0)
+
+  def test_full_eval_stream(self):
+    def stream(n_devices):
+      del n_devices
+      while True:
+        yield (np.ones((2, 3)), np.ones((2, 3)))
+    def full_eval_stream(n_devices):
+      return inputs.pad_batches(
+          inputs.batch_data(((np.ones(3), np.ones(3)) for _ in range(3)), 2,
+                            drop_remainder=False), n_devices)
+    without_full_eval = inputs.Inputs(stream)
+    self.assertFalse(without_full_eval.has_full_eval_stream)
+    with self.assertRaises(ValueError):
+      without_full_eval.full_eval_stream(1)
+    with_full_eval = inputs.Inputs(stream, full_eval_stream=full_eval_stream)
+    self.assertTrue(with_full_eval.has_full_eval_stream)
+    weights = [b[2] for b in with_full_eval.full_eval_stream(1)]
+    self.assertEqual([float(np.sum(w)) for w in weights], [6.0, 3.0])
+
   def test_pad_to_max_dims(self):
     tensors1 = [np.zeros((3, 10)), np.ones((3, 10))]
     padded1 = inputs.pad_to_max_dims(tensors1)
@@ -73,6 +134,225 @@ class InputsTest(tf.test.TestCase):
     padded4 = inputs.pad_to_max_dims(tensors4, 12)
     self.assertEqual(padded4.shape, (2, 4, 12))
 
+  def test_bucket_by_length(self):
+    def example_length(x):
+      return x[0].shape[0]
+    lengths = [3, 9, 4, 12, 5, 2]
+    examples = [(np.ones((l,)), np.ones((l, 2))) for l in lengths]
+    batches = list(inputs.bucket_by_length(
+        iter(examples), example_length, [8], [2, 2]))
+    self.assertLen(batches, 3)
+    # Full buckets are padded to the boundary.
+    self.assertEqual(batches[0][0].shape, (2, 7))
+    self.assertEqual(batches[0][1].shape, (2, 7, 2))
+    self.assertEqual(batches[1][0].shape, (2, 16))
+    # Padding matches pad_to_max_dims.
+    expected = inputs.pad_to_max_dims([examples[0][1], examples[2][1]], 7)
+    self.assertAllEqual(batches[0][1], expected)
+
+  def test_bucket_by_length_flushes_partial_buckets(self):
+    def example_length(x):
+      return x[0].shape[0]
+    examples = [(np.ones((l,)), np.ones((l,))) for l in [3, 4, 5, 20]]
+    batches = list(inputs.bucket_by_length(
+        iter(examples), example_length, [8], [2, 2]))
+    self.assertLen(batches, 3)
+    self.assertEqual(sum(b[0].shape[0] for b in batches), len(examples))
+
+  def test_shuffle_data_drains_buffer(self):
+    shuffled = list(inputs.shuffle_data(iter(range(20)), 8, seed=0))
+    self.assertCountEqual(shuffled, range(20))
+    self.assertNotEqual(shuffled, list(range(20)))
+
+  def test_shuffle_data_is_reproducible(self):
+    first = list(inputs.shuffle_data(iter(range(20)), 8, seed=3))
+    second = list(inputs.shuffle_data(iter(range(20)), 8, seed=3))
+    self.assertEqual(first, second)
+
+  def test_shuffle_buffer_restores_state(self):
+    expected = list(inputs.ShuffleBuffer(iter(range(30)), 8, seed=1))
+    buf = inputs.ShuffleBuffer(iter(range(30)), 8, seed=1)
+    consumed = [next(buf) for _ in range(12)]
+    restored = inputs.ShuffleBuffer(iter(range(30)), 8, seed=5)
+    restored.restore(buf.state())
+    self.assertEqual(consumed + list(restored), expected)
+
+  def test_mapped_stream_keeps_shuffle_buffer_state(self):
+    mapped = inputs.MappedStream(
+        lambda x: 2 * x, inputs.ShuffleBuffer(iter(range(30)), 8, seed=1))
+    consumed = [next(mapped) for _ in range(12)]
+    restored = inputs.MappedStream(
+        lambda x: 2 * x, inputs.ShuffleBuffer(iter(range(30)), 8, seed=5))
+    restored.restore(mapped.state())
+    expected = [2 * x for x in inputs.ShuffleBuffer(iter(range(30)), 8, seed=1)]
+    self.assertEqual(consumed + list(restored), expected)
+
+  def test_pack_data(self):
+    examples = [(np.full((l,), l), np.full((l,), l + 10)) for l in [3, 4, 2, 9]]
+    rows = list(inputs.pack_data(iter(examples), 6))
+    self.assertLen(rows, 3)
+    inp, segment_ids, positions, tgt, weights = rows[0]
+    self.assertAllEqual(inp, [3, 3, 3, 2, 2, 0])
+    self.assertAllEqual(segment_ids, [1, 1, 1, 2, 2, 0])
+    self.assertAllEqual(positions, [0, 1, 2, 0, 1, 0])
+    self.assertAllEqual(tgt, [13, 13, 13, 12, 12, 0])
+    self.assertAllEqual(weights, [1, 1, 1, 1, 1, 0])
+    # Long examples are truncated.
+    self.assertAllEqual(rows[2][0], [9] * 6)
+
+  def test_batch_fn_packs_examples(self):
+    examples = ((np.ones((l,)), np.ones((l,))) for l in [3, 4, 2, 5, 6, 1])
+    batches = inputs.batch_fn(examples, False, 1, True, eval_batch_size=2,
+                              pack_length=8)
+    batch = next(batches)
+    self.assertLen(batch, 5)
+    self.assertEqual(batch[1].shape, (2, 8))
+
+  def test_example_cache(self):
+    examples = [(np.arange(l), np.ones((l, 2), dtype=np.float32))
+                for l in [3, 1, 5]]
+    path = os.path.join(self.get_temp_dir(), 'cache')
+    self.assertEqual(inputs.ExampleCache.write(iter(examples), path), 3)
+    cache = inputs.ExampleCache(path)
+    self.assertLen(cache, 3)
+    for (cached, example) in zip([cache[i] for i in range(3)], examples):
+      self.assertAllEqual(cached[0], example[0])
+      self.assertAllEqual(cached[1], example[1])
+    stream = cache.stream(shuffle=True)
+    lengths = [next(stream)[0].shape[0] for _ in range(6)]
+    self.assertCountEqual(lengths, [3, 1, 5, 3, 1, 5])
+    shards = [cache.stream(shuffle=True, repeat=False, shard=(i, 2))
+              for i in range(2)]
+    self.assertCountEqual([x.shape[0] for (x, _) in shards[0]], [3, 5])
+    self.assertEqual([x.shape[0] for (x, _) in shards[1]], [1])
+
+  def test_example_cache_needs_local_dir(self):
+    with self.assertRaisesRegex(ValueError, 'local directory'):
+      inputs.inputs('mnist', data_dir=_TESTDATA, cache_dir='gs://bucket/cache')
+
+  def test_example_cache_refuses_random_augmentation(self):
+    gin.parse_config('shuffle_and_batch_data.preprocess_fun = '
+                     '@trax.supervised.inputs.cifar10_augmentation_preprocess')
+    with self.assertRaisesRegex(ValueError, 'augment_fn'):
+      inputs.inputs('cifar10', data_dir=_TESTDATA,
+                    cache_dir=self.get_temp_dir())
+
+  def test_token_budget_buckets(self):
+    lengths = [2, 3, 3, 4, 10, 11, 12, 30]
+    boundaries, batch_sizes = inputs.token_budget_buckets(
+        lengths, 120, max_buckets=3, n_devices=2)
+    self.assertEqual(boundaries, [5, 13, 31, 61])
+    self.assertEqual(batch_sizes, [30, 10, 4, 2, 2])
+
+  def test_bucket_by_length_pads_to_boundaries(self):
+    def example_length(x):
+      return x[0].shape[0]
+    examples = [(np.ones((l,)), np.ones((l,))) for l in [2, 3, 3, 3, 6, 9]]
+    batches = list(inputs.bucket_by_length(
+        iter(examples), example_length, [5, 9], [2, 2, 1],
+        pad_to_boundaries=True))
+    # Only the unbounded last bucket keeps the length of its examples.
+    self.assertEqual([b[0].shape for b in batches],
+                     [(2, 4), (2, 4), (1, 9), (1, 8)])
+
+  def test_batch_fn_with_token_budget(self):
+    examples = [(np.ones((l,)), np.ones((l,))) for l in [2, 3, 9, 10] * 8]
+    batches = inputs.batch_fn(iter(examples), False, 1, True,
+                              token_budget=40, max_buckets=2,
+                              length_warmup_size=8)
+    lengths = set()
+    for batch in batches:
+      self.assertLessEqual(batch[1].size, 40)
+      lengths.add(batch[1].shape[1])
+    # Batches are padded to one length per bucket.
+    self.assertLessEqual(len(lengths), 2)
+
+  def test_snap_to_shapes(self):
+    batches = [(np.ones((3, 5)), np.ones((3, 5))),
+               (np.ones((4, 9)), np.ones((4, 9))),
+               (np.ones((2, 3)), np.ones((2, 3)))]
+    snapped = list(inputs.snap_to_shapes(iter(batches), [(4, 8), (4, 16)]))
+    self.assertEqual([b[0].shape for b in snapped], [(4, 8), (4, 16), (4, 8)])
+    self.assertLen(snapped[0], 3)
+    self.assertEqual(snapped[0][2].sum(), 15)
+    self.assertEqual(snapped[0][2][3].sum(), 0)
+    with self.assertRaisesRegex(ValueError, 'No shape'):
+      next(inputs.snap_to_shapes(iter([(np.ones((2, 20)),)]), [(4, 16)]))
+
+  def test_cifar10_augment_batch(self):
+    images = np.random.uniform(size=(8, 32, 32, 3)).astype(np.float32)
+    labels = np.arange(8)
+    for use_jax in [False, True]:
+      augmented, augmented_labels = inputs.cifar10_augment_batch(
+          (images, labels), use_jax=use_jax)
+      self.assertEqual(augmented.shape, images.shape)
+      self.assertAllEqual(augmented_labels, labels)
+      # Without padding, images can only be flipped.
+      flipped, _ = inputs.cifar10_augment_batch(
+          (images, labels), padding=0, use_jax=use_jax)
+      for image, flipped_image in zip(images, np.asarray(flipped)):
+        self.assertTrue(np.array_equal(flipped_image, image) or
+                        np.array_equal(flipped_image, image[:, ::-1]))
+
+  def test_prefetcher(self):
+    prefetcher = inputs.Prefetcher(iter(range(10)), buffer_size=3,
+                                   transform=lambda x: 2 * x)
+    self.assertEqual(list(prefetcher), [2 * i for i in range(10)])
+    stats = prefetcher.pop_stats()
+    self.assertIn('queue_depth', stats)
+    self.assertGreaterEqual(stats['consumer_stall_secs'], 0.0)
+    prefetcher.close()
+
+  def test_prefetcher_reraises_errors(self):
+    def failing_stream():
+      yield 1
+      raise ValueError('Stream failed.')
+    prefetcher = inputs.Prefetcher(failing_stream())
+    self.assertEqual(next(prefetcher), 1)
+    with self.assertRaisesRegex(ValueError, 'Stream failed'):
+      next(prefetcher)
+    prefetcher.close()
+
+  def test_prefetcher_closes_endless_stream(self):
+    def endless_stream():
+      while True:
+        yield np.zeros((2, 2))
+    prefetcher = inputs.Prefetcher(endless_stream(), buffer_size=2)
+    self.assertEqual(next(prefetcher).shape, (2, 2))
+    prefetcher.close()
+    with self.assertRaises(StopIteration):
+      next(prefetcher)
+
+  def test_parallel_stream_restores_sharded_order(self):
+    batches = list(inputs.parallel_stream(_sharded_stream, 3, seed=0))
+    self.assertEqual([int(b[0][0, 0]) for b in batches], list(range(10)))
+    self.assertAllEqual(batches[5][1], np.arange(5))
+
+  def test_parallel_stream_is_reproducible(self):
+    def first_batches():
+      stream = inputs.parallel_stream(_random_stream, 2, seed=7)
+      batches = [next(stream)[0] for _ in range(4)]
+      stream.close()
+      return batches
+    self.assertAllEqual(first_batches(), first_batches())
+
+  def test_parallel_inputs_read_input_shards(self):
+    parallel = inputs.parallel_inputs(_counting_inputs, n_workers=3)
+    batches = list(parallel.train_stream(1))
+    # Each worker reads its shard of the source, so each batch comes once.
+    self.assertCountEqual([int(b[0][0, 0]) for b in batches], range(7))
+
+  def test_parallel_inputs_without_sharding(self):
+    parallel = inputs.parallel_inputs(_counting_inputs, n_workers=2,
+                                      shard=False)
+    batches = list(parallel.train_stream(1))
+    self.assertCountEqual([int(b[0][0, 0]) for b in batches],
+                          list(range(7)) * 2)
+
+  def test_parallel_stream_reraises_errors(self):
+    with self.assertRaisesRegex(RuntimeError, 'Stream failed'):
+      list(inputs.parallel_stream(_failing_stream, 2))
+
   def test_c4_preprocess(self):
     def load_c4_dataset(split='train'):
       dataset = tfds.load(
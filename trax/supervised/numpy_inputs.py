@@ -0,0 +1,162 @@
+# coding=utf-8
+# Copyright 2020 The Trax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Inputs from NumPy arrays on disk, without TensorFlow.
+
+Unlike `trax.supervised.inputs`, this module does not import TensorFlow,
+TensorFlow Datasets or Tensor2Tensor.
+"""
+
+import os
+
+import gin
+import numpy as np
+
+from trax.supervised.inputs_base import Inputs
+
+
+@gin.configurable()
+def numpy_inputs(train_path=gin.REQUIRED, eval_path=None, input_name='inputs',
+                 target_name='targets', batch_size_per_device=32,
+                 eval_batch_size=32, buckets=None, seed=None):
+  """Make Inputs from NumPy arrays on disk, without TensorFlow.
+
+  Each path is either an `.npz` file or a directory with `.npy` files (which
+  are memory-mapped), holding arrays named input_name and target_name and
+  optionally 'weights', with examples along the first axis. Batches are
+  gathered with vectorized indexing from a random permutation of the examples
+  in each epoch for training and in order for evaluation.
+
+  If buckets are given, as (boundaries, batch_sizes) like in `inputs.batch_fn`,
+  examples are bucketed by the length of their 2-dimensional targets (not
+  counting trailing zeros), and bucket batch sizes are made divisible by
+  n_devices. Targets and weights in a batch are cropped to the padded length
+  of their bucket, and 2-dimensional inputs to the padded length of the bucket
+  their longest input in the batch would fall into. Batches not filled in an
+  epoch are dropped, and the training batches from all buckets are shuffled.
+
+  Args:
+    train_path: path to the training data.
+    eval_path: optional path to the evaluation data, train_path if None.
+    input_name: name of the inputs array.
+    target_name: name of the targets array.
+    batch_size_per_device: training batch size per device.
+    eval_batch_size: evaluation batch size, made divisible by n_devices.
+    buckets: optional pair (boundaries, batch_sizes) of lists to bucket by.
+    seed: optional random seed for shuffling; if None, it is drawn from the
+      global NumPy random generator.
+
+  Returns:
+    trax.inputs.Inputs
+  """
+  if seed is None:
+    seed = np.random.randint(2**31 - 1)
+  names = (input_name, target_name, 'weights')
+  train_arrays = _load_numpy_arrays(train_path, names)
+  eval_arrays = (_load_numpy_arrays(eval_path, names) if eval_path
+                 else train_arrays)
+
+  def stream(n_devices, arrays, training):
+    if training:
+      batch_size = batch_size_per_device * n_devices
+    else:
+      batch_size = max(eval_batch_size // n_devices, 1) * n_devices
+    rng = np.random.RandomState(seed) if training else None
+    stream_buckets = None
+    if buckets:
+      boundaries, batch_sizes = buckets
+      # Make batch sizes divisible by n_devices, like inputs.batch_fn.
+      stream_buckets = (boundaries, [max(b // n_devices, 1) * n_devices
+                                     for b in batch_sizes])
+    return _numpy_batches(arrays, batch_size, rng, stream_buckets)
+
+  return Inputs(train_stream=lambda n: stream(n, train_arrays, True),
+                train_eval_stream=lambda n: stream(n, train_arrays, False),
+                eval_stream=lambda n: stream(n, eval_arrays, False))
+
+
+def _load_numpy_arrays(path, names):
+  """Loads the arrays with the given names that exist in path, see above."""
+  if path.endswith('.npz'):
+    with np.load(path) as data:
+      arrays = tuple(data[name] for name in names if name in data)
+  elif os.path.isdir(path):
+    arrays = tuple(np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                   for name in names
+                   if os.path.exists(os.path.join(path, name + '.npy')))
+  else:
+    raise ValueError(f'Expected an .npz file or a directory, got {path}.')
+  if len(arrays) < 2:
+    raise ValueError(f'Did not find arrays {names[:2]} in {path}.')
+  if len({x.shape[0] for x in arrays}) != 1:
+    raise ValueError(f'Arrays in {path} have different numbers of examples: '
+                     f'{[x.shape[0] for x in arrays]}.')
+  return arrays
+
+
+def _nonzero_lengths(x):
+  """Returns the lengths of the rows of x, not counting trailing zeros."""
+  nonzero = np.asarray(x) != 0
+  return np.where(nonzero.any(axis=1),
+                  x.shape[1] - np.argmax(nonzero[:, ::-1], axis=1), 0)
+
+
+def _padded_length(length, boundaries, max_length):
+  """Pads to boundary - 1 like inputs.bucket_by_length, up to max_length."""
+  bucket_id = np.searchsorted(boundaries, length, side='right')
+  if bucket_id == len(boundaries):
+    return max_length
+  return min(boundaries[bucket_id] - 1, max_length)
+
+
+def _numpy_batches(arrays, batch_size, rng=None, buckets=None):
+  """Yields batches of arrays endlessly, shuffled if rng is given."""
+  n_examples = arrays[0].shape[0]
+  targets = arrays[1]
+  if buckets and targets.ndim == 2:
+    lengths = _nonzero_lengths(targets)
+    boundaries, batch_sizes = buckets
+    # Weights (the third array) are cropped like the targets they weigh,
+    # inputs by their own lengths.
+    crop_lengths = [None if x.ndim != 2 else lengths if i else
+                    _nonzero_lengths(x) for (i, x) in enumerate(arrays)]
+  else:
+    lengths, boundaries, batch_sizes = None, [], [batch_size]
+    crop_lengths = [None] * len(arrays)
+  while True:
+    order = rng.permutation(n_examples) if rng else np.arange(n_examples)
+    if lengths is None:
+      bucket_ids = np.zeros((n_examples,), dtype=np.int64)
+    else:
+      bucket_ids = np.searchsorted(boundaries, lengths[order], side='right')
+    batches = []
+    for bucket_id, bucket_batch_size in enumerate(batch_sizes):
+      indices = order[bucket_ids == bucket_id]
+      n_batches = len(indices) // bucket_batch_size
+      indices = indices[:n_batches * bucket_batch_size]
+      batches.extend((bucket_id, batch_indices) for batch_indices in
+                     np.split(indices, n_batches) if n_batches)
+    if not batches:
+      raise ValueError(f'Not enough examples ({n_examples}) for a batch.')
+    if rng:
+      batches = [batches[i] for i in rng.permutation(len(batches))]
+    for (_, indices) in batches:
+      indices = np.sort(indices)  # Read memory-mapped arrays in order.
+      yield tuple(
+          x[indices] if x_lengths is None else
+          x[indices, :_padded_length(x_lengths[indices].max(), boundaries,
+                                     x.shape[1])]
+          for (x, x_lengths) in zip(arrays, crop_lengths))
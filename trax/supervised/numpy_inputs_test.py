@@ -0,0 +1,88 @@
+# coding=utf-8
+# Copyright 2020 The Trax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Tests for trax.supervised.numpy_inputs."""
+
+import itertools
+import os
+
+from absl.testing import absltest
+import numpy as np
+
+from trax.supervised import numpy_inputs as numpy_inputs_lib
+
+
+class NumpyInputsTest(absltest.TestCase):
+
+  def _targets(self):
+    targets = np.zeros((10, 8), dtype=np.int32)
+    for i in range(10):
+      targets[i, :i + 1] = 1
+    return targets
+
+  def test_numpy_inputs_from_npz(self):
+    targets = self._targets()
+    path = os.path.join(self.create_tempdir().full_path, 'data.npz')
+    np.savez(path, inputs=targets, targets=targets)
+    inputs = numpy_inputs_lib.numpy_inputs(
+        train_path=path, batch_size_per_device=2, eval_batch_size=4,
+        buckets=([4], [2, 2]), seed=0)
+    for batch in itertools.islice(inputs.train_stream(1), 10):
+      self.assertEqual(batch[0].shape[0], 2)
+      # Short examples are cropped to the bucket length.
+      if batch[1].sum() <= 6:
+        self.assertEqual(batch[1].shape, (2, 3))
+    eval_batch = next(inputs.eval_stream(1))
+    np.testing.assert_array_equal(eval_batch[1].sum(axis=1), [1, 2])
+
+  def test_numpy_inputs_from_npy_directory(self):
+    path = self.create_tempdir().full_path
+    np.save(os.path.join(path, 'inputs.npy'), np.arange(10))
+    np.save(os.path.join(path, 'targets.npy'), self._targets())
+    inputs = numpy_inputs_lib.numpy_inputs(
+        train_path=path, batch_size_per_device=5, seed=0)
+    batches = list(itertools.islice(inputs.train_stream(1), 2))
+    # One epoch has every example once, in a random order.
+    ids = np.concatenate([batch[0] for batch in batches])
+    self.assertCountEqual(ids, range(10))
+    self.assertEqual(inputs.target_shape, (8,))
+
+  def test_numpy_inputs_crop_inputs_by_their_own_length(self):
+    targets = self._targets()
+    path = os.path.join(self.create_tempdir().full_path, 'data.npz')
+    # Short targets, but inputs as long as the longest targets.
+    np.savez(path, inputs=np.ones((10, 8), dtype=np.int32),
+             targets=targets[::-1], weights=np.ones((10, 8)))
+    inputs = numpy_inputs_lib.numpy_inputs(
+        train_path=path, batch_size_per_device=2, eval_batch_size=4,
+        buckets=([4], [2, 2]), seed=0)
+    for batch in itertools.islice(inputs.train_stream(1), 10):
+      self.assertEqual(batch[0].shape, (2, 8))
+      self.assertEqual(batch[2].shape, batch[1].shape)
+      self.assertEqual(batch[1].shape[1], 3 if batch[1].sum() <= 6 else 8)
+
+  def test_numpy_inputs_bucket_batch_sizes_divisible_by_devices(self):
+    path = os.path.join(self.create_tempdir().full_path, 'data.npz')
+    np.savez(path, inputs=self._targets(), targets=self._targets())
+    inputs = numpy_inputs_lib.numpy_inputs(
+        train_path=path, batch_size_per_device=2, buckets=([4], [3, 1]),
+        seed=0)
+    batch_sizes = {batch[0].shape[0]
+                   for batch in itertools.islice(inputs.train_stream(2), 10)}
+    self.assertEqual(batch_sizes, {2})
+
+if __name__ == '__main__':
+  absltest.main()
@@ -20,13 +20,18 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+from concurrent import futures
+import contextlib
+import copy
 import functools
-import gzip as gzip_lib
 import itertools
+import json
 import os
 import pickle
 import random
+import resource
 import sys
+import threading
 import time
 
 from absl import logging
@@ -37,6 +42,7 @@ import jax
 import numpy
 import six
 import tensorflow.compat.v2 as tf
+from trax import checkpoints
 from trax import history as trax_history
 from trax import jaxboard
 from trax import layers as tl
@@ -47,6 +53,14 @@ from trax.math import numpy as np
 from trax.math import random as jax_random
 from trax.shapes import ShapeDtype
 from trax.supervised import inputs as trax_inputs
+from trax.supervised.utils import accumulate_gradients
+from trax.supervised.utils import accumulate_metrics
+from trax.supervised.utils import link_or_copy
+from trax.supervised.utils import make_trainer_state_dict
+from trax.supervised.utils import OptState
+from trax.supervised.utils import pickle_to_file
+from trax.supervised.utils import stack_batches
+from trax.supervised.utils import unpickle_from_file
 
 
 # TODO(afrozm): Maybe flatten everything from OptState into TrainerState.
@@ -55,13 +69,7 @@ TrainerState = collections.namedtuple('_TrainerState', [
     'opt_state',    # OptState.
     'history',      # trax.history.History.
     'model_state',  # Auxilliary state of the model.
-])
-
-
-OptState = collections.namedtuple('_OptState', [
-    'weights',     # Model weights.
-    'slots',       # Per-parameter optimizer state, e.g. gradient moments.
-    'opt_params',  # Optimizer (hyper)parameters, e.g. learning rate, momentum.
+    'input_state',  # State of a resumable train stream, or None.
 ])
 
 
@@ -86,29 +94,87 @@ class Trainer(object):
                checkpoints_at=None, should_save_checkpoints=True,
                should_write_summaries=True, nontrainable_param_map=None,
                id_to_mask=None,
-               metrics=None, checkpoint_highest=None, checkpoint_lowest=None):
+               metrics=None, checkpoint_highest=None, checkpoint_lowest=None,
+               prefetch_size=None, prefetch_to_device=False,
+               resume_input_stream=False, precompile_batch_shapes=None,
+               async_checkpoints=False, sharded_checkpoints=False,
+               delta_checkpoints=False, n_micro_batches=1,
+               steps_per_dispatch=1, donate_buffers=False,
+               dynamic_loss_scaling=False, shard_optimizer_state=False,
+               eval_on_device=False, cache_eval_batches=False,
+               eval_batches_on_device=False, full_eval=False,
+               log_step_times=False, profile_steps=None,
+               buffered_summaries=False):
 
     self._is_chief, self._n_devices, rng = (
         self._init_host_and_devices(n_devices, random_seed))
     self._should_save_checkpoints = should_save_checkpoints and self._is_chief
     self._checkpoints_at = checkpoints_at or []
+    misaligned_checkpoints = [step for step in self._checkpoints_at
+                              if step % steps_per_dispatch]
+    if misaligned_checkpoints:
+      raise ValueError(
+          f'Checkpoint steps {misaligned_checkpoints} are not multiples of '
+          f'steps_per_dispatch ({steps_per_dispatch}).')
+    self._steps_per_dispatch = steps_per_dispatch
+    self._donate_buffers = donate_buffers
+    self._dynamic_loss_scaling = dynamic_loss_scaling
+    self._eval_on_device = eval_on_device
+    self._cache_eval_batches = cache_eval_batches or eval_batches_on_device
+    self._eval_batches_on_device = eval_batches_on_device
+    self._full_eval = full_eval
+    if full_eval and not eval_on_device:
+      raise ValueError('Evaluating on the full eval set requires '
+                       'eval_on_device, to weigh the padded last batches.')
+    # Eval batches by eval stream name and number of steps, if cached.
+    self._eval_batches_cache = {}
     self._should_write_summaries = should_write_summaries
+    self._buffered_summaries = buffered_summaries
     if not output_dir:
       self._should_save_checkpoints = False
       self._should_write_summaries = False
     self._checkpoint_highest = checkpoint_highest
     self._checkpoint_lowest = checkpoint_lowest
     self._id_to_mask = id_to_mask
+    self._prefetch_size = prefetch_size
+    self._prefetch_to_device = prefetch_to_device
+    self._resume_input_stream = resume_input_stream
+    self._precompile_batch_shapes = precompile_batch_shapes
+    self._checkpoint_writer = _CheckpointWriter() if async_checkpoints else None
+    self._sharded_checkpoints = sharded_checkpoints or delta_checkpoints
+    self._delta_checkpoints = delta_checkpoints
+    # Seconds spent on the first training step for each batch shape, which is
+    # dominated by compilation.
+    self._compile_secs = {}
+    self._step_timer = _StepTimer(enabled=log_step_times)
+    if profile_steps is not None and not _has_trace_profiler():
+      raise ValueError(
+          'Tracing the profile_steps needs jax.profiler.start_trace and '
+          'stop_trace, which this version of JAX does not have.')
+    self._profile_steps = profile_steps
+    self._profiling = False
     self._metrics_dict = metrics if metrics is not None else _DEFAULT_METRICS
     # Inputs is either an Inputs instance or a function that returns it.
     self._inputs = inputs
     if callable(inputs):  # If we pass a function, e.g., through gin, call it.
       self._inputs = inputs()
+    if full_eval and not self._inputs.has_full_eval_stream:
+      raise ValueError('Evaluating on the full eval set requires inputs with '
+                       'a full_eval_stream.')
     # Mask id_to_mask and add weights if needed.
     # TODO(lukaszkaiser, jonni): move this out of Trainer to input processing.
     self._inputs = _add_weights_and_mask(self._inputs, id_to_mask)
     # Initialize the learning rate to a dummy value. It will be set in reset().
     opt = optimizer(learning_rate=0.0)
+    # Optimizer slots are only sharded if there is more than one device.
+    self._shard_optimizer_state = (
+        shard_optimizer_state and self._n_devices > 1)
+    if self._shard_optimizer_state and not opt.elementwise_update:
+      raise ValueError(
+          f'Sharding the optimizer state requires an optimizer that updates '
+          f'weights elementwise, but {type(opt).__name__} does not.')
+    if self._shard_optimizer_state and jax.host_count() > 1:
+      raise ValueError('Sharding the optimizer state works on one host only.')
 
     # Setup the model.
     model_train = model(mode='train')
@@ -158,8 +224,22 @@ class Trainer(object):
     # Jit model_predict and update so they're fast.
     self._jit_eval = _jit_predict_fn(
         model_predict_eval, metrics_in_parallel, self._n_devices)
+    self._jit_accumulate_metrics = _jit_accumulate_metrics_fn(
+        model_predict_eval, metrics_in_parallel, len(self._metrics),
+        self._n_devices, weighted=True)
     self._jit_update_fn = _jit_update_fn(
-        model_train, loss_fn, opt, self._n_devices)
+        model_train, loss_fn, opt, self._n_devices,
+        n_micro_batches=n_micro_batches, donate_buffers=donate_buffers,
+        dynamic_loss_scaling=dynamic_loss_scaling,
+        shard_optimizer_state=self._shard_optimizer_state)
+    self._jit_multi_step_update_fn = None
+    if steps_per_dispatch > 1:
+      self._jit_multi_step_update_fn = _jit_update_fn(
+          model_train, loss_fn, opt, self._n_devices,
+          n_micro_batches=n_micro_batches, n_steps=steps_per_dispatch,
+          donate_buffers=donate_buffers,
+          dynamic_loss_scaling=dynamic_loss_scaling,
+          shard_optimizer_state=self._shard_optimizer_state)
 
     self._model_train = model_train
     self._model_predict_eval = model_predict_eval
@@ -177,6 +257,11 @@ class Trainer(object):
     self._output_dir = None
     self._train_sw = None
     self._eval_sw = None
+    self._train_stream = None
+    self._eval_stream = None
+    self._train_eval_stream = None
+    self._input_state = None
+    self._input_states = None
     self._history = None
     self._lr_fn = None
     self._opt_state = None
@@ -231,7 +316,7 @@ class Trainer(object):
   def state(self):
     return TrainerState(
         opt_state=self._opt_state, step=self._step, history=self._history,
-        model_state=self._model_state)
+        model_state=self._model_state, input_state=self._input_state)
 
   @property
   def nontrainable_params(self):
@@ -265,27 +350,28 @@ class Trainer(object):
     # Create summary writers and history.
     if self._should_write_summaries:
       self._train_sw = jaxboard.SummaryWriter(os.path.join(output_dir, 'train'),
-                                              enable=self._is_chief)
+                                              enable=self._is_chief,
+                                              buffered=self._buffered_summaries)
       self._eval_sw = jaxboard.SummaryWriter(os.path.join(output_dir, 'eval'),
-                                             enable=self._is_chief)
-
-    # Reset the train and eval streams.
-    self._train_stream = _repeat_stream(self._inputs.train_stream,
-                                        self._n_devices)
-    # TODO(lukaszkaiser): add an option to evaluate exactly on the full eval
-    #   set by adding a padding and stopping the stream when too large.
-    self._eval_stream = _repeat_stream(
-        self._inputs.eval_stream, self._n_devices)
-    self._train_eval_stream = _repeat_stream(
-        self._inputs.train_eval_stream, self._n_devices)
+                                             enable=self._is_chief,
+                                             buffered=self._buffered_summaries)
 
     # Restore the training state.
     if output_dir is not None:
       state = load_trainer_state(output_dir, init_checkpoint)
     else:
       state = TrainerState(step=None, opt_state=None,
-                           history=trax_history.History(), model_state=None)
+                           history=trax_history.History(), model_state=None,
+                           input_state=None)
     self._step = state.step or 0
+
+    # Reset the train and eval streams; the old ones were closed above.
+    self._input_state = state.input_state
+    self._train_stream = self._train_input_stream()
+    self._eval_stream = self._input_stream(
+        self._inputs.eval_stream, self._prepare_eval_batch)
+    self._train_eval_stream = self._input_stream(
+        self._inputs.train_eval_stream, self._prepare_eval_batch)
     history = state.history
     self._lr_fn = self._lr_schedule(history)
     self._history = history
@@ -295,12 +381,25 @@ class Trainer(object):
     else:
       opt_state, model_state = self._new_opt_state_and_model_state()
       model_state = self._for_n_devices(model_state)
-    self._opt_state = OptState(*self._for_n_devices(opt_state))
+    if self._dynamic_loss_scaling:
+      opt_params = opt_state[2]
+      opt_params.setdefault('loss_scale', np.array(_INITIAL_LOSS_SCALE))
+      opt_params.setdefault('loss_scale_good_steps', np.array(0))
+    if self._shard_optimizer_state:
+      # Each device gets the slots of its shard of the weights.
+      weights, slots, opt_params = opt_state
+      slots = _shard_slots(jax.device_get(slots), self.n_devices)
+      self._opt_state = OptState(self._for_n_devices(weights), slots,
+                                 self._for_n_devices(opt_params))
+    else:
+      self._opt_state = OptState(*self._for_n_devices(opt_state))
     self._model_state = model_state
     if not state.opt_state and self._should_save_checkpoints:
       self.save_state(keep=False)
 
     self.update_nontrainable_params()
+    if self._precompile_batch_shapes:
+      self.precompile(self._precompile_batch_shapes)
 
   def train_epoch(self, n_steps, n_eval_steps):
     """Runs `n_steps` of training, with periodic logging, saving, and evals."""
@@ -310,55 +409,220 @@ class Trainer(object):
     print()  # Add visual separator in logs for start of training epoch.
     start_time = time.time()
 
-    for _ in range(n_steps):
-      batch = next(self._train_stream)
-      if self.n_devices > 1:  # TODO(lukaszkaiser): use everywhere if possible.
-        batch = _reshape_by_device(batch, self.n_devices)
-      self.train_step(batch)
+    timer = self._step_timer
+    n_steps_left = n_steps
+    while n_steps_left > 0:
+      self._update_profiler()
+      # Multi-step dispatches start at multiples of steps_per_dispatch, so
+      # they end at those steps too and checkpoints there are not skipped.
+      k = self._steps_per_dispatch
+      if k > 1 and self._step % k == 0 and n_steps_left >= k:
+        with timer.time('input_wait'):
+          batches = [self._next_train_batch() for _ in range(k)]
+        self.train_steps(batches)
+      else:
+        k = 1
+        with timer.time('input_wait'):
+          batch = self._next_train_batch()
+        self.train_step(batch)
+      n_steps_left -= k
       if self._should_save_now():
-        self.save_state(keep=True)
+        with timer.time('checkpoint'):
+          self.save_state(keep=True)
       if self._should_log_now():
-        for (name, value) in self.nontrainable_params.items():
-          self._train_sw.scalar('training/{}'.format(name), value)
+        with timer.time('logging'):
+          for (name, value) in self.nontrainable_params.items():
+            self._train_sw.scalar('training/{}'.format(name), value)
+    self._update_profiler()
 
     # At end of n_steps, do bookkeeping, run evals, and save state.
     elapsed_time = time.time() - start_time
     self.log_step('Ran %d train steps in %0.2f secs' % (n_steps, elapsed_time))
+    with timer.time('logging'):
+      self._log_epoch_stats(n_steps, elapsed_time)
+    with timer.time('eval'):
+      self.evaluate(n_eval_steps)
+    if self._eval_sw:
+      self._eval_sw.flush()
+    with timer.time('checkpoint'):
+      if self._should_save_checkpoints:
+        self.save_state(keep=False)
+      if (self._should_save_checkpoints and
+          self._current_step_is_best(high=True)):
+        self.save_state(keep=False,
+                        prefix='highest_' + self._checkpoint_highest)
+      if (self._should_save_checkpoints and
+          self._current_step_is_best(high=False)):
+        self.save_state(keep=False, prefix='lowest_' + self._checkpoint_lowest)
+    if timer.enabled:
+      self._log_step_times(n_steps, time.time() - start_time)
+
+  def _log_epoch_stats(self, n_steps, elapsed_time):
+    """Writes the speed, compilation, memory and input stats of an epoch."""
     if self._train_sw and n_steps > 1:
       self._train_sw.scalar('training/steps per second',
                             n_steps / elapsed_time, step=self._step)
+      self._train_sw.scalar('training/compiled_shapes',
+                            len(self._compile_secs), step=self._step)
+      self._train_sw.scalar('training/compile_secs',
+                            sum(self._compile_secs.values()), step=self._step)
+      for (name, value) in memory_stats().items():
+        self._train_sw.scalar('training/' + name, value, step=self._step)
+      if isinstance(self._train_stream, trax_inputs.Prefetcher):
+        for (name, value) in self._train_stream.pop_stats().items():
+          self._train_sw.scalar('training/input_' + name, value,
+                                step=self._step)
       self._train_sw.flush()
-    self.evaluate(n_eval_steps)
-    if self._eval_sw:
-      self._eval_sw.flush()
-    if self._should_save_checkpoints:
-      self.save_state(keep=False)
-    if self._should_save_checkpoints and self._current_step_is_best(high=True):
-      self.save_state(keep=False, prefix='highest_' + self._checkpoint_highest)
-    if self._should_save_checkpoints and self._current_step_is_best(high=False):
-      self.save_state(keep=False, prefix='lowest_' + self._checkpoint_lowest)
+
+  def _log_step_times(self, n_steps, elapsed_time):
+    """Writes the step time breakdown of an epoch, see `log_step_times`.
+
+    The seconds spent in each phase and the batch shape counts are written as
+    'timing/' scalars to the training summaries and appended as one JSON line
+    to `output_dir/step_times.jsonl`.
+
+    Args:
+      n_steps: int, the number of training steps in the epoch.
+      elapsed_time: float, the wall time of the epoch in seconds.
+    """
+    stats = self._step_timer.pop_stats()
+    if self._train_sw:
+      for (name, value) in stats.items():
+        self._train_sw.scalar('timing/' + name, value, step=self._step)
+      self._train_sw.flush()
+    if self._output_dir is not None and self._is_chief:
+      record = dict(step=self._step, n_steps=n_steps, epoch_secs=elapsed_time,
+                    **stats)
+      path = os.path.join(self._output_dir, 'step_times.jsonl')
+      with tf.io.gfile.GFile(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+  def _update_profiler(self):
+    """Starts or stops the profiler trace at the steps in profile_steps."""
+    if self._profile_steps is None or self._output_dir is None:
+      return
+    start, stop = self._profile_steps
+    if not self._profiling and start <= self._step < stop:
+      log('Starting profiler trace at step %d.' % self._step, stdout=False)
+      jax.profiler.start_trace(os.path.join(self._output_dir, 'profile'))
+      self._profiling = True
+    elif self._profiling and self._step >= stop:
+      self._stop_profiler()
+
+  def _stop_profiler(self):
+    if self._profiling:
+      _block_until_ready(self._opt_state.weights)
+      jax.profiler.stop_trace()
+      self._profiling = False
+      log('Stopped profiler trace at step %d.' % self._step, stdout=False)
 
   def train_step(self, batch):
     """Run one training step and update self._opt_state."""
-    # Calculate the current optimizer parameters.
-    # TODO(pkozakowski): Optimizer parameters get polluted with model state,
-    # which doesn't break anything but is weird. Filter it out.
-    opt_param_updates = self._for_n_devices(
-        math.nested_map(np.array, self.nontrainable_params))
-    opt_state = self._opt_state
-    opt_state.opt_params.update(opt_param_updates)
+    opt_state = self._updated_opt_state()
 
     # Run the update.
-    (weights, slots, stat), self._model_state, self._rngs = self._jit_update_fn(
-        self._step, opt_state, batch, self._model_state, self._rngs)
+    batch_shape = tuple(x.shape for x in batch)
+    batch = self._transfer_batch(batch)
+    start_time = time.time()
+    with self._step_timer.time('step'):
+      (weights, slots, stat), self._model_state, self._rngs = (
+          self._jit_update_fn(self._step, opt_state, batch, self._model_state,
+                              self._rngs))
+      if self._step_timer.enabled:
+        _block_until_ready(weights)
+    self._count_batch_shape(batch_shape, time.time() - start_time)
     self._model_state = self._map_to_state_dicts(self._state_dicts_update)
     self._opt_state = opt_state._replace(weights=weights, slots=slots)
+    if self._dynamic_loss_scaling:
+      self._opt_state.opt_params.update(
+          loss_scale=stat['loss_scale'],
+          loss_scale_good_steps=stat['loss_scale_good_steps'])
     if self._should_log_now():
-      for name, value in stat.items():
-        scalar_value = np.mean(value)  # On  multiple devices, take the mean.
-        self._train_sw.scalar('training/' + name, scalar_value, step=self._step)
+      with self._step_timer.time('logging'):
+        for name, value in stat.items():
+          scalar_value = np.mean(value)  # On  multiple devices, take the mean.
+          self._train_sw.scalar('training/' + name, scalar_value,
+                                step=self._step)
     self._step += 1
 
+  def train_steps(self, batches):
+    """Runs len(batches) training steps with a single call to the device.
+
+    The batches are stacked and the steps run in a `math.scan` inside one
+    compiled function, with nontrainable parameters (e.g., the learning rate)
+    computed for every step up front. This saves dispatch overhead for small
+    models. Requires steps_per_dispatch == len(batches).
+
+    Args:
+      batches: list of steps_per_dispatch batches.
+    """
+    n_steps = len(batches)
+    assert n_steps == self._steps_per_dispatch
+    opt_state = self._updated_opt_state()
+    steps = range(self._step, self._step + n_steps)
+    with math.use_backend('numpy'):
+      step_params = [self._lr_fn(step) for step in steps]
+    step_opt_params = self._for_n_devices(
+        {name: np.array([params[name] for params in step_params])
+         for name in step_params[0]})
+    # Stack after the device axis, which pmap maps over.
+    stack_axis = 0 if self.n_devices == 1 else 1
+    batch = tuple(np.stack(xs, axis=stack_axis) for xs in zip(*batches))
+
+    batch_shape = tuple(x.shape for x in batch)
+    batch = self._transfer_batch(batch)
+    start_time = time.time()
+    with self._step_timer.time('step'):
+      (weights, slots, stats), self._model_state, self._rngs = (
+          self._jit_multi_step_update_fn(self._step, opt_state, batch,
+                                         self._model_state, self._rngs,
+                                         step_opt_params))
+      if self._step_timer.enabled:
+        _block_until_ready(weights)
+    self._count_batch_shape(batch_shape, time.time() - start_time)
+    self._model_state = self._map_to_state_dicts(self._state_dicts_update)
+    self._opt_state = opt_state._replace(weights=weights, slots=slots)
+    if self._dynamic_loss_scaling:
+      # The scale is updated after each step; keep the one after the last.
+      self._opt_state.opt_params.update(
+          loss_scale=stats['loss_scale'][..., -1],
+          loss_scale_good_steps=stats['loss_scale_good_steps'][..., -1])
+    with self._step_timer.time('logging'):
+      for i, step in enumerate(steps):
+        if self._should_log_now(step):
+          for name, value in stats.items():
+            # Stats are stacked over steps on the last axis (after devices).
+            scalar_value = np.mean(value[..., i])
+            self._train_sw.scalar('training/' + name, scalar_value, step=step)
+    self._step += n_steps
+
+  def _transfer_batch(self, batch):
+    """Moves the batch to the device, timed separately if logging step times.
+
+    Only done when logging step times on one device with JAX; otherwise the
+    batch is transferred as part of the step.
+    """
+    if (not self._step_timer.enabled or self.n_devices > 1 or
+        math.backend_name() != 'jax'):
+      return batch
+    with self._step_timer.time('transfer'):
+      batch = jax.device_put(batch)
+      _block_until_ready(batch)
+    return batch
+
+  def _count_batch_shape(self, batch_shape, secs):
+    """Counts a step as one with a new or an already seen batch shape.
+
+    The first step with a new batch shape usually compiles the update, so its
+    time is logged as the compile time of that shape. These are not counts of
+    actual XLA compilations, which can also happen for other reasons.
+    """
+    if batch_shape in self._compile_secs:
+      self._step_timer.count('seen_batch_shapes')
+    else:
+      self._step_timer.count('new_batch_shapes')
+      self._log_compile(batch_shape, secs)
+
   def evaluate(self, n_eval_steps):
     """Evaluate the model and log metrics."""
     _, rng = jax_random.split(self._rngs[0])
@@ -368,12 +632,13 @@ class Trainer(object):
     weights = (self._opt_state[0][0], self._metrics_weights)
     state = (self._model_state[0], self._metrics_state)
     self.log_step('Evaluation')
-    train_eval_slice = itertools.islice(self._train_eval_stream, n_eval_steps)
-    train_metrics, _ = self.evaluation_round(train_eval_slice, weights, state,
-                                             rng)
+    train_eval_batches, stacked = self._eval_batches('train', n_eval_steps)
+    train_metrics, _ = self.evaluation_round(train_eval_batches, weights, state,
+                                             rng, stacked=stacked)
     self.log_metrics(train_metrics, self._train_sw, 'train')
-    eval_slice = itertools.islice(self._eval_stream, n_eval_steps)
-    eval_metrics, _ = self.evaluation_round(eval_slice, weights, state, rng)
+    eval_batches, stacked = self._eval_batches('eval', n_eval_steps)
+    eval_metrics, _ = self.evaluation_round(eval_batches, weights, state, rng,
+                                            stacked=stacked)
     self.log_metrics(eval_metrics, self._eval_sw, 'eval')
     self.log_step('Finished evaluation')
 
@@ -382,20 +647,79 @@ class Trainer(object):
       self._history.append('train', 'training/{}'.format(name), self._step,
                            value)
 
-  def evaluation_round(self, inputs_stream, weights, state, rng):
+  def _eval_batches(self, name, n_eval_steps):
+    """Returns the batches to evaluate on from the named eval stream.
+
+    These are n_eval_steps batches, or with full_eval all batches of the full
+    eval stream for 'eval'. With cache_eval_batches, the batches are read once
+    (and stacked if evaluating on device) and the same ones are returned in
+    every evaluation; with eval_batches_on_device they are also kept on the
+    device if there is one device.
+
+    Args:
+      name: 'train' for the train_eval stream or 'eval' for the eval stream.
+      n_eval_steps: int, the number of batches.
+
+    Returns:
+      A pair (batches, stacked), where stacked tells if the batches are
+      already stacked by `stack_batches`.
+    """
+    key = (name, n_eval_steps)
+    if key in self._eval_batches_cache:
+      return self._eval_batches_cache[key], self._eval_on_device
+    if name == 'eval' and self._full_eval:
+      batches = map(self._prepare_eval_batch,
+                    self._inputs.full_eval_stream(self.n_devices))
+    else:
+      stream = self._train_eval_stream if name == 'train' else self._eval_stream
+      batches = itertools.islice(stream, n_eval_steps)
+    if not self._cache_eval_batches:
+      return batches, False
+    if self._eval_on_device:
+      batches = stack_batches(batches, self.n_devices)
+    else:
+      batches = list(batches)
+    if (self._eval_batches_on_device and self.n_devices == 1 and
+        math.backend_name() == 'jax'):
+      batches = jax.device_put(batches)
+    self._eval_batches_cache[key] = batches
+    return batches, self._eval_on_device
+
+  def evaluation_round(self, inputs_stream, weights, state, rng, stacked=False):
     """Evaluate.
 
+    With eval_on_device, the batches are stacked (grouped by shape) and the
+    weighted sums of the metrics over them are accumulated on the device, see
+    `accumulate_metrics`, with one transfer at the end. Batches then count by
+    the sum of their weights, so the metrics are averages over all examples.
+
     Args:
       inputs_stream: iterable of inputs to evaluate on.
       weights: weights for each f in eval_fns.
       state: state for each f in eval_fns.
       rng: random number generator.
+      stacked: bool; if True, inputs_stream is a list of batches already
+        stacked by `stack_batches`, only used with eval_on_device.
 
     Returns:
       metrics: dict from metric name to metric value averaged over the number of
         inputs.
       state: end state for `predict_fn`.
     """
+    if self._eval_on_device:
+      stacked_batches = inputs_stream
+      if not stacked:
+        stacked_batches = stack_batches(inputs_stream, self.n_devices)
+      if not stacked_batches:
+        return {}, state
+      sums, total = 0.0, 0.0
+      for batches in stacked_batches:
+        rng, subrng = jax_random.split(rng)
+        batch_sums, batch_total = self._jit_accumulate_metrics(
+            batches, weights, state, subrng)
+        sums, total = sums + batch_sums, total + batch_total
+      sums, total = jax.device_get((sums, total))
+      return {m: float(v) / total for (m, v) in zip(self._metrics, sums)}, state
     metrics = collections.defaultdict(float)
     count = 0
     for inp in inputs_stream:
@@ -410,6 +734,59 @@ class Trainer(object):
         metrics[m] += v
     return {m: v / count for (m, v) in six.iteritems(metrics)}, state
 
+  def precompile(self, batch_shapes, n_threads=None):
+    """Compiles the train and eval steps for the given batch shapes ahead.
+
+    Batches of each (batch size, length) shape, as produced by
+    `trax_inputs.snap_to_shapes`, are run through the train and eval steps
+    once, in up to n_threads threads at a time, and the results are dropped.
+
+    Args:
+      batch_shapes: list of (batch size, length) pairs.
+      n_threads: how many shapes to compile at a time; by default all of them,
+        up to the number of CPUs.
+
+    Returns:
+      A dict from batch shapes to the seconds it took to compile them.
+    """
+    opt_state = self._updated_opt_state()
+    eval_weights = (opt_state[0][0], self._metrics_weights)
+    eval_state = (self._model_state[0], self._metrics_state)
+    _, eval_rng = jax_random.split(self._rngs[0])
+
+    def compile_shape(batch_shape):
+      update_opt_state, update_model_state = opt_state, self._model_state
+      if self._donate_buffers:
+        # The update consumes the buffers it is given, so give it copies.
+        update_opt_state, update_model_state = jax.tree_util.tree_map(
+            np.array, (opt_state, self._model_state))
+      batch_size, length = batch_shape
+      shapes, dtypes = self._inputs.example_shape_dtype
+      batch = tuple(
+          numpy.zeros((batch_size, length) if len(shape) == 2
+                      else (batch_size,) + tuple(shape[1:]), dtype=dtype)
+          for (shape, dtype) in zip(shapes, dtypes))
+      train_batch = self._prepare_train_batch(batch)
+      start_time = time.time()
+      self._jit_update_fn(
+          self._step, update_opt_state, train_batch, update_model_state,
+          self._rngs)
+      self._jit_eval(self._prepare_eval_batch(batch), eval_weights, eval_state,
+                     eval_rng)
+      return tuple(x.shape for x in train_batch), time.time() - start_time
+
+    n_threads = n_threads or min(len(batch_shapes), os.cpu_count() or 1)
+    if self._donate_buffers:
+      n_threads = 1  # Don't keep more than one copy of the state at a time.
+    start_time = time.time()
+    with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+      compiled = list(executor.map(compile_shape, batch_shapes))
+    for (batch_shape, secs) in compiled:
+      self._log_compile(batch_shape, secs)
+    self.log_step('Compiled %d batch shapes in %0.2f secs' % (
+        len(batch_shapes), time.time() - start_time))
+    return {tuple(s): secs for (s, (_, secs)) in zip(batch_shapes, compiled)}
+
   def update_model_state(self, key, value):
     """Updates model state based on nontrainable_params."""
     # Translate model state keys to nontrainable param names.
@@ -440,43 +817,115 @@ class Trainer(object):
               jaxboard.markdownify_operative_config_str(config_str))
 
   def _save_state_dict(self, trainer_state_dict, weights_file):
-    pickle_to_file(trainer_state_dict, weights_file)
+    if self._delta_checkpoints:
+      n_written = checkpoints.save(trainer_state_dict, weights_file,
+                                   blob_dir=self._blob_dir)
+      logging.info('Wrote %d changed leaves to %s', n_written, weights_file)
+    elif self._sharded_checkpoints:
+      checkpoints.save(trainer_state_dict, weights_file)
+    else:
+      pickle_to_file(trainer_state_dict, weights_file)
     log('Model saved to %s' % weights_file, stdout=False)
 
   def save_state(self, keep, prefix='model'):
-    """Save trainer state given a possibly replicated opt_state."""
+    """Save trainer state given a possibly replicated opt_state.
+
+    The state is always copied to host memory first. With async_checkpoints,
+    it is then written in a background thread while training continues; at
+    most one checkpoint is written at a time, so this waits for the previous
+    one to finish. If keep is True, the state is written once to the file for
+    the current step and the latest checkpoint is linked to it. With
+    sharded_checkpoints, checkpoints are directories in the format of
+    `trax.checkpoints` instead of pickle files. With delta_checkpoints, their
+    arrays are stored in `output_dir/blobs` and only written if they changed
+    since an earlier checkpoint; after each save, blobs not used by any
+    checkpoint left in output_dir (e.g., those of the overwritten one, or of
+    deleted old ones) are removed.
+
+    Args:
+      keep: bool, whether to also keep the checkpoint for the current step.
+      prefix: prefix of the checkpoint file names.
+    """
     opt_state = self._opt_state
-    if self.n_devices > 1:
+    if self._shard_optimizer_state:
+      first_replica = lambda x: x[0]
+      opt_state = opt_state._replace(
+          weights=math.nested_map(first_replica, opt_state.weights),
+          opt_params=math.nested_map(first_replica, opt_state.opt_params))
+    elif self.n_devices > 1:
       first_replica = lambda x: x[0]
       opt_state = OptState(*math.nested_map(first_replica, opt_state))
+    step, history, model_state = self._step, self._history, self._model_state
     # This line, while optional, allows JAX to transfer arrays from the device
     # to the host in parallel, which is particularly important for cloud TPU.
     if math.backend_name() == 'jax':
-      opt_state = jax.device_get(opt_state)
-    step, history, model_state = self._step, self._history, self._model_state
+      opt_state, model_state = jax.device_get((opt_state, model_state))
+    if self._shard_optimizer_state:
+      # Checkpoints have the slots unsharded, as without sharding.
+      opt_state = opt_state._replace(
+          slots=_unshard_slots(opt_state.slots, opt_state.weights))
     output_dir = self._output_dir
 
-    weights_file = os.path.join(output_dir, prefix + '.pkl')
+    extension = _SHARDED_EXTENSION if self._sharded_checkpoints else '.pkl'
+    weights_file = os.path.join(output_dir, prefix + extension)
 
+    if self._checkpoint_writer is not None:
+      # History keeps changing during training, so write a copy of it.
+      history = copy.deepcopy(history)
+      if math.backend_name() != 'jax':
+        # So do the optimizer parameters, which device_get copies under JAX.
+        opt_state = opt_state._replace(opt_params=dict(opt_state.opt_params))
     # This dict will be stored as the model.
     trainer_state_dict = make_trainer_state_dict(step,
                                                  opt_state,
                                                  history,
-                                                 model_state)
-    self._save_state_dict(trainer_state_dict, weights_file)
+                                                 model_state,
+                                                 self._input_state)
+
+    def write():
+      if keep:
+        step_file = os.path.join(
+            output_dir, '{}_{}{}'.format(prefix, step, extension))
+        self._save_state_dict(trainer_state_dict, step_file)
+        if self._sharded_checkpoints:
+          checkpoints.link(step_file, weights_file)
+        else:
+          link_or_copy(step_file, weights_file)
+      else:
+        self._save_state_dict(trainer_state_dict, weights_file)
+      if self._delta_checkpoints:
+        self._collect_garbage()
 
-    if keep:
-      weights_file = os.path.join(output_dir, '{}_{}.pkl'.format(prefix, step))
-      self._save_state_dict(trainer_state_dict, weights_file)
+    if self._checkpoint_writer is not None:
+      self._checkpoint_writer.write(write)
+    else:
+      write()
+
+  @property
+  def _blob_dir(self):
+    return os.path.join(self._output_dir, 'blobs')
+
+  def _collect_garbage(self):
+    """Removes blobs not used by delta checkpoints in output_dir anymore."""
+    pattern = os.path.join(self._output_dir, '*' + _SHARDED_EXTENSION)
+    paths = [path for path in tf.io.gfile.glob(pattern)
+             if checkpoints.is_sharded(path)]
+    n_deleted = checkpoints.collect_garbage(self._blob_dir, paths)
+    if n_deleted:
+      logging.info('Deleted %d unused arrays from %s', n_deleted,
+                   self._blob_dir)
+
+  def wait_for_checkpoints(self):
+    """Waits until checkpoints written in the background are saved."""
+    if self._checkpoint_writer is not None:
+      self._checkpoint_writer.wait()
 
   def save_computation_graphs(self, save_backward_graph):
     """Dump computation graphs to files."""
     if self.n_devices != 1:
       return  # TODO(lukaszkaiser): make this work with more devices.
-    batch = next(self._train_stream)
+    batch = self._next_train_batch()
     output_dir = self._output_dir
-    if self.n_devices > 1:
-      batch = _reshape_by_device(batch, self.n_devices)
     weights = self._opt_state[0][0]
     forward_computation = jax.xla_computation(self._model_predict_eval)(
         batch, weights=weights, state=self._model_state[0],
@@ -574,6 +1023,100 @@ class Trainer(object):
     value = state_dict[key]
     return {key: self.update_model_state(key, value)}
 
+  def _updated_opt_state(self):
+    """Returns the optimizer state with current nontrainable parameters."""
+    # TODO(pkozakowski): Optimizer parameters get polluted with model state,
+    # which doesn't break anything but is weird. Filter it out.
+    opt_param_updates = self._for_n_devices(
+        math.nested_map(np.array, self.nontrainable_params))
+    opt_state = self._opt_state
+    opt_state.opt_params.update(opt_param_updates)
+    return opt_state
+
+  def _log_compile(self, batch_shape, secs):
+    self._compile_secs[batch_shape] = secs
+    log('Compiled batch shapes %s in %0.2f secs (%d shapes compiled)' % (
+        batch_shape, secs, len(self._compile_secs)), stdout=False)
+
+  def _train_input_stream(self):
+    """Returns the stream of train batches, resumed if requested.
+
+    With resume_input_stream, a resumable train stream (one with `state` and
+    `restore` methods, like `inputs.ShuffleBuffer`) is restored from the
+    input state saved in the checkpoint. Its state after each batch is queued
+    when the batch is read, and `_next_train_batch` keeps the state after the
+    last batch actually trained on, also when prefetching runs ahead. Other
+    streams, and checkpoints without input state, are replayed instead,
+    skipping the batches trained on before the restart. Both re-read the
+    source up to the restored position, which takes O(steps) input work.
+    """
+    self._input_states = None
+    stream = self._inputs.train_stream(self._n_devices)
+    batches = itertools.chain(
+        stream, _repeat_stream(self._inputs.train_stream, self._n_devices))
+    if not self._resume_input_stream:
+      self._input_state = None
+      return self._prefetch(batches, self._prepare_train_batch)
+    if hasattr(stream, 'state') and hasattr(stream, 'restore'):
+      self._input_states = collections.deque()
+      batches = _stream_with_states(stream, self._input_states,
+                                    self._inputs.train_stream, self._n_devices)
+      if self._input_state is not None:
+        log('Restoring the input stream state from step %d.' % self._step,
+            stdout=False)
+        stream.restore(self._input_state)
+        return self._prefetch(batches, self._prepare_train_batch)
+    self._input_state = None
+    if self._step:
+      log('Skipping the %d batches of inputs seen before step %d.' % (
+          self._step, self._step), stdout=False)
+      for _ in range(self._step):
+        next(batches)
+      if self._input_states is not None:
+        self._input_states.clear()
+    return self._prefetch(batches, self._prepare_train_batch)
+
+  def _next_train_batch(self):
+    """Returns the next train batch and keeps the input state after it."""
+    batch = next(self._train_stream)
+    if self._input_states is not None:
+      self._input_state = self._input_states.popleft()
+    return batch
+
+  def _input_stream(self, stream_fn, transform):
+    """Returns an endless stream of batches, prefetched if requested."""
+    return self._prefetch(_repeat_stream(stream_fn, self._n_devices),
+                          transform)
+
+  def _prefetch(self, stream, transform):
+    """Maps transform over stream, ahead of time in a thread if requested."""
+    if self._prefetch_size:
+      return trax_inputs.Prefetcher(stream, self._prefetch_size, transform)
+    return map(transform, stream)
+
+  def _close_streams(self):
+    """Stops the prefetching threads of the input streams and drops them."""
+    for stream in (self._train_stream, self._eval_stream,
+                   self._train_eval_stream):
+      if isinstance(stream, trax_inputs.Prefetcher):
+        stream.close()
+    self._train_stream = None
+    self._eval_stream = None
+    self._train_eval_stream = None
+
+  def _prepare_eval_batch(self, batch):
+    """Moves the batch to the device if prefetching to device on 1 device."""
+    if (self._prefetch_size and self._prefetch_to_device and
+        self.n_devices == 1 and math.backend_name() == 'jax'):
+      batch = jax.device_put(batch)
+    return batch
+
+  def _prepare_train_batch(self, batch):
+    """Reshapes the batch by device or moves it to the device if requested."""
+    if self.n_devices > 1:  # TODO(lukaszkaiser): use everywhere if possible.
+      return _reshape_by_device(batch, self.n_devices)
+    return self._prepare_eval_batch(batch)
+
   def _should_save_now(self):
     return self._should_save_checkpoints and self._step in self._checkpoints_at
 
@@ -582,23 +1125,25 @@ class Trainer(object):
     metric = self._checkpoint_highest if high else self._checkpoint_lowest
     if metric is None:
       return False
-    # History is a list of pairs (step, value).
-    history = self._history.get('eval', 'metrics/' + metric)
-    sequence = [float(i[1]) for i in history]  # Just the values.
-    best = max(sequence) if high else min(sequence)  # Best value.
-    last_is_best = float(history[-1][1]) == best  # Is last the best?
-    cur_step = history[-1][0] == self._step  # Is last the current step?
+    steps, values = self._history.steps_and_values('eval', 'metrics/' + metric)
+    values = values.astype(numpy.float64)
+    best = values.max() if high else values.min()  # Best value.
+    last_is_best = values[-1] == best  # Is last the best?
+    cur_step = steps[-1] == self._step  # Is last the current step?
     return cur_step and last_is_best
 
-  def _should_log_now(self):
-    return (self._train_sw is not None
-            and (self._step == 1 or self._step % 10 == 0))
+  def _should_log_now(self, step=None):
+    step = self._step if step is None else step
+    return self._train_sw is not None and (step == 1 or step % 10 == 0)
 
   def _for_n_devices(self, x):
     """Replicates/broadcasts `x` for n devices if `self.n_devicess > 1`."""
     return tl.for_n_devices(x, self.n_devices)  # pylint: disable=protected-access
 
   def close(self):
+    self._stop_profiler()
+    self.wait_for_checkpoints()
+    self._close_streams()
     if self._train_sw is not None:
       self._train_sw.close()
       self._train_sw = None
@@ -627,7 +1172,26 @@ def train(output_dir,
           metrics=None,
           checkpoint_highest=None,
           checkpoint_lowest=None,
-          custom_train_fn=None):
+          custom_train_fn=None,
+          prefetch_size=None,
+          prefetch_to_device=False,
+          resume_input_stream=False,
+          precompile_batch_shapes=None,
+          async_checkpoints=False,
+          sharded_checkpoints=False,
+          delta_checkpoints=False,
+          n_micro_batches=1,
+          steps_per_dispatch=1,
+          donate_buffers=False,
+          dynamic_loss_scaling=False,
+          shard_optimizer_state=False,
+          eval_on_device=False,
+          cache_eval_batches=False,
+          eval_batches_on_device=False,
+          full_eval=False,
+          log_step_times=False,
+          profile_steps=None,
+          buffered_summaries=False):
   """Train the model on the inputs.
 
   Args:
@@ -657,6 +1221,75 @@ def train(output_dir,
     checkpoint_highest: save the checkpoint highest at this metric.
     checkpoint_lowest: save the checkpoint lowest at this metric.
     custom_train_fn: custom train function to call, entirely bypassing this one
+    prefetch_size: int or None; if set, prepare this many batches ahead of
+      training and evaluation in a background thread.
+    prefetch_to_device: bool, if True (and prefetching on a single device),
+      also transfer the prefetched batches to the device in the background.
+    resume_input_stream: bool, if True, training restored from a checkpoint
+      continues with the same batches as an uninterrupted run would: a
+      resumable train stream (e.g., the `inputs.ShuffleBuffer` of `batch_fn`)
+      is restored from its state saved in the checkpoint, and other streams
+      skip the batches trained on before (given a fixed random_seed). Either
+      way the stream below the restored state is read again from its start
+      and the batches read before are dropped, so restarting costs as much
+      input work as the training steps so far did.
+    precompile_batch_shapes: optional list of (batch size, length) pairs to
+      compile the train and eval steps for before training; use together with
+      the same `batch_fn.batch_shapes`, e.g., through a gin macro.
+    async_checkpoints: bool, if True, write checkpoints in a background thread
+      while training continues.
+    sharded_checkpoints: bool, if True, save checkpoints as directories with
+      one file per array (see `trax.checkpoints`) which can be loaded lazily.
+    delta_checkpoints: bool, if True, save sharded checkpoints that share
+      unchanged arrays with earlier checkpoints instead of writing them again.
+    n_micro_batches: int, if more than 1, split each training batch (on each
+      device) into this many micro-batches and accumulate their gradients,
+      weighted by the sum of their weights, for a single optimizer update, to
+      train with batches that do not fit in memory at once.
+    steps_per_dispatch: int K; if more than 1, run K training steps on K
+      stacked batches in a single compiled call where possible, to save
+      per-step dispatch overhead for small models. Steps in checkpoints_at
+      must be multiples of K.
+    donate_buffers: bool, if True, let the training step reuse the device
+      memory of the weights, optimizer slots and model state for their new
+      values, instead of keeping both versions until the step ends. Peak
+      memory is written to the training summaries either way.
+    dynamic_loss_scaling: bool, if True, scale the loss up for computing
+      gradients (and the gradients back down) with a scale adjusted to avoid
+      overflows, for training with a low-precision `math.compute_dtype`.
+    shard_optimizer_state: bool, if True (and training on several devices),
+      keep on each device the optimizer slots for only its 1/n_devices shard
+      of the weights, and update just that shard there; the updated shards
+      are then gathered on all devices. Requires an optimizer that updates
+      weights elementwise (e.g., Adam, not Adafactor); checkpoints are the
+      same as without sharding. Gradients are reduce-scattered and weights
+      all-gathered with `lax.psum_scatter` and `lax.all_gather`; with a JAX
+      version that lacks them, both fall back to a `psum` over all devices,
+      which moves about twice as much data as without sharding.
+    eval_on_device: bool, if True, evaluate all eval batches in one compiled
+      call per batch shape that sums the metrics on the device, instead of
+      transferring the metrics of every batch to the host; batches count by
+      the sum of their weights.
+    cache_eval_batches: bool, if True, read the eval batches once and evaluate
+      on the same ones every time, instead of reading new ones.
+    eval_batches_on_device: bool, if True, cache the eval batches as above
+      and keep them in device memory (on one device only).
+    full_eval: bool, if True, evaluate on the whole eval set exactly once in
+      each evaluation, from the full_eval_stream of the inputs, instead of on
+      eval_steps batches; requires eval_on_device, so that the padding in the
+      last batches does not count.
+    log_step_times: bool, if True, time the phases of training (waiting for
+      inputs, transfer to the device, the compiled step, logging,
+      checkpointing and evaluation) and count steps with new and already
+      seen batch shapes (new ones usually need a compilation of the update),
+      and write them to the summaries and output_dir/step_times.jsonl after
+      each epoch. Steps then wait for the device, which can slow them down.
+    profile_steps: optional pair (start, stop) of steps; if given, the steps
+      from start up to stop are traced with `jax.profiler` into
+      output_dir/profile.
+    buffered_summaries: bool, if True, buffer the summaries in memory and
+      write them to the event files in a background thread, so that logging
+      does not block the training loop.
 
   Returns:
     trax.TrainerState
@@ -673,7 +1306,26 @@ def train(output_dir,
                           nontrainable_param_map=nontrainable_param_map,
                           metrics=metrics, id_to_mask=id_to_mask,
                           checkpoint_lowest=checkpoint_lowest,
-                          checkpoint_highest=checkpoint_highest)
+                          checkpoint_highest=checkpoint_highest,
+                          prefetch_size=prefetch_size,
+                          prefetch_to_device=prefetch_to_device,
+                          resume_input_stream=resume_input_stream,
+                          precompile_batch_shapes=precompile_batch_shapes,
+                          async_checkpoints=async_checkpoints,
+                          sharded_checkpoints=sharded_checkpoints,
+                          delta_checkpoints=delta_checkpoints,
+                          n_micro_batches=n_micro_batches,
+                          steps_per_dispatch=steps_per_dispatch,
+                          donate_buffers=donate_buffers,
+                          dynamic_loss_scaling=dynamic_loss_scaling,
+                          shard_optimizer_state=shard_optimizer_state,
+                          eval_on_device=eval_on_device,
+                          cache_eval_batches=cache_eval_batches,
+                          eval_batches_on_device=eval_batches_on_device,
+                          full_eval=full_eval,
+                          log_step_times=log_step_times,
+                          profile_steps=profile_steps,
+                          buffered_summaries=buffered_summaries)
 
   epoch_steps = [steps]  # Only training if eval_frequency is 0 or None
   if eval_frequency and eval_steps > 0:
@@ -721,9 +1373,25 @@ def _is_jit_init(value=None):
 
 
 @gin.configurable
-def _jit_update_fn(predict_fn, loss_fn, optimizer, n_devices, jit=True):
-  """Returns a (JIT-compiled) function that computes updates for one step."""
+def _jit_update_fn(predict_fn, loss_fn, optimizer, n_devices, jit=True,
+                   n_micro_batches=1, n_steps=1, donate_buffers=False,
+                   dynamic_loss_scaling=False, shard_optimizer_state=False):
+  """Returns a (JIT-compiled) function that computes updates for one step.
+
+  With n_steps > 1, the returned function instead runs n_steps updates in a
+  `math.scan`, on batches and nontrainable parameters stacked along an extra
+  axis (after the device axis), see `_multi_step_update`. With donate_buffers,
+  the weights, slots and model state passed to it can't be used afterwards.
+  With dynamic_loss_scaling, the loss scale is taken from the optimizer
+  parameters and its new value is returned in the stats, see
+  `_loss_scaled_tree_update`; with n_steps > 1, it is updated after each of
+  the steps. With shard_optimizer_state (and n_devices > 1),
+  the slots passed to it are sharded across devices, see
+  `_sharded_tree_update`.
+  """
   model_and_loss = tl.Serial(predict_fn, loss_fn)
+  # Each step of a multi-step update scales the loss by the previous scale.
+  carried_params = _LOSS_SCALE_PARAMS if dynamic_loss_scaling else ()
   # Gradients are always wrt. the first argument, so putting weights first.
   def model_and_loss_call(weights, batch, state, rng):
     res = model_and_loss(batch, weights=weights, state=state, rng=rng)
@@ -732,21 +1400,43 @@ def _jit_update_fn(predict_fn, loss_fn, optimizer, n_devices, jit=True):
     def single_update(i, opt_state, batch, state, rng):
       weights, slots, opt_params = opt_state
       rng, subrng = jax_random.split(rng[0])
-      grad_fn = math.grad(model_and_loss_call, has_aux=True)
+      loss_fn = model_and_loss_call
+      if dynamic_loss_scaling:
+        loss_fn = _scaled_loss(loss_fn, opt_params['loss_scale'])
+      grad_fn = accumulate_gradients(
+          math.grad(loss_fn, has_aux=True), n_micro_batches, weighted=True)
       grads, state = grad_fn(weights, batch, state, rng)
+      if dynamic_loss_scaling:
+        return _loss_scaled_tree_update(
+            optimizer, i, grads, weights, slots, opt_params), state, [subrng]
       return optimizer.tree_update(
           i, grads, weights, slots, opt_params), state, [subrng]
-    return math.jit(single_update) if jit else single_update
+    if n_steps > 1:
+      single_update = _multi_step_update(single_update, n_steps,
+                                         carried_params)
+    if not jit:
+      return single_update
+    if donate_buffers:
+      return _donate_weights_slots_and_state(math.jit, single_update)
+    return math.jit(single_update)
 
   # Else, for n_devices > 1:
-  @functools.partial(math.pmap, axis_name='batch')
-  def mapped_update(i, opt_state, batch, state, rng):
+  def device_update(i, opt_state, batch, state, rng):
     """This is a multi-device version of the update function above."""
     # We assume all tensors have the first dimension = n_devices.
     weights, slots, opt_params = opt_state
     rng, subrng = jax_random.split(rng)
-    grad_fn = math.grad(model_and_loss_call, has_aux=True)
+    loss_fn = model_and_loss_call
+    if dynamic_loss_scaling:
+      loss_fn = _scaled_loss(loss_fn, opt_params['loss_scale'])
+    grad_fn = accumulate_gradients(
+        math.grad(loss_fn, has_aux=True), n_micro_batches, weighted=True)
     grads, state = grad_fn(weights, batch, state, rng)
+    if shard_optimizer_state:
+      # Gradients are summed over devices shard by shard, in the update.
+      return _sharded_tree_update(
+          optimizer, i, grads, weights, slots, opt_params, n_devices,
+          dynamic_loss_scaling), state, subrng
     # We do a psum(1.0) here instead of `n_devices` since `n_devices` is just
     # the number of devices on this host machine, however psum goes over all
     # devices of all hosts (ex: a TPU pod) and we need to be averaging over all
@@ -754,15 +1444,292 @@ def _jit_update_fn(predict_fn, loss_fn, optimizer, n_devices, jit=True):
     grads = jax.tree_util.tree_map(
         lambda g: math.psum(g, 'batch') / math.psum(np.array(1.0), 'batch'),
         grads)
+    if dynamic_loss_scaling:
+      return _loss_scaled_tree_update(
+          optimizer, i, grads, weights, slots, opt_params), state, subrng
     return optimizer.tree_update(
         i, grads, weights, slots, opt_params), state, subrng
 
-  def update(i, opt_state, batch, state, rng):
-    return mapped_update(np.repeat(i, n_devices), opt_state, batch, state, rng)
+  if n_steps > 1:
+    device_update = _multi_step_update(device_update, n_steps, carried_params)
+  pmap = functools.partial(math.pmap, axis_name='batch')
+  if donate_buffers:
+    mapped_update = _donate_weights_slots_and_state(pmap, device_update)
+  else:
+    mapped_update = pmap(device_update)
+
+  def update(i, *args):
+    return mapped_update(np.repeat(i, n_devices), *args)
+
+  return update
+
+
+def _sharded_tree_update(optimizer, i, grads, weights, slots, opt_params,
+                         n_shards, dynamic_loss_scaling):
+  """Updates this device's shard of the weights and all-gathers the result.
+
+  Runs inside `math.pmap` over the axis 'batch'. Every weight array is split
+  into n_shards flat shards (see `_shard`) and each device keeps the optimizer
+  slots of its shard only, so it only updates that shard. The gradients are
+  averaged over devices with a reduce-scatter, so each device only gets those
+  of its shard, and the new shards are all-gathered into the full weights;
+  see `_reduce_scatter` and `_all_gather`.
+
+  Args:
+    optimizer: the optimizer, which must have `elementwise_update`.
+    i: the step number.
+    grads: the gradients on this device, not yet averaged over devices.
+    weights: the full (replicated) weights.
+    slots: the optimizer slots of this device's shard of the weights.
+    opt_params: the optimizer parameters.
+    n_shards: the number of devices.
+    dynamic_loss_scaling: whether to update with `_loss_scaled_tree_update`.
+
+  Returns:
+    Tuple (new_weights, new_slots, stats) like `optimizer.tree_update`, with
+    the full new weights and the new slots of this device's shard.
+  """
+  shard_index = jax.lax.axis_index('batch')
+  n_total = math.psum(np.array(1.0), 'batch')
+  weights_flat = math.tree_flatten(weights)
+  grad_shards = [_reduce_scatter(g, n_shards, shard_index) / n_total
+                 for g in math.tree_flatten(grads)]
+  weight_shards = [_shard(w, n_shards, np)[shard_index] for w in weights_flat]
+  if dynamic_loss_scaling:
+    new_shards, new_slots, stats = _loss_scaled_tree_update(
+        optimizer, i, grad_shards, weight_shards, slots, opt_params,
+        axis_name='batch')
+  else:
+    new_shards, new_slots, stats = optimizer.tree_update(
+        i, grad_shards, weight_shards, slots, opt_params, axis_name='batch')
+  new_weights_flat = [
+      _unshard(_all_gather(shard, n_shards, shard_index), weight.shape, np)
+      for (shard, weight) in zip(new_shards, weights_flat)]
+  new_weights, _ = math.tree_unflatten(new_weights_flat, weights)
+  return new_weights, new_slots, stats
+
+
+def _reduce_scatter(x, n_shards, shard_index):
+  """Returns this device's shard (see `_shard`) of x summed over devices.
+
+  Uses `lax.psum_scatter` if the installed JAX has it. Otherwise, sums all of
+  x over devices and slices out the shard, which moves about twice the data.
+  """
+  shards = _shard(x, n_shards, np)
+  if hasattr(jax.lax, 'psum_scatter'):
+    return jax.lax.psum_scatter(shards, 'batch')
+  return math.psum(shards, 'batch')[shard_index]
+
+
+def _all_gather(shard, n_shards, shard_index):
+  """Returns the shards of all devices, stacked, given this device's shard.
+
+  Uses `lax.all_gather` if the installed JAX has it. Otherwise, sums arrays
+  of all shards over devices, with each device contributing its own shard and
+  zeros elsewhere, which moves about twice the data.
+  """
+  if hasattr(jax.lax, 'all_gather'):
+    return jax.lax.all_gather(shard, 'batch')
+  is_local = (np.arange(n_shards) == shard_index)[:, None]
+  shards = np.where(is_local, shard[None, :], np.zeros_like(shard)[None, :])
+  return math.psum(shards, 'batch')
+
+
+def _shard(x, n_shards, np_module=numpy):
+  """Splits x into n_shards flat shards of equal size, padded with zeros."""
+  flat = np_module.reshape(x, (-1,))
+  shard_size = -(-flat.shape[0] // n_shards)  # Rounded up.
+  flat = np_module.pad(flat, (0, n_shards * shard_size - flat.shape[0]))
+  return np_module.reshape(flat, (n_shards, shard_size))
+
+
+def _unshard(shards, shape, np_module=numpy):
+  """Inverse of `_shard`: returns the array of the given shape from shards."""
+  size = int(numpy.prod(shape))
+  return np_module.reshape(np_module.reshape(shards, (-1,))[:size], shape)
+
+
+def _shard_slots(slots, n_shards):
+  """Shards each slot array on the host, see `_shard`."""
+  return math.nested_map(
+      lambda x: None if x is None else _shard(numpy.asarray(x), n_shards),
+      slots)
+
+
+def _unshard_slots(slots, weights):
+  """Inverse of `_shard_slots`: returns slots in the shapes of the weights.
+
+  Slots of optimizers with `elementwise_update` have the shapes of the weights
+  they are for, and there is one slot (tree) per weight array.
+  """
+  return [
+      math.nested_map(
+          lambda x: None if x is None else _unshard(x, weight.shape), slot)
+      for (slot, weight) in zip(slots, math.tree_flatten(weights))]
+
+
+# Dynamic loss scaling starts with this scale and doubles it after this many
+# steps without non-finite gradients; it halves it on non-finite gradients.
+_INITIAL_LOSS_SCALE = 2.0 ** 15
+_LOSS_SCALE_PERIOD = 2000
+# Optimizer parameters holding the loss scale state, updated in every step.
+_LOSS_SCALE_PARAMS = ('loss_scale', 'loss_scale_good_steps')
+
+
+def _scaled_loss(loss_fn, loss_scale):
+  """Returns loss_fn with the loss (but not the state) multiplied by a scale."""
+  def scaled_loss_fn(*args):
+    loss, state = loss_fn(*args)
+    return loss * loss_scale, state
+  return scaled_loss_fn
+
+
+def _loss_scaled_tree_update(optimizer, i, grads, weights, slots, opt_params,
+                             axis_name=None):
+  """Unscales grads and updates with them if they are finite.
+
+  Gradients of a loss multiplied by opt_params['loss_scale'] don't underflow
+  in low precision as easily. If any of them is not finite (the scaled loss
+  overflowed), weights and slots are left as they are and the scale is
+  halved; after _LOSS_SCALE_PERIOD steps with finite gradients, it is doubled.
+
+  Args:
+    optimizer: the optimizer.
+    i: the step number.
+    grads: gradients of the scaled loss.
+    weights: the weights.
+    slots: the optimizer slots.
+    opt_params: the optimizer parameters, including 'loss_scale' and
+      'loss_scale_good_steps'.
+    axis_name: if the arrays are shards on devices mapped over with this axis
+      name, the update is skipped on all of them if any gradient isn't finite.
+
+  Returns:
+    Tuple (new_weights, new_slots, stats) like `optimizer.tree_update`, with
+    the new 'loss_scale' and 'loss_scale_good_steps' added to the stats.
+  """
+  loss_scale = opt_params['loss_scale']
+  grads = math.nested_map(lambda g: g / loss_scale, grads)
+  new_weights, new_slots, stats = optimizer.tree_update(
+      i, grads, weights, slots, opt_params, axis_name=axis_name)
+  finite = np.all(np.array(
+      [np.all(np.isfinite(g)) for g in math.tree_flatten(grads)]))
+  if axis_name is not None:
+    n_not_finite = math.psum(np.logical_not(finite).astype(np.int32), axis_name)
+    finite = n_not_finite == 0
+  def keep_if_not_finite(new_trees, old_trees):
+    new_flat = [new if new is None else np.where(finite, new, old)
+                for (new, old) in zip(math.tree_flatten(new_trees),
+                                      math.tree_flatten(old_trees))]
+    return math.tree_unflatten(new_flat, new_trees)[0]
+  new_weights = keep_if_not_finite(new_weights, weights)
+  new_slots = keep_if_not_finite(new_slots, slots)
+  good_steps = np.where(finite, opt_params['loss_scale_good_steps'] + 1, 0)
+  grow = good_steps >= _LOSS_SCALE_PERIOD
+  stats = dict(stats)
+  stats['loss_scale'] = np.where(
+      finite, np.where(grow, loss_scale * 2, loss_scale), loss_scale / 2)
+  stats['loss_scale_good_steps'] = np.where(grow, 0, good_steps)
+  return new_weights, new_slots, stats
+
+
+def _donate_weights_slots_and_state(transform, update_fn):
+  """Returns transform(update_fn), donating weights, slots and state buffers.
+
+  Optimizer parameters are not donated: some of them stay the same across
+  steps, and the donated buffers of the arguments get deleted.
+
+  Args:
+    transform: `math.jit` or `math.pmap`, taking a donate_argnums argument.
+    update_fn: function (i, opt_state, batch, state, ...) -> (...).
+
+  Returns:
+    The transformed function, with the same signature as update_fn.
+  """
+  def split_update(i, weights, slots, opt_params, batch, state, *args):
+    return update_fn(i, (weights, slots, opt_params), batch, state, *args)
+  transformed_update = transform(split_update, donate_argnums=(1, 2, 5))
+
+  def update(i, opt_state, batch, state, *args):
+    weights, slots, opt_params = opt_state
+    return transformed_update(i, weights, slots, opt_params, batch, state,
+                              *args)
 
   return update
 
 
+def _has_trace_profiler():
+  """Returns True if jax.profiler can trace into a directory."""
+  profiler = getattr(jax, 'profiler', None)
+  return (hasattr(profiler, 'start_trace') and
+          hasattr(profiler, 'stop_trace'))
+
+
+def memory_stats():
+  """Returns a dict with the peak memory use so far, in bytes.
+
+  The peak host memory (resident set size) is always included. Peak device
+  memory, summed over local devices, is included if the devices report it.
+  """
+  stats = {}
+  if math.backend_name() == 'jax':
+    device_stats = [getattr(device, 'memory_stats', lambda: None)()
+                    for device in jax.local_devices()]
+    if device_stats and all(device_stats):
+      stats['device_peak_bytes'] = sum(
+          s.get('peak_bytes_in_use', 0) for s in device_stats)
+  # On Linux, ru_maxrss is in kilobytes.
+  stats['host_peak_bytes'] = (
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+  return stats
+
+
+def _multi_step_update(update_fn, n_steps, carried_params=()):
+  """Returns a function running update_fn for n_steps steps in a scan.
+
+  The returned function takes the same arguments as update_fn, except that
+  batch is replaced by n_steps batches stacked along the first axis, and an
+  additional argument step_opt_params holds a dict of nontrainable parameters
+  for each step, stacked the same way; they override those in opt_state. The
+  step number is incremented on device. Statistics from all steps are returned
+  stacked.
+
+  Args:
+    update_fn: function (i, opt_state, batch, state, rng) ->
+      ((weights, slots, stats), state, rng), with i the step number.
+    n_steps: int, number of steps to run per call.
+    carried_params: names of optimizer parameters that update_fn updates and
+      returns in its stats, e.g., the dynamic loss scale; each step takes them
+      from the stats of the step before (and the first from opt_state).
+
+  Returns:
+    The multi-step update function.
+  """
+  def multi_step_update(i, opt_state, batches, state, rng, step_opt_params):
+    weights, slots, opt_params = opt_state
+    carried = {name: opt_params[name] for name in carried_params}
+    def step(step_inputs, carry):
+      j, batch, params = step_inputs
+      weights, slots, state, rng, carried = carry
+      params = dict(opt_params, **params)
+      params.update(carried)
+      (weights, slots, stats), state, rng = update_fn(
+          j, (weights, slots, params), batch, state, rng)
+      carried = {name: stats[name].astype(value.dtype)
+                 for (name, value) in carried.items()}
+      # The scan needs the same tree types in the carry, but e.g. optimizers
+      # return slots as a tuple that were a list initially.
+      new_carry, _ = math.tree_unflatten(
+          math.tree_flatten((weights, slots, state, rng, carried)), carry)
+      return stats, new_carry
+    steps = i + np.arange(n_steps, dtype=np.int32)
+    stats, (weights, slots, state, rng, _) = math.scan(
+        step, (steps, batches, step_opt_params),
+        (weights, slots, state, rng, carried))
+    return (weights, slots, stats), state, rng
+  return multi_step_update
+
+
 @gin.configurable
 def _jit_predict_fn(model_predict, metric_fn, n_devices, jit=True):
   """Returns a JIT-compiled predict function (unless jit=False)."""
@@ -773,6 +1740,28 @@ def _jit_predict_fn(model_predict, metric_fn, n_devices, jit=True):
   return tl.jit_forward(model.pure_fn, n_devices)
 
 
+def _jit_accumulate_metrics_fn(model_predict, metric_fn, n_metrics, n_devices,
+                               weighted=False):
+  """Returns a JIT-compiled `accumulate_metrics` function on n_devices."""
+  model = tl.Serial(model_predict, metric_fn)
+  accumulated_metrics_fn = accumulate_metrics(model.pure_fn, n_metrics,
+                                              weighted=weighted)
+  if n_devices == 1:
+    return math.jit(accumulated_metrics_fn)
+
+  def device_accumulated_metrics_fn(batches, weights, state, rng):
+    sums, total = accumulated_metrics_fn(batches, weights, state, rng)
+    return math.psum(sums, 'batch'), math.psum(total, 'batch')
+  mapped_fn = math.pmap(device_accumulated_metrics_fn, axis_name='batch')
+
+  def multi_device_accumulated_metrics_fn(batches, weights, state, rng):
+    sums, total = mapped_fn(batches, weights, state,
+                            jax_random.split(rng, n_devices))
+    return sums[0], total[0]  # The same on all devices after psum.
+
+  return multi_device_accumulated_metrics_fn
+
+
 @gin.configurable
 def _jit_compute_loss_fn(predict_fn, loss_fn, n_devices, jit=True):
   """Returns a (JIT-compiled) function that computes the loss for one step."""
@@ -839,35 +1828,6 @@ def epochs(total_steps, steps_to_skip, epoch_steps):
       break
 
 
-def make_trainer_state_dict(step,
-                            opt_state,
-                            history,
-                            model_state):
-  """Creates a trainer state dictionary to save to disk.
-
-  Args:
-    step: int, a step number
-    opt_state: OptState namedtuple
-    history: `trax.history.History`, the history object.
-    model_state: A nested structure of the model state.
-
-  Returns:
-    A dictionary with the fields of TrainerState and OptState flattened.
-  """
-
-  return {
-      'step': step,
-      'weights': opt_state.weights[0],
-      'loss_weights': opt_state.weights[1],
-      'slots': opt_state.slots,
-      'opt_params': opt_state.opt_params,
-      'history': history,
-      'state': model_state[0],
-      'loss_state': model_state[1],
-      'version_timestamp': 'Jan-13-2020'  # To update in the future if needed.
-  }
-
-
 def trainer_state_from_dict(trainer_state_dict):
   """Given the trainer state dictionary, returns `TrainerState`."""
   # TODO(afrozm): This becomes simpler if OptState is flattened into
@@ -889,27 +1849,48 @@ def trainer_state_from_dict(trainer_state_dict):
       slots=trainer_state_dict['slots'],
       opt_params=trainer_state_dict['opt_params'])
   return TrainerState(step=step, opt_state=OptState(*opt_state),
-                      history=history, model_state=model_state)
+                      history=history, model_state=model_state,
+                      input_state=trainer_state_dict.get('input_state'))
 
 
 def load_trainer_state(output_dir, weights_file=None):
-  """Returns a TrainerState instance loaded from the given `output_dir`."""
+  """Returns a TrainerState instance loaded from the given `output_dir`.
+
+  Args:
+    output_dir: directory to load the latest checkpoint from, preferring a
+      sharded checkpoint (see `trax.checkpoints`) over a pickle file.
+    weights_file: optional checkpoint file or sharded checkpoint directory to
+      load instead.
+
+  Returns:
+    A TrainerState, with step and opt_state None if there is no checkpoint.
+  """
   if weights_file is None:
-    weights_file = os.path.join(output_dir, 'model.pkl')
+    weights_file = os.path.join(output_dir, 'model' + _SHARDED_EXTENSION)
+    if not checkpoints.is_sharded(weights_file):
+      weights_file = os.path.join(output_dir, 'model.pkl')
     if not tf.io.gfile.exists(weights_file):
       return TrainerState(step=None, opt_state=None,
-                          history=trax_history.History(), model_state=None)
+                          history=trax_history.History(), model_state=None,
+                          input_state=None)
   elif not tf.io.gfile.exists(weights_file):
     raise ValueError('File not found: %s' % weights_file)
 
-  with tf.io.gfile.GFile(weights_file, 'rb') as f:
-    trainer_state_dict = pickle.load(f)
+  if checkpoints.is_sharded(weights_file):
+    trainer_state_dict = checkpoints.load(weights_file)
+  else:
+    with tf.io.gfile.GFile(weights_file, 'rb') as f:
+      trainer_state_dict = pickle.load(f)
   trainer_state = trainer_state_from_dict(trainer_state_dict)
   log('Model loaded from %s at step %d' % (weights_file, trainer_state.step))
   logging.debug('From loaded model : history = %s', trainer_state.history)
   return trainer_state
 
 
+# Sharded checkpoints are directories named like pickle files with this suffix.
+_SHARDED_EXTENSION = '.ckpt'
+
+
 def init_random_number_generators(seed=None):
   """Initializes random generators for Python, NumPy, TensorFlow, and JAX."""
   # Seed Python random (None as seed is okay), then use it to seed the others.
@@ -952,29 +1933,87 @@ def _repeat_stream(stream, n_devices):
       yield example
 
 
-def pickle_to_file(obj, file_path, gzip=False):
-  """Pickle obj to file_path with gzipping and failure protection."""
-  # Pickle to tmp file and overwrite to prevent writing partial files.
-  tmp_file_path = file_path + '._tmp_'
-  with tf.io.gfile.GFile(tmp_file_path, 'wb') as f:
-    if not gzip:
-      pickle.dump(obj, f)
-    else:
-      with gzip_lib.GzipFile(fileobj=f, compresslevel=2) as gzipf:
-        pickle.dump(obj, gzipf)
-  # Moving a file is much less error-prone than pickling large files.
-  tf.io.gfile.rename(tmp_file_path, file_path, overwrite=True)
+def _stream_with_states(stream, states, stream_fn, n_devices):
+  """Repeats a resumable stream, appending its state after each example."""
+  while True:
+    for example in stream:
+      states.append(stream.state())
+      yield example
+    stream = stream_fn(n_devices)
 
 
-def unpickle_from_file(file_path, gzip=False):
-  """Unpickle obj from file_path with gzipping."""
-  with tf.io.gfile.GFile(file_path, 'rb') as f:
-    if not gzip:
-      obj = pickle.load(f)
-    else:
-      with gzip_lib.GzipFile(fileobj=f, compresslevel=2) as gzipf:
-        obj = pickle.load(gzipf)
-  return obj
+class _StepTimer(object):
+  """Adds up the seconds spent in phases of training, if enabled.
+
+  Phases are timed with `time`, e.g., `with timer.time('eval'): ...`, and
+  events are counted with `count`; nothing is recorded if not enabled.
+  """
+
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+    self._secs = collections.defaultdict(float)
+    self._counts = collections.defaultdict(int)
+
+  @contextlib.contextmanager
+  def time(self, phase):
+    """Context manager adding the time spent in it to phase."""
+    if not self.enabled:
+      yield
+      return
+    start_time = time.time()
+    try:
+      yield
+    finally:
+      self._secs[phase] += time.time() - start_time
+
+  def count(self, name, n=1):
+    if self.enabled:
+      self._counts[name] += n
+
+  def pop_stats(self):
+    """Returns the seconds by phase and counts so far and resets them."""
+    stats = {phase + '_secs': secs for (phase, secs) in self._secs.items()}
+    stats.update(self._counts)
+    self._secs.clear()
+    self._counts.clear()
+    return stats
+
+
+def _block_until_ready(tree):
+  """Waits until all arrays in tree are computed."""
+  for x in jax.tree_util.tree_leaves(tree):
+    if hasattr(x, 'block_until_ready'):
+      x.block_until_ready()
+
+
+class _CheckpointWriter(object):
+  """Runs checkpoint writes in a background thread, one at a time."""
+
+  def __init__(self):
+    self._thread = None
+    self._error = None
+
+  def write(self, write_fn):
+    """Waits for the previous write and starts write_fn in the background."""
+    self.wait()
+    self._thread = threading.Thread(target=self._run, args=(write_fn,))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def wait(self):
+    """Waits for the current write and re-raises the error if it failed."""
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error
+
+  def _run(self, write_fn):
+    try:
+      write_fn()
+    except Exception as e:  # pylint: disable=broad-except
+      self._error = e
 
 
 def _add_weights_and_mask(inputs, id_to_mask):
@@ -995,21 +2034,27 @@ def _add_weights_and_mask(inputs, id_to_mask):
   Returns:
     a trax_inputs.Inputs object with augmented streams
   """
+  def _with_mask(example):
+    """Create masks for the given example."""
+    if len(example) > 3 or len(example) < 2:
+      assert id_to_mask is None, 'Cannot automatically mask this stream.'
+      return example
+    if len(example) == 2:
+      weights = numpy.ones_like(example[1]).astype(numpy.float32)
+    else:
+      weights = example[2].astype(numpy.float32)
+    mask = 1.0 - numpy.equal(example[1], id_to_mask).astype(np.float32)
+    weights *= mask
+    return (example[0], example[1], weights)
+
   def _with_masks(input_stream):
-    """Create masks for the given stream."""
-    for example in input_stream:
-      if len(example) > 3 or len(example) < 2:
-        assert id_to_mask is None, 'Cannot automatically mask this stream.'
-        yield example
-      else:
-        if len(example) == 2:
-          weights = numpy.ones_like(example[1]).astype(numpy.float32)
-        else:
-          weights = example[2].astype(numpy.float32)
-        mask = 1.0 - numpy.equal(example[1], id_to_mask).astype(np.float32)
-        weights *= mask
-        yield (example[0], example[1], weights)
+    """Create masks for the given stream, keeping it resumable."""
+    return trax_inputs.MappedStream(_with_mask, input_stream)
+  full_eval_stream = None
+  if inputs.has_full_eval_stream:
+    full_eval_stream = lambda n: _with_masks(inputs.full_eval_stream(n))
   return trax_inputs.Inputs(
       train_stream=lambda n: _with_masks(inputs.train_stream(n)),
       eval_stream=lambda n: _with_masks(inputs.eval_stream(n)),
-      train_eval_stream=lambda n: _with_masks(inputs.train_eval_stream(n)))
+      train_eval_stream=lambda n: _with_masks(inputs.train_eval_stream(n)),
+      full_eval_stream=full_eval_stream)
@@ -21,23 +21,31 @@ from __future__ import print_function
 
 import contextlib
 import functools
+import itertools
+import json
 import os
+import subprocess
+import sys
 import tempfile
 from absl.testing import parameterized
+import gin
 
 from jax import test_util  # pylint: disable=unused-import
 from jax.config import config
 from jax.lib import xla_bridge
+import numpy as onp
 
 import tensorflow.compat.v2 as tf
 from tensorflow.compat.v2 import test
 from tensorflow.compat.v2.io import gfile
 
+from trax import checkpoints
 from trax import layers
 from trax import lr_schedules as lr
 from trax import math
 from trax import models
 from trax import optimizers as trax_opt
+from trax import shapes
 from trax.math import numpy as np
 from trax.supervised import inputs as inputs_lib
 from trax.supervised import trainer_lib
@@ -199,6 +207,137 @@ class TraxTest(test.TestCase, parameterized.TestCase):
       # Assert total train steps
       self.assertEqual(state.step, 2 * steps)
 
+  @parameterized.named_parameters(
+      ('replayed', False, None),
+      ('restored', True, None),
+      ('restored_prefetched', True, 2))
+  def test_train_restart_resumes_input_stream(self, resumable, prefetch_size):
+    batch_size = 2 * xla_bridge.device_count()
+    seeds = itertools.count()
+
+    def train_stream(n_devices):
+      del n_devices
+      batches = ((onp.full((batch_size, 3), i, dtype=onp.float32),
+                  onp.full((batch_size,), i % 4, dtype=onp.int32))
+                 for i in range(100))
+      if resumable:
+        # A new order for every stream, so it must be restored, not replayed.
+        return inputs_lib.shuffle_data(batches, 4, seed=next(seeds))
+      return batches
+
+    def new_trainer(output_dir):
+      return trainer_lib.Trainer(
+          model=functools.partial(models.MLP, d_hidden=16, n_output_classes=4),
+          loss_fn=layers.CrossEntropyLoss(),
+          optimizer=trax_opt.SGD,
+          lr_schedule=lr.MultifactorSchedule,
+          inputs=inputs_lib.Inputs(train_stream),
+          output_dir=output_dir,
+          prefetch_size=prefetch_size,
+          resume_input_stream=True)
+
+    def next_batch_number(trainer):
+      batch = trainer._next_train_batch()  # pylint: disable=protected-access
+      return int(onp.asarray(batch[0]).reshape((-1,))[0])
+
+    with self.tmp_dir() as output_dir:
+      trainer = new_trainer(output_dir)
+      trainer.train_epoch(3, 1)
+      trainer.save_state(keep=False)
+      # The batches an uninterrupted run trains on next.
+      expected = [next_batch_number(trainer) for _ in range(3)]
+      trainer.close()
+
+      restarted = new_trainer(output_dir)
+      self.assertEqual(restarted.step, 3)
+      self.assertEqual([next_batch_number(restarted) for _ in range(3)],
+                       expected)
+      restarted.close()
+
+  def test_train_restart_resumes_batch_fn_stream(self):
+    # The default pipeline: a tf.data dataset batched by batch_fn, which ends
+    # in a resumable shuffle buffer.
+    batch_size = 2 * xla_bridge.device_count()
+    dataset = tf.data.Dataset.from_tensor_slices((
+        {'x': onp.arange(60, dtype=onp.float32)[:, None] * onp.ones((1, 3))},
+        onp.arange(60, dtype=onp.int32) % 4)).repeat()
+
+    def train_stream(n_devices):
+      return inputs_lib.batch_fn(
+          inputs_lib.dataset_to_stream(dataset, 'x'), True, n_devices,
+          variable_target_shapes=False, batch_size=batch_size)
+
+    def new_trainer(output_dir):
+      return trainer_lib.Trainer(
+          model=functools.partial(models.MLP, d_hidden=16, n_output_classes=4),
+          loss_fn=layers.CrossEntropyLoss(),
+          optimizer=trax_opt.SGD,
+          lr_schedule=lr.MultifactorSchedule,
+          inputs=inputs_lib.Inputs(train_stream),
+          output_dir=output_dir,
+          resume_input_stream=True)
+
+    def next_examples(trainer):
+      batch = trainer._next_train_batch()  # pylint: disable=protected-access
+      return [int(x) for x in onp.asarray(batch[0])[..., 0].reshape((-1,))]
+
+    with self.tmp_dir() as output_dir:
+      trainer = new_trainer(output_dir)
+      trainer.train_epoch(3, 1)
+      trainer.save_state(keep=False)
+      # The examples an uninterrupted run trains on next.
+      expected = [next_examples(trainer) for _ in range(3)]
+      trainer.close()
+
+      restarted = new_trainer(output_dir)
+      # pylint: disable=protected-access
+      self.assertIsNotNone(restarted._input_state)  # Restored, not replayed.
+      # pylint: enable=protected-access
+      self.assertEqual([next_examples(restarted) for _ in range(3)], expected)
+      restarted.close()
+
+  @parameterized.named_parameters(
+      ('plain', {}),
+      ('prefetch', dict(prefetch_size=2)),
+      ('async_checkpoints', dict(async_checkpoints=True)),
+      ('sharded_checkpoints', dict(sharded_checkpoints=True)),
+      ('delta_checkpoints', dict(delta_checkpoints=True)),
+      ('micro_batches', dict(n_micro_batches=2)),
+      ('steps_per_dispatch', dict(steps_per_dispatch=2)),
+      ('donate_buffers', dict(donate_buffers=True)),
+      ('dynamic_loss_scaling', dict(dynamic_loss_scaling=True)))
+  def test_train_restart_matches_uninterrupted_training(self, options):
+    # These options change how training runs and is saved, not its result.
+    n_classes = 4
+    steps = 2
+    def train(output_dir, steps, **options):
+      return trainer_lib.train(
+          output_dir,
+          model=functools.partial(
+              models.MLP, d_hidden=16, n_output_classes=n_classes),
+          inputs=_test_inputs(n_classes),
+          optimizer=trax_opt.Adam,
+          steps=steps,
+          eval_steps=1,
+          random_seed=0,
+          resume_input_stream=True,
+          **options)
+
+    with self.tmp_dir() as output_dir:
+      expected_state = train(output_dir, 2 * steps)
+    with self.tmp_dir() as output_dir:
+      train(output_dir, steps, **options)
+      state = train(output_dir, 2 * steps, **options)
+    self.assertEqual(state.step, 2 * steps)
+    for (weight, expected_weight) in zip(
+        math.tree_flatten(state.opt_state.weights),
+        math.tree_flatten(expected_state.opt_state.weights)):
+      self.assertAllClose(weight, expected_weight, rtol=1e-5, atol=1e-6)
+    self.assertAllClose(
+        state.history.value_at('train', 'metrics/loss', 2 * steps),
+        expected_state.history.value_at('train', 'metrics/loss', 2 * steps),
+        rtol=1e-5)
+
   @parameterized.parameters(BACKENDS)
   def test_train_with_weights(self, backend_name):
     if xla_bridge.device_count() > 1 and backend_name == 'tf':
@@ -223,6 +362,410 @@ class TraxTest(test.TestCase, parameterized.TestCase):
       # Assert total train steps
       self.assertEqual(state.step, steps)
 
+  def test_train_with_packed_sequences(self):
+    vocab_size = 8
+    batch_size = 2 * xla_bridge.device_count()
+
+    def examples():
+      rng = onp.random.RandomState(0)
+      while True:
+        tokens = rng.randint(1, vocab_size, size=rng.randint(2, 6))
+        yield tokens, tokens
+
+    def input_stream(n_devices):
+      del n_devices
+      return inputs_lib.batch_data(
+          inputs_lib.pack_data(examples(), length=8), batch_size)
+
+    with self.tmp_dir() as output_dir:
+      inputs = inputs_lib.Inputs(input_stream)
+      self.assertLen(next(inputs.train_stream(1)), 5)
+      model_fn = functools.partial(
+          models.TransformerLM, vocab_size, d_model=16, d_ff=16, n_layers=1,
+          n_heads=2, max_len=8, packed=True)
+      metrics = {'loss': layers.CrossEntropyLoss(),
+                 'non_padding_fraction': layers.NonPaddingFraction()}
+      state = trainer_lib.train(
+          output_dir, model=model_fn, inputs=inputs, metrics=metrics,
+          optimizer=trax_opt.Adam,
+          lr_schedule=functools.partial(lr.constant, value=0.01),
+          steps=20, eval_steps=1, eval_frequency=10)
+      self.assertEqual(state.step, 20)
+      _, losses = zip(*state.history.get('train', 'metrics/loss'))
+      self.assertLess(losses[-1], losses[0])
+      _, fraction = state.history.get(
+          'eval', 'metrics/non_padding_fraction')[-1]
+      self.assertGreater(fraction, 0.5)
+
+  @parameterized.parameters(BACKENDS)
+  def test_train_with_prefetch(self, backend_name):
+    if xla_bridge.device_count() > 1 and backend_name == 'tf':
+      self.skipTest("tf-numpy backend doesn't support multi-devices yet.")
+    with math.use_backend(backend_name):
+      inputs = _test_inputs(4)
+      trainer = trainer_lib.Trainer(
+          model=functools.partial(models.MLP, d_hidden=16, n_output_classes=4),
+          loss_fn=layers.CrossEntropyLoss(),
+          optimizer=trax_opt.SGD,
+          lr_schedule=lr.MultifactorSchedule,
+          inputs=inputs,
+          prefetch_size=2,
+          prefetch_to_device=True)
+      # pylint: disable=protected-access
+      prefetcher = trainer._train_stream
+      self.assertIsInstance(prefetcher, inputs_lib.Prefetcher)
+      # Prefetched batches come in the order of the stream.
+      expected_batches = inputs.train_stream(trainer.n_devices)
+      for _ in range(3):
+        batch, expected_batch = next(prefetcher), next(expected_batches)
+        for x, expected_x in zip(batch, expected_batch):
+          self.assertAllClose(np.reshape(x, expected_x.shape), expected_x)
+      trainer.train_epoch(2, 1)
+      self.assertEqual(trainer.step, 2)
+      # Resetting stops the prefetching threads of the old streams.
+      trainer.reset(None)
+      self.assertFalse(prefetcher._thread.is_alive())
+      self.assertIsNot(trainer._train_stream, prefetcher)
+      trainer.close()
+      self.assertFalse(trainer._train_stream)
+      # pylint: enable=protected-access
+
+  def test_train_with_async_checkpoints(self):
+    with self.tmp_dir() as output_dir:
+      n_classes = 4
+      steps = 2
+      eval_steps = 2
+      model_fn = functools.partial(
+          models.MLP, d_hidden=16, n_output_classes=n_classes)
+      inputs = _test_inputs(n_classes)
+
+      trainer = trainer_lib.Trainer(
+          model=model_fn,
+          loss_fn=layers.CrossEntropyLoss(),
+          optimizer=trax_opt.SM3,
+          lr_schedule=lr.MultifactorSchedule,
+          inputs=inputs,
+          output_dir=output_dir,
+          async_checkpoints=True)
+      trainer.train_epoch(steps, eval_steps)
+      trainer.save_state(keep=True)
+      trainer.close()
+      self.assertEqual(trainer_lib.load_trainer_state(output_dir).step, steps)
+      # The latest checkpoint is a link to the kept one, not a second copy.
+      self.assertTrue(os.path.samefile(
+          os.path.join(output_dir, 'model.pkl'),
+          os.path.join(output_dir, 'model_%d.pkl' % steps)))
+
+  def test_sharded_checkpoint_initializes_model(self):
+    with self.tmp_dir() as output_dir:
+      n_classes = 4
+      model_fn = functools.partial(
+          models.MLP, d_hidden=16, n_output_classes=n_classes)
+      state = trainer_lib.train(
+          output_dir,
+          model=model_fn,
+          inputs=_test_inputs(n_classes),
+          steps=2,
+          eval_steps=1,
+          sharded_checkpoints=True)
+      self.assertTrue(gfile.isdir(os.path.join(output_dir, 'model.ckpt')))
+
+      model = model_fn(mode='eval')
+      model.init_from_file(os.path.join(output_dir, 'model.ckpt'),
+                           weights_only=True)
+      for (weight, trained_weight) in zip(
+          math.tree_flatten(model.weights),
+          math.tree_flatten(state.opt_state.weights[0])):
+        self.assertAllClose(weight, trained_weight)
+
+  def test_train_restart_with_delta_checkpoints(self):
+    with self.tmp_dir() as output_dir:
+      n_classes = 4
+      steps = 2
+      eval_steps = 2
+      model_fn = functools.partial(
+          models.MLP, d_hidden=16, n_output_classes=n_classes)
+      inputs = _test_inputs(n_classes)
+
+      trainer_lib.train(
+          output_dir,
+          model=model_fn,
+          inputs=inputs,
+          steps=steps,
+          eval_steps=eval_steps,
+          checkpoints_at=[steps],
+          delta_checkpoints=True)
+      state = trainer_lib.train(
+          output_dir,
+          model=model_fn,
+          inputs=inputs,
+          steps=(2 * steps),
+          eval_steps=eval_steps,
+          delta_checkpoints=True)
+      self.assertEqual(state.step, 2 * steps)
+      # Both checkpoints load, blobs of overwritten ones were removed.
+      paths = [os.path.join(output_dir, 'model_%d.ckpt' % steps),
+               os.path.join(output_dir, 'model.ckpt')]
+      for path in paths:
+        trainer_lib.load_trainer_state(output_dir, weights_file=path)
+      blob_dir = os.path.join(output_dir, 'blobs')
+      self.assertEqual(checkpoints.collect_garbage(blob_dir, paths), 0)
+
+  def test_train_with_steps_per_dispatch(self):
+    with self.tmp_dir() as output_dir:
+      n_classes = 4
+      steps = 5
+      eval_steps = 2
+      model_fn = functools.partial(
+          models.MLP, d_hidden=16, n_output_classes=n_classes)
+      inputs = _test_inputs(n_classes)
+
+      state = trainer_lib.train(
+          output_dir,
+          model=model_fn,
+          inputs=inputs,
+          steps=steps,
+          eval_steps=eval_steps,
+          eval_frequency=2,
+          checkpoints_at=[4],
+          steps_per_dispatch=2)
+      self.assertEqual(state.step, steps)
+      self.assertTrue(gfile.exists(os.path.join(output_dir, 'model_4.pkl')))
+
+  def test_checkpoints_must_align_with_steps_per_dispatch(self):
+    with self.assertRaisesRegex(ValueError, 'not multiples'):
+      trainer_lib.Trainer(
+          model=functools.partial(models.MLP, n_output_classes=4),
+          loss_fn=layers.CrossEntropyLoss(),
+          optimizer=trax_opt.SGD,
+          lr_schedule=lr.MultifactorSchedule,
+          inputs=_test_inputs(4),
+          checkpoints_at=[3],
+          steps_per_dispatch=2)
+
+  def test_shard_and_unshard(self):
+    x = np.arange(15).reshape((3, 5))
+    shards = trainer_lib._shard(x, 4)
+    self.assertEqual(shards.shape, (4, 4))
+    self.assertAllEqual(trainer_lib._unshard(shards, x.shape), x)
+
+  def test_eval_on_device_matches_host_evals(self):
+    # On unpadded batches of one size, all with weights 1, averaging over
+    # examples on the device is the same as averaging batch metrics.
+    n_classes = 4
+    steps = 4
+    def train(eval_on_device):
+      with self.tmp_dir() as output_dir:
+        return trainer_lib.train(
+            output_dir,
+            model=functools.partial(
+                models.MLP, d_hidden=16, n_output_classes=n_classes),
+            inputs=_test_inputs(n_classes),
+            steps=steps,
+            eval_steps=2,
+            eval_frequency=2,
+            random_seed=0,
+            eval_on_device=eval_on_device,
+            cache_eval_batches=True)
+
+    state = train(eval_on_device=True)
+    host_state = train(eval_on_device=False)
+    self.assertEqual(state.step, steps)
+    for mode in ('train', 'eval'):
+      metric_names = host_state.history.metrics_for_mode(mode)
+      self.assertIn('metrics/accuracy', metric_names)
+      for name in metric_names:
+        if not name.startswith('metrics/'):
+          continue
+        (metric_steps, values) = state.history.steps_and_values(mode, name)
+        (host_steps, host_values) = host_state.history.steps_and_values(
+            mode, name)
+        self.assertAllEqual(metric_steps, host_steps)
+        self.assertAllClose(values, host_values, rtol=1e-5)
+
+  def test_train_with_full_eval_on_cached_device_batches(self):
+    with self.tmp_dir() as output_dir:
+      n_classes = 4
+      steps = 2
+      eval_steps = 1
+      model_fn = functools.partial(
+          models.MLP, d_hidden=16, n_output_classes=n_classes)
+      inputs = _test_inputs(n_classes)
+      batch_size = 2 * xla_bridge.device_count()
+
+      def full_eval_stream(n_devices):
+        # One example more than a batch, so the last batch is padded.
+        examples = ((np.ones((6, 6, 3), dtype=np.float32), np.int32(i % 2))
+                    for i in range(batch_size + 1))
+        return inputs_lib.pad_batches(
+            inputs_lib.batch_data(examples, batch_size, drop_remainder=False),
+            n_devices)
+      inputs = inputs_lib.Inputs(inputs.train_stream,
+                                 full_eval_stream=full_eval_stream)
+
+      state = trainer_lib.train(
+          output_dir,
+          model=model_fn,
+          inputs=inputs,
+          steps=steps,
+          eval_steps=eval_steps,
+          eval_frequency=1,
+          eval_on_device=True,
+          eval_batches_on_device=True,
+          full_eval=True)
+      self.assertEqual(state.step, steps)
+      self.assertLen(state.history.get('eval', 'metrics/accuracy'), 2)
+
+      # All real examples have the same inputs, so the same predictions; the
+      # padded example (zero inputs, label 0) must not count.
+      model = model_fn(mode='eval')
+      x = np.ones((1, 6, 6, 3), dtype=np.float32)
+      model.init(shapes.signature(x))
+      log_probs = onp.asarray(model(x, weights=state.opt_state.weights[0]))[0]
+      labels = onp.arange(batch_size + 1) % 2
+      expected_loss = -onp.mean(log_probs[labels])
+      expected_accuracy = onp.mean(labels == onp.argmax(log_probs))
+      loss = state.history.value_at('eval', 'metrics/loss', steps)
+      accuracy = state.history.value_at('eval', 'metrics/accuracy', steps)
+      self.assertAllClose(loss, expected_loss, rtol=1e-5)
+      self.assertAllClose(accuracy, expected_accuracy)
+
+  def test_full_eval_needs_eval_on_device(self):
+    with self.assertRaisesRegex(ValueError, 'eval_on_device'):
+      trainer_lib.Trainer(
+          model=functools.partial(models.MLP, n_output_classes=4),
+          loss_fn=layers.CrossEntropyLoss(),
+          optimizer=trax_opt.SGD,
+          lr_schedule=lr.MultifactorSchedule,
+          inputs=_test_inputs(4),
+          full_eval=True)
+
+  def test_train_with_step_times_and_profile(self):
+    with self.tmp_dir() as output_dir:
+      n_classes = 4
+      steps = 4
+      eval_steps = 1
+      model_fn = functools.partial(
+          models.MLP, d_hidden=16, n_output_classes=n_classes)
+      inputs = _test_inputs(n_classes)
+
+      state = trainer_lib.train(
+          output_dir,
+          model=model_fn,
+          inputs=inputs,
+          steps=steps,
+          eval_steps=eval_steps,
+          eval_frequency=2,
+          log_step_times=True,
+          profile_steps=(1, 3))
+      self.assertEqual(state.step, steps)
+      with gfile.GFile(os.path.join(output_dir, 'step_times.jsonl')) as f:
+        records = [json.loads(line) for line in f]
+      self.assertEqual([r['step'] for r in records], [1, 2, 4])
+      self.assertEqual(sum(r['n_steps'] for r in records), steps)
+      self.assertEqual(sum(r.get('new_batch_shapes', 0) for r in records) +
+                       sum(r.get('seen_batch_shapes', 0) for r in records),
+                       steps)
+      for key in ('input_wait_secs', 'step_secs', 'eval_secs'):
+        self.assertIn(key, records[-1])
+      self.assertTrue(gfile.exists(os.path.join(output_dir, 'profile')))
+
+  def test_memory_stats(self):
+    stats = trainer_lib.memory_stats()
+    self.assertGreater(stats['host_peak_bytes'], 0)
+
+  def test_train_with_dynamic_loss_scaling(self):
+    with self.tmp_dir() as output_dir:
+      n_classes = 4
+      steps = 2
+      eval_steps = 2
+      model_fn = functools.partial(
+          models.MLP, d_hidden=16, n_output_classes=n_classes)
+      inputs = _test_inputs(n_classes)
+
+      gin.bind_parameter('compute_dtype.name', 'bfloat16')
+      try:
+        state = trainer_lib.train(
+            output_dir,
+            model=model_fn,
+            inputs=inputs,
+            steps=steps,
+            eval_steps=eval_steps,
+            dynamic_loss_scaling=True)
+      finally:
+        gin.clear_config()
+      self.assertEqual(state.step, steps)
+      self.assertIn('loss_scale', state.opt_state.opt_params)
+      # Master weights stay in float32.
+      for w in math.tree_flatten(state.opt_state.weights):
+        self.assertEqual(w.dtype, np.float32)
+
+  def test_loss_scaled_update_skips_non_finite_gradients(self):
+    optimizer = trax_opt.SGD(0.1)
+    weights = (np.ones(3),)
+    slots, opt_params = optimizer.tree_init(weights)
+    opt_params = dict(opt_params, loss_scale=np.array(8.0),
+                      loss_scale_good_steps=np.array(5))
+    grads = (np.array([1.0, np.inf, 1.0]),)
+    new_weights, _, stats = trainer_lib._loss_scaled_tree_update(
+        optimizer, 0, grads, weights, slots, opt_params)
+    self.assertAllClose(new_weights[0], weights[0])
+    self.assertEqual(stats['loss_scale'], 4.0)
+    self.assertEqual(stats['loss_scale_good_steps'], 0)
+    grads = (np.array([8.0, 8.0, 8.0]),)
+    new_weights, _, stats = trainer_lib._loss_scaled_tree_update(
+        optimizer, 0, grads, weights, slots, opt_params)
+    self.assertAllClose(new_weights[0], 0.9 * np.ones(3))
+    self.assertEqual(stats['loss_scale'], 8.0)
+    self.assertEqual(stats['loss_scale_good_steps'], 6)
+
+  def test_multi_step_update_carries_loss_scale(self):
+    optimizer = trax_opt.SGD(0.1)
+    weights = (np.ones(3),)
+    slots, opt_params = optimizer.tree_init(weights)
+    opt_params = dict(opt_params, loss_scale=np.array(8.0),
+                      loss_scale_good_steps=np.array(5))
+    def update_fn(i, opt_state, batch, state, rng):
+      weights, slots, opt_params = opt_state
+      grads = (batch * opt_params['loss_scale'],)  # Gradients of scaled loss.
+      return trainer_lib._loss_scaled_tree_update(
+          optimizer, i, grads, weights, slots, opt_params), state, rng
+    multi_step_update = trainer_lib._multi_step_update(
+        update_fn, 3, carried_params=('loss_scale', 'loss_scale_good_steps'))
+    # The second step overflows.
+    batches = np.array([[1.0] * 3, [np.inf] * 3, [1.0] * 3])
+    step_opt_params = {'learning_rate': np.full((3,), 0.1)}
+    (new_weights, _, stats), _, _ = multi_step_update(
+        0, (weights, slots, opt_params), batches, (), np.array(0),
+        step_opt_params)
+    self.assertAllClose(stats['loss_scale'], [8.0, 4.0, 4.0])
+    self.assertAllClose(stats['loss_scale_good_steps'], [6, 0, 1])
+    # Only the first and third steps update the weights.
+    self.assertAllClose(new_weights[0], 0.8 * np.ones(3))
+
+  def test_train_with_precompile(self):
+    with self.tmp_dir() as output_dir:
+      n_classes = 4
+      steps = 2
+      batch_size = 2 * xla_bridge.device_count()
+      trainer = trainer_lib.Trainer(
+          model=functools.partial(
+              models.MLP, d_hidden=16, n_output_classes=n_classes),
+          loss_fn=layers.CrossEntropyLoss(),
+          optimizer=trax_opt.SM3,
+          lr_schedule=lr.MultifactorSchedule,
+          inputs=_test_inputs(n_classes),
+          output_dir=output_dir,
+          log_step_times=True,
+          precompile_batch_shapes=[(batch_size, 1)])
+      trainer.train_epoch(steps, 1)
+      trainer.close()
+      # Training steps only see the precompiled batch shape.
+      with gfile.GFile(os.path.join(output_dir, 'step_times.jsonl')) as f:
+        (record,) = [json.loads(line) for line in f]
+      self.assertEqual(record.get('seen_batch_shapes'), steps)
+      self.assertNotIn('new_batch_shapes', record)
+
   @parameterized.parameters(BACKENDS)
   def test_reset_twice(self, backend_name):
     if xla_bridge.device_count() > 1 and backend_name == 'tf':
@@ -247,6 +790,32 @@ class TraxTest(test.TestCase, parameterized.TestCase):
       trainer.reset(output_dir2)
       trainer.evaluate(1)
 
+  def test_reset_closes_buffered_summary_writers(self):
+    with self.tmp_dir() as output_dir1, self.tmp_dir() as output_dir2:
+      trainer = trainer_lib.Trainer(
+          model=functools.partial(models.MLP, d_hidden=16, n_output_classes=4),
+          loss_fn=layers.CrossEntropyLoss(),
+          optimizer=trax_opt.SM3,
+          lr_schedule=lr.MultifactorSchedule,
+          inputs=_test_inputs(4),
+          output_dir=output_dir1,
+          buffered_summaries=True)
+      # pylint: disable=protected-access
+      def event_writers():
+        return [trainer._train_sw._event_writer, trainer._eval_sw._event_writer]
+      old_writers = event_writers()
+      trainer.reset(output_dir2)
+      new_writers = event_writers()
+      for writer in old_writers:
+        self.assertTrue(writer._closed)
+        self.assertFalse(writer._thread.is_alive())
+      trainer.close()
+      self.assertIsNone(trainer._train_sw)
+      self.assertIsNone(trainer._eval_sw)
+      for writer in new_writers:
+        self.assertFalse(writer._thread.is_alive())
+      # pylint: enable=protected-access
+
   def test_tf_xla_forced_compile(self):
     # TODO(wangpeng): re-enable this test
     self.skipTest('Needs --config=cuda to pass this test')
@@ -289,6 +858,79 @@ class TraxTest(test.TestCase, parameterized.TestCase):
 
 
 
+class ShardedOptimizerStateTest(test.TestCase):
+  """Tests of shard_optimizer_state, which needs several devices.
+
+  On a single device, the tests run in a subprocess with several CPU devices,
+  see `test_on_host_devices`.
+  """
+
+  def _train(self, output_dir, steps, shard_optimizer_state):
+    n_classes = 4
+    return trainer_lib.train(
+        output_dir,
+        model=functools.partial(
+            models.MLP, d_hidden=16, n_output_classes=n_classes),
+        inputs=_test_inputs(n_classes),
+        optimizer=trax_opt.Adam,
+        steps=steps,
+        eval_steps=1,
+        random_seed=0,
+        resume_input_stream=True,
+        shard_optimizer_state=shard_optimizer_state)
+
+  def test_on_host_devices(self):
+    if xla_bridge.device_count() > 1:
+      self.skipTest('The tests below run on the available devices directly.')
+    env = dict(os.environ)
+    env['XLA_FLAGS'] = ' '.join([env.get('XLA_FLAGS', ''),
+                                 '--xla_force_host_platform_device_count=4'])
+    env['JAX_PLATFORM_NAME'] = 'cpu'
+    tests = [f'ShardedOptimizerStateTest.{name}' for name in (
+        'test_train_matches_unsharded_training',
+        'test_needs_elementwise_optimizer')]
+    result = subprocess.run([sys.executable, os.path.abspath(__file__)] + tests,
+                            env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True)
+    self.assertEqual(result.returncode, 0, result.stdout)
+    self.assertNotIn('skipped', result.stdout)
+
+  def test_train_matches_unsharded_training(self):
+    if xla_bridge.device_count() < 2:
+      self.skipTest('Sharding needs several devices.')
+    steps = 3
+    with tempfile.TemporaryDirectory() as output_dir:
+      expected_state = self._train(output_dir, steps,
+                                   shard_optimizer_state=False)
+    with tempfile.TemporaryDirectory() as output_dir:
+      self._train(output_dir, 2, shard_optimizer_state=True)
+      # Checkpoints have unsharded slots, with the shapes of the weights.
+      checkpoint = trainer_lib.load_trainer_state(output_dir)
+      weights, slots, _ = checkpoint.opt_state
+      for weight, (m, v) in zip(math.tree_flatten(weights), slots):
+        self.assertEqual(m.shape, weight.shape)
+        self.assertEqual(v.shape, weight.shape)
+      # Continues from the checkpoint, with its slots sharded again.
+      state = self._train(output_dir, steps, shard_optimizer_state=True)
+    self.assertEqual(state.step, steps)
+    for (weight, expected_weight) in zip(
+        math.tree_flatten(state.opt_state.weights),
+        math.tree_flatten(expected_state.opt_state.weights)):
+      self.assertAllClose(weight, expected_weight, rtol=1e-5, atol=1e-6)
+
+  def test_needs_elementwise_optimizer(self):
+    if xla_bridge.device_count() < 2:
+      self.skipTest('Sharding needs several devices.')
+    with self.assertRaisesRegex(ValueError, 'elementwise'):
+      trainer_lib.Trainer(
+          model=functools.partial(models.MLP, n_output_classes=4),
+          loss_fn=layers.CrossEntropyLoss(),
+          optimizer=trax_opt.Adafactor,
+          lr_schedule=lr.MultifactorSchedule,
+          inputs=_test_inputs(4),
+          shard_optimizer_state=True)
+
+
 class EpochsTest(test.TestCase):
 
   def test_cuts_epoch_when_total_steps_reached(self):
@@ -32,12 +32,18 @@ Trax provides classes for training supervised models:
     training step number.
 """
 
+import os
+import time
+
 from absl import logging
 import numpy as np
+import tensorflow.compat.v2 as tf
 
+from trax import history as trax_history
 from trax import layers as tl
 from trax import math
 from trax import shapes
+from trax.supervised import utils
 
 
 class Loop:
@@ -52,9 +58,15 @@ class Loop:
   transformations (specifically, `jit` and `grad`). It creates JIT-compiled
   pure functions derived from variants of the core model; schematically:
 
-    - training variant: jit(grad(pure_function(model+loss)))
+    - training variant: jit(optimizer_update(grad(pure_function(model+loss))))
     - evals variant: jit(pure_function(model+evals))
 
+  The training variant donates the buffers of the weights, state and slots
+  it is called with, so they are updated in place on the device. `run` stores
+  the latest weights, state and slots back into the model and optimizer even
+  if it raises; if the compiled step itself fails after taking its inputs,
+  their buffers may already be deleted, and the `Loop` should be discarded.
+
   In training or during evals, these variants are called with explicit
   arguments for all relevant input data, model weights/state, optimizer slots,
   and random number seeds:
@@ -69,7 +81,7 @@ class Loop:
   """
 
   def __init__(self, model, task, eval_task=None, output_dir=None,
-               checkpoint_at=None):
+               checkpoint_at=None, n_micro_batches=1):
     """Configures a training `Loop`, including a random initialization.
 
     Args:
@@ -85,6 +97,11 @@ class Loop:
       checkpoint_at: Function (integer --> boolean) telling, for step n, whether
           that step should have its checkpoint saved. If None, don't save any
           checkpoints.
+      n_micro_batches: Integer K; if more than 1, each training step splits its
+          batch into K micro-batches and accumulates their gradients in a
+          single compiled step before one optimizer update, weighting each by
+          the sum of its weights (the last array of the batch). This trains
+          with the full batch using the activation memory of one micro-batch.
     """
     self._task = task
     self._model_in_training = tl.Serial(model, task.loss_layer)
@@ -100,16 +117,32 @@ class Loop:
     _, _ = self._model_in_training.init(batch_signature)
     _, _ = task.optimizer.tree_init(self._model_in_training.weights)
 
-    self._gradients_and_state_fn = (
-        math.jit(math.grad(self._model_in_training.pure_fn,
-                           argnums=1,  # arg1 of pure_fn: weights
-                           has_aux=True)))  # return (gradients, state)
+    def loss_and_state(weights, batch, state, rng):
+      return self._model_in_training.pure_fn(batch, weights, state, rng)
+    gradients_and_state_fn = utils.accumulate_gradients(
+        math.grad(loss_and_state, has_aux=True),  # return (gradients, state)
+        n_micro_batches, weighted=True)
+    optimizer = task.optimizer
+
+    def train_step(weights, state, slots, batch, rng, step, opt_params):
+      gradients, state = gradients_and_state_fn(weights, batch, state, rng)
+      weights, slots, _ = (
+          optimizer.tree_update(step, gradients, weights, slots, opt_params))
+      return weights, state, slots
+    # Weights, state and slots are replaced by the outputs, so their device
+    # buffers can be reused for them.
+    self._train_step_fn = math.jit(train_step, donate_argnums=(0, 1, 2))
+    # Host seconds spent in each training step after the first (compiling)
+    # one: the per-step overhead when the device is not the bottleneck.
+    self._step_secs = []
 
     if eval_task is not None:
       model_with_metrics = _model_with_metrics(model, eval_task)
       self._eval_weights = model_with_metrics.weights[1]  # just the eval part
       self._eval_state = model_with_metrics.state[1]  # just the eval part
-      self._metrics_fn = math.jit(model_with_metrics.pure_fn)
+      # Sums the metrics over all eval batches on the device.
+      self._metrics_fn = math.jit(utils.accumulate_metrics(
+          model_with_metrics.pure_fn, len(eval_task.metrics)))
 
   def run(self, n_steps=1):
     """Runs this training loop for n steps.
@@ -123,19 +156,28 @@ class Loop:
     weights = self._model_in_training.weights
     state = self._model_in_training.state
     slots = self._task.optimizer.slots
-    for step_i in range(1, n_steps + 1):
-      self._step = step_i
-      weights, state, slots = self._run_one_step(weights, state, slots)
-      if self._eval_at(step_i):
-        self._run_evals(weights, state)
-      if self._checkpoint_at(step_i):
-        self._save_checkpoint(weights, state, slots)
-
-    # Store the final values back into their respective objects, for testing
-    # or other inspection/use.
-    self._model_in_training.weights = weights
-    self._model_in_training.state = state
-    self._task.optimizer.slots = slots
+    self._step_secs = []
+    try:
+      for step_i in range(1, n_steps + 1):
+        self._step = step_i
+        start_time = time.time()
+        weights, state, slots = self._run_one_step(weights, state, slots)
+        if step_i > 1:
+          self._step_secs.append(time.time() - start_time)
+        if self._eval_at(step_i):
+          self._run_evals(weights, state)
+        if self._checkpoint_at(step_i):
+          self._save_checkpoint(weights, state, slots)
+    finally:
+      # Store the latest values back into their respective objects, for
+      # testing or other inspection/use; also if a step raised, since the
+      # values the objects held before may have been donated to a step.
+      self._model_in_training.weights = weights
+      self._model_in_training.state = state
+      self._task.optimizer.slots = slots
+    if self._step_secs:
+      self._log_step('Host time per train step: %0.2f ms' % (
+          1000 * np.mean(self._step_secs)))
 
   def current_step(self):
     """Returns current step number in this training session."""
@@ -161,11 +203,8 @@ class Loop:
     optimizer = self._task.optimizer
     opt_params = optimizer._init_opt_params  # pylint: disable=protected-access
 
-    gradients, state = (
-        self._gradients_and_state_fn(batch, weights, state, self.new_rng()))
-    weights, slots, _ = (
-        optimizer.tree_update(step, gradients, weights, slots, opt_params))
-    return weights, state, slots
+    return self._train_step_fn(weights, state, slots, batch, self.new_rng(),
+                               step, opt_params)
 
   def _run_evals(self, weights, state):
     """Runs and records evals for this training session.
@@ -173,6 +212,9 @@ class Loop:
     Args:
       weights: Current weights from model in training.
       state: Current state from model in training.
+
+    Returns:
+      Dict from eval names to the averages of the metrics over the batches.
     """
     eval_task = self._eval_task
     model_weights = weights[0]  # exclude weights from the loss layer
@@ -181,18 +223,18 @@ class Loop:
     metrics_state = (model_state, self._eval_state)
 
     n_batches = eval_task._eval_N  # pylint: disable=protected-access
-    n_metrics = len(eval_task.metrics)
-    sums = np.zeros((n_metrics,))
-    for _ in range(n_batches):
-      rng = self.new_rng()
-      batch = eval_task.next_batch()
-      metric_values, _ = (
-          self._metrics_fn(batch, metrics_weights, metrics_state, rng))
-      sums += metric_values
-    averages = sums / n_batches
+    batches = [eval_task.next_batch() for _ in range(n_batches)]
+    # One call per batch shape; the sums stay on the device until the end.
+    sums, count = 0.0, 0.0
+    for stacked_batches in utils.stack_batches(batches):
+      batch_sums, batch_count = self._metrics_fn(
+          stacked_batches, metrics_weights, metrics_state, self.new_rng())
+      sums, count = sums + batch_sums, count + batch_count
+    averages = np.asarray(sums) / float(count)
     for name, average_value in zip(eval_task.names, averages):
       logging.info('Eval at step %d: %s = %f',
                    self.current_step(), name, average_value)
+    return dict(zip(eval_task.names, averages))
 
   def _eval_at(self, step_n):
     """Returns True for training step n if evals should be run for that step."""
@@ -211,7 +253,19 @@ class Loop:
       state: State (non-weight parameters) from model being trained.
       slots: Updatable weights for the optimizer in this training loop.
     """
-    raise NotImplementedError
+    # Same format as trainer_lib.Trainer checkpoints, so they can be loaded
+    # with trainer_lib.load_trainer_state or Layer.init_from_file.
+    optimizer = self._task.optimizer
+    opt_params = optimizer._init_opt_params  # pylint: disable=protected-access
+    opt_state = utils.OptState(weights, slots, opt_params)
+    trainer_state_dict = utils.make_trainer_state_dict(
+        self.current_step(), opt_state, trax_history.History(), state)
+    tf.io.gfile.makedirs(self._output_dir)
+    step_file = os.path.join(self._output_dir,
+                             'model_{}.pkl'.format(self.current_step()))
+    utils.pickle_to_file(trainer_state_dict, step_file)
+    utils.link_or_copy(step_file, os.path.join(self._output_dir, 'model.pkl'))
+    self._log_step('Checkpoint saved to %s' % step_file)
 
 
 def _model_with_metrics(model, eval_task):
@@ -16,6 +16,9 @@
 # Lint as: python3
 """Tests for supervised training: core classes and flows."""
 
+import itertools
+import os
+
 from jax import test_util  # pylint: disable=unused-import
 from jax.config import config
 
@@ -24,7 +27,9 @@ import numpy as np
 from tensorflow.compat.v2 import test
 
 from trax import layers as tl
+from trax import math
 from trax import optimizers
+from trax.supervised import trainer_lib
 from trax.supervised import training
 
 
@@ -62,13 +67,89 @@ class TrainingTest(test.TestCase):
     training_session.run(n_steps=20)
     self.assertEqual(20, training_session.current_step())
 
+  def test_train_dense_layer_with_micro_batches(self):
+    """Trains with gradients accumulated over micro-batches."""
+    inputs = np.arange(8, dtype=np.float32).reshape((8, 1))
+    targets = np.pi * np.ones_like(inputs)
+    # The 4 micro-batches have 2, 1, 0 and 2 unmasked examples.
+    mask = np.array([[1], [1], [1], [0], [0], [0], [1], [1]], dtype=np.float32)
+
+    def train(n_micro_batches):
+      model = tl.Serial(tl.Dense(1))
+      task = training.TrainTask(itertools.repeat((inputs, targets, mask)),
+                                tl.L2Loss(), optimizers.SGD(.01))
+      training_session = training.Loop(model, task,
+                                       n_micro_batches=n_micro_batches)
+      training_session.run(n_steps=5)
+      self.assertEqual(5, training_session.current_step())
+      return model.weights
+
+    # Both start from the same weights (initialized with the default rng).
+    for (weight, expected_weight) in zip(math.tree_flatten(train(4)),
+                                         math.tree_flatten(train(1))):
+      self.assertAllClose(weight, expected_weight, rtol=1e-5)
+
+  def test_evals_average_metrics_over_batches(self):
+    """Averages the metrics of each batch, as a loop on the host would."""
+    model = tl.Serial(tl.Dense(1))
+    task = training.TrainTask(
+        _very_simple_data(), tl.L2Loss(), optimizers.SGD(.01))
+    inputs = np.arange(7, dtype=np.float32).reshape((7, 1))
+    targets = np.pi * np.ones_like(inputs)
+    # Batches with different numbers of unmasked examples still count once.
+    masks = [np.ones_like(targets), (inputs < 2).astype(np.float32)]
+    batches = [(inputs, targets, mask) for mask in masks]
+    eval_task = training.EvalTask(
+        itertools.cycle(batches), [tl.L2Loss()], names=['L2Loss'], eval_N=2)
+    training_session = training.Loop(model, task, eval_task=eval_task)
+    training_session.run(n_steps=2)
+    # pylint: disable=protected-access
+    model_in_training = training_session._model_in_training
+    averages = training_session._run_evals(model_in_training.weights,
+                                           model_in_training.state)
+    # pylint: enable=protected-access
+
+    outputs = np.asarray(model(inputs))
+    host_averages = [np.sum(mask * (outputs - targets) ** 2) / np.sum(mask)
+                     for mask in masks]
+    self.assertAllClose(averages['L2Loss'], np.mean(host_averages), rtol=1e-5)
+
+  def test_train_dense_layer_with_checkpoints(self):
+    """Saves checkpoints that Trainer can load."""
+    output_dir = self.get_temp_dir()
+    model = tl.Serial(tl.Dense(1))
+    task = training.TrainTask(
+        _very_simple_data(), tl.L2Loss(), optimizers.Momentum(.01))
+    training_session = training.Loop(model, task, output_dir=output_dir,
+                                     checkpoint_at=lambda step_n: step_n == 2)
+    training_session.run(n_steps=3)
+    self.assertTrue(os.path.exists(os.path.join(output_dir, 'model_2.pkl')))
+    trainer_state = trainer_lib.load_trainer_state(output_dir)
+    self.assertEqual(trainer_state.step, 2)
+
+  def test_run_keeps_live_weights_when_step_raises(self):
+    """Stores the latest (not donated) weights back if a step fails."""
+    model = tl.Serial(tl.Dense(1))
+    task = training.TrainTask(
+        _very_simple_data(n_batches=4), tl.L2Loss(), optimizers.SGD(.01))
+    training_session = training.Loop(model, task)
+    # One batch is the sample batch; the 4th step finds no data.
+    with self.assertRaises(StopIteration):
+      training_session.run(n_steps=5)
+    self.assertEqual(4, training_session.current_step())
+    # The weights after step 3 are readable, so they were not donated.
+    dense_weights = model.weights[0][0]
+    self.assertEqual(np.asarray(dense_weights).shape, (1, 1))
+
 
-def _very_simple_data():
+def _very_simple_data(n_batches=None):
   """"Returns stream of labeled data that maps small integers to constant pi."""
   inputs_batch = np.arange(7).reshape((7, 1))  # 7 items per batch
   targets_batch = np.pi * np.ones_like(inputs_batch)
   labeled_batch = (inputs_batch, targets_batch, np.ones_like(targets_batch))
-  while True:
+  while n_batches is None or n_batches > 0:
+    if n_batches is not None:
+      n_batches -= 1
     yield labeled_batch
 
 
@@ -0,0 +1,243 @@
+# coding=utf-8
+# Copyright 2020 The Trax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Training utilities shared by `trainer_lib.Trainer` and `training.Loop`.
+
+Gradient and metric accumulation on device, and the checkpoint format and
+file helpers both use.
+"""
+
+import collections
+import gzip as gzip_lib
+import os
+import pickle
+
+import jax
+import numpy
+import tensorflow.compat.v2 as tf
+from trax import layers as tl
+from trax import math
+from trax.math import numpy as np
+from trax.math import random as jax_random
+
+
+OptState = collections.namedtuple('_OptState', [
+    'weights',     # Model weights.
+    'slots',       # Per-parameter optimizer state, e.g. gradient moments.
+    'opt_params',  # Optimizer (hyper)parameters, e.g. learning rate, momentum.
+])
+
+
+def accumulate_gradients(grad_fn, n_micro_batches, weighted=False):
+  """Returns a gradient function that accumulates over micro-batches.
+
+  The returned function splits each array in the batch into n_micro_batches
+  parts along the batch dimension and runs grad_fn on them one after another
+  in a `math.scan`, so activations are only kept for one micro-batch at a
+  time. It returns the average of the gradients and the state after the last
+  micro-batch.
+
+  Args:
+    grad_fn: function (weights, batch, state, rng) -> (gradients, state).
+    n_micro_batches: int, number of micro-batches to split each batch into;
+      the batch size has to be divisible by it.
+    weighted: bool; if True, the gradients of each micro-batch count with the
+      sum of its last array (the weights of its examples), so that the result
+      matches grad_fn on the full batch for weighted-mean losses like
+      `tl.CrossEntropyLoss`, also if micro-batches have different weight sums.
+      If False, all micro-batches count equally, which matches grad_fn for
+      losses that are a plain mean over examples.
+
+  Returns:
+    A function with the same signature as grad_fn.
+  """
+  if n_micro_batches == 1:
+    return grad_fn
+
+  def split(x):
+    if x.shape[0] % n_micro_batches:
+      raise ValueError(f'Batch size {x.shape[0]} is not divisible by the '
+                       f'number of micro-batches ({n_micro_batches}).')
+    return np.reshape(
+        x, (n_micro_batches, x.shape[0] // n_micro_batches) + x.shape[1:])
+
+  def micro_batch_weight(micro_batch):
+    if not weighted:
+      return np.array(1.0)
+    return np.sum(micro_batch[-1]).astype(np.float32)
+
+  def accumulated_grad_fn(weights, batch, state, rng):
+    micro_batches = math.nested_map(split, batch)
+    rngs = jax_random.split(rng, n_micro_batches)
+    def micro_step(micro_batch_and_rng, sums_and_state):
+      micro_batch, micro_rng = micro_batch_and_rng
+      (grads_sum, total), state = sums_and_state
+      grads, state = grad_fn(weights, micro_batch, state, micro_rng)
+      weight = micro_batch_weight(micro_batch)
+      def add(grad_sum, grad):
+        # Micro-batches without weight may have nan gradients (of 0 / 0).
+        weighted_grad = np.where(weight > 0, weight * grad, 0.0)
+        return grad_sum + weighted_grad.astype(grad.dtype)
+      grads_sum = jax.tree_multimap(add, grads_sum, grads)
+      return (), ((grads_sum, total + weight), state)
+    zeros = math.nested_map(np.zeros_like, weights)
+    _, ((grads_sum, total), state) = math.scan(
+        micro_step, (micro_batches, rngs), ((zeros, np.array(0.0)), state))
+    grads = math.nested_map(
+        lambda g: np.where(total > 0, g / total, 0.0).astype(g.dtype),
+        grads_sum)
+    return grads, state
+
+  return accumulated_grad_fn
+
+
+def accumulate_metrics(metrics_fn, n_metrics, weighted=False):
+  """Returns a function that sums metrics over stacked batches on device.
+
+  The returned function runs metrics_fn on each batch in a `math.scan` over
+  the first axis of the stacked batches and sums up the metric values, so
+  that evaluating many batches takes a single call and transfer.
+
+  Args:
+    metrics_fn: function (batch, weights, state, rng) -> (metric values,
+      state), e.g., `pure_fn` of a model followed by a `tl.Branch` of metrics.
+    n_metrics: int, the number of metric values.
+    weighted: bool; if True, each batch counts with the sum of its last array
+      (the weights of its examples) instead of 1, so that batches with fewer
+      (or no) unpadded examples count less (or not at all).
+
+  Returns:
+    A function (batches, weights, state, rng) -> (sums, total weight), where
+    sums has the weighted sum of each metric; divide them by the total weight
+    to get the average metrics.
+  """
+  def batch_metrics(batch, weights, state, rng):
+    values, _ = metrics_fn(batch, weights, state, rng)
+    if isinstance(values, (list, tuple)):
+      values = np.stack(values)
+    values = np.reshape(values, (n_metrics,)).astype(np.float32)
+    if not weighted:
+      return values, np.array(1.0)
+    batch_weight = np.sum(batch[-1]).astype(np.float32)
+    # Batches without weight may have nan metrics (0 / 0): don't add them.
+    return (np.where(batch_weight > 0, batch_weight * values, 0.0),
+            batch_weight)
+
+  def accumulated_metrics_fn(batches, weights, state, rng):
+    n_batches = batches[0].shape[0]
+    rngs = jax_random.split(rng, n_batches)
+    def add_batch(batch_and_rng, sums_and_total):
+      batch, batch_rng = batch_and_rng
+      sums, total = sums_and_total
+      values, batch_weight = batch_metrics(batch, weights, state, batch_rng)
+      return (), (sums + values, total + batch_weight)
+    init = (np.zeros((n_metrics,), dtype=np.float32), np.array(0.0))
+    _, (sums, total) = math.scan(add_batch, (batches, rngs), init)
+    return sums, total
+
+  return accumulated_metrics_fn
+
+
+def stack_batches(batches, n_devices=1):
+  """Stacks batches, grouped by their shapes, for `accumulate_metrics`.
+
+  Args:
+    batches: iterable of batches, each a tuple of arrays.
+    n_devices: int; if more than 1, each batch is split by devices first and
+      the stacking axis comes after the device axis.
+
+  Returns:
+    A list with a stacked batch for each group of batches of the same shapes.
+  """
+  groups = collections.OrderedDict()
+  for batch in batches:
+    if n_devices > 1:
+      batch = tl.reshape_by_device(batch, n_devices)
+    shapes = tuple(x.shape for x in batch)
+    groups.setdefault(shapes, []).append(batch)
+  stack_axis = 0 if n_devices == 1 else 1
+  return [tuple(numpy.stack(xs, axis=stack_axis) for xs in zip(*group))
+          for group in groups.values()]
+
+
+def make_trainer_state_dict(step,
+                            opt_state,
+                            history,
+                            model_state,
+                            input_state=None):
+  """Creates a trainer state dictionary to save to disk.
+
+  Args:
+    step: int, a step number
+    opt_state: OptState namedtuple
+    history: `trax.history.History`, the history object.
+    model_state: A nested structure of the model state.
+    input_state: optional state of a resumable train stream, see
+      `inputs.ShuffleBuffer.state`.
+
+  Returns:
+    A dictionary with the fields of TrainerState and OptState flattened.
+  """
+
+  return {
+      'step': step,
+      'weights': opt_state.weights[0],
+      'loss_weights': opt_state.weights[1],
+      'slots': opt_state.slots,
+      'opt_params': opt_state.opt_params,
+      'history': history,
+      'state': model_state[0],
+      'loss_state': model_state[1],
+      'input_state': input_state,
+      'version_timestamp': 'Jan-13-2020'  # To update in the future if needed.
+  }
+
+
+def pickle_to_file(obj, file_path, gzip=False):
+  """Pickle obj to file_path with gzipping and failure protection."""
+  # Pickle to tmp file and overwrite to prevent writing partial files.
+  tmp_file_path = file_path + '._tmp_'
+  with tf.io.gfile.GFile(tmp_file_path, 'wb') as f:
+    if not gzip:
+      pickle.dump(obj, f)
+    else:
+      with gzip_lib.GzipFile(fileobj=f, compresslevel=2) as gzipf:
+        pickle.dump(obj, gzipf)
+  # Moving a file is much less error-prone than pickling large files.
+  tf.io.gfile.rename(tmp_file_path, file_path, overwrite=True)
+
+
+def unpickle_from_file(file_path, gzip=False):
+  """Unpickle obj from file_path with gzipping."""
+  with tf.io.gfile.GFile(file_path, 'rb') as f:
+    if not gzip:
+      obj = pickle.load(f)
+    else:
+      with gzip_lib.GzipFile(fileobj=f, compresslevel=2) as gzipf:
+        obj = pickle.load(gzipf)
+  return obj
+
+
+def link_or_copy(src_path, dst_path):
+  """Atomically makes dst_path a hard link to src_path, or a copy if remote."""
+  tmp_path = dst_path + '._tmp_'
+  try:
+    if os.path.lexists(tmp_path):
+      os.remove(tmp_path)
+    os.link(src_path, tmp_path)
+  except OSError:  # Not a local file system, e.g., GCS.
+    tf.io.gfile.copy(src_path, tmp_path, overwrite=True)
+  tf.io.gfile.rename(tmp_path, dst_path, overwrite=True)
@@ -0,0 +1,100 @@
+# coding=utf-8
+# Copyright 2020 The Trax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Lint as: python3
+"""Tests for trax.supervised.utils."""
+
+import os
+
+from absl.testing import absltest
+import numpy as onp
+
+from trax import math
+from trax.math import numpy as np
+from trax.supervised import utils
+
+
+class UtilsTest(absltest.TestCase):
+
+  def test_accumulate_gradients(self):
+    def loss_and_state(weights, batch, state, rng):
+      del rng
+      return np.mean((batch[0] * weights - batch[1]) ** 2), state + 1
+    grad_fn = math.grad(loss_and_state, has_aux=True)
+    batch = (np.arange(8.0), np.ones(8))
+    weights = np.array(0.5)
+    rng = math.random.get_prng(0)
+    grads, _ = grad_fn(weights, batch, np.array(0), rng)
+    accumulated_grad_fn = utils.accumulate_gradients(grad_fn, 4)
+    accumulated_grads, state = accumulated_grad_fn(
+        weights, batch, np.array(0), rng)
+    onp.testing.assert_allclose(grads, accumulated_grads)
+    self.assertEqual(state, 4)
+
+  def test_accumulate_gradients_with_uneven_masks(self):
+    def loss_and_state(weights, batch, state, rng):
+      del rng
+      inputs, targets, mask = batch
+      losses = (inputs * weights - targets) ** 2
+      return np.sum(losses * mask) / np.sum(mask), state
+    grad_fn = math.grad(loss_and_state, has_aux=True)
+    # The micro-batches have 3, 1, 0 and 2 unmasked examples.
+    mask = np.array([1.0, 1.0, 1.0, 0.0, 0.0, 0.0, 1.0, 1.0])
+    batch = (np.arange(8.0), np.ones(8), mask)
+    weights = np.array(0.5)
+    rng = math.random.get_prng(0)
+    grads, _ = grad_fn(weights, batch, np.array(0), rng)
+    accumulated_grad_fn = utils.accumulate_gradients(
+        grad_fn, 4, weighted=True)
+    accumulated_grads, _ = accumulated_grad_fn(
+        weights, batch, np.array(0), rng)
+    onp.testing.assert_allclose(grads, accumulated_grads, rtol=1e-6)
+
+  def test_accumulate_metrics(self):
+    def metrics_fn(batch, weights, state, rng):
+      del weights, rng
+      inputs, targets = batch
+      return (np.mean(inputs), np.sum(targets)), state
+    batches = (np.array([[1.0, 3.0], [5.0, 7.0]]),
+               np.array([[1.0, 1.0], [0.0, 0.0]]))
+    sums, count = utils.accumulate_metrics(metrics_fn, 2)(
+        batches, (), (), math.random.get_prng(0))
+    onp.testing.assert_allclose(sums, [8.0, 2.0])
+    self.assertEqual(count, 2.0)
+    # Weighted by the last array: the second batch has no weight.
+    sums, total = utils.accumulate_metrics(metrics_fn, 2, weighted=True)(
+        batches, (), (), math.random.get_prng(0))
+    onp.testing.assert_allclose(sums, [4.0, 4.0])
+    self.assertEqual(total, 2.0)
+
+  def test_stack_batches_by_shape(self):
+    batches = [(np.zeros((2, 3)),), (np.zeros((2, 5)),), (np.ones((2, 3)),)]
+    stacked = utils.stack_batches(batches)
+    self.assertEqual([b[0].shape for b in stacked], [(2, 2, 3), (1, 2, 5)])
+
+  def test_link_or_copy(self):
+    tmp_dir = self.create_tempdir().full_path
+    src_path = os.path.join(tmp_dir, 'model_1.pkl')
+    dst_path = os.path.join(tmp_dir, 'model.pkl')
+    utils.pickle_to_file({'step': 1}, src_path)
+    utils.link_or_copy(src_path, dst_path)
+    utils.pickle_to_file({'step': 2}, src_path.replace('1', '2'))
+    utils.link_or_copy(src_path.replace('1', '2'), dst_path)
+    self.assertEqual(utils.unpickle_from_file(dst_path), {'step': 2})
+    self.assertEqual(utils.unpickle_from_file(src_path), {'step': 1})
+
+
+if __name__ == '__main__':
+  absltest.main()